@@ -0,0 +1,190 @@
+import operator
+from functools import lru_cache
+from typing import Callable, Iterable, NamedTuple
+
+from utils import (
+    ANALYTICS_DEFAULT_WINDOW,
+    ANALYTICS_PRECISION,
+    ANALYTICS_WINDOW_SEPARATOR,
+    ANALYTICS_WINDOWS,
+    GOOD_CONDITIONS,
+    HOURS_RANGE,
+)
+
+MEAN = 'mean'
+SUM = 'sum'
+MIN = 'min'
+MAX = 'max'
+COUNT = 'count'
+AGGREGATES: dict[str, Callable] = {
+    MEAN: operator.add,
+    SUM: operator.add,
+    MIN: min,
+    MAX: max,
+    COUNT: operator.add,
+}
+# Колонки, которые есть в упакованных данных дня всегда
+BASE_FIELDS = ('temp', 'condition')
+
+
+class Metric(NamedTuple):
+    """
+    Показатель дня: агрегат поля часов. Если заданы values, count
+    считает часы, в которые значение поля входит в values, иначе -
+    все часы, для которых есть значение поля
+    """
+    field: str
+    aggregate: str
+    title: str
+    values: frozenset | None = None
+
+
+METRICS: dict[str, Metric] = {}
+
+
+def register_metric(
+        name: str,
+        field: str,
+        aggregate: str,
+        title: str,
+        values: Iterable | None = None,
+) -> None:
+    """Добавить показатель в реестр"""
+    if aggregate not in AGGREGATES:
+        raise ValueError(f'Unknown aggregate {aggregate}')
+    METRICS[name] = Metric(
+        field, aggregate, title, None if values is None else frozenset(values)
+    )
+
+
+register_metric('temp', 'temp', MEAN, 'Температура, среднее')
+register_metric('temp_min', 'temp', MIN, 'Температура, минимум')
+register_metric('temp_max', 'temp', MAX, 'Температура, максимум')
+register_metric(
+    'good_hours', 'condition', COUNT, 'Без осадков, часов', GOOD_CONDITIONS
+)
+register_metric('feels_like', 'feels_like', MEAN, 'Ощущается как, среднее')
+register_metric('humidity', 'humidity', MEAN, 'Влажность, %')
+register_metric('prec_mm', 'prec_mm', SUM, 'Осадки, мм')
+register_metric('wind_speed', 'wind_speed', MAX, 'Ветер, максимум м/с')
+register_metric('uv_index', 'uv_index', MAX, 'УФ-индекс, максимум')
+
+
+def parse_spec(spec: str) -> tuple[str, str]:
+    """
+    Показатель и окно часов из записи вида 'humidity@evening'.
+    Без окна берётся ANALYTICS_DEFAULT_WINDOW
+    """
+    name, _, window = spec.partition(ANALYTICS_WINDOW_SEPARATOR)
+    window = window or ANALYTICS_DEFAULT_WINDOW
+    if name not in METRICS:
+        raise ValueError(f'Unknown metric {name}')
+    if window not in ANALYTICS_WINDOWS:
+        raise ValueError(f'Unknown hours window {window}')
+    return name, window
+
+
+def normalize_specs(specs: Iterable[str]) -> tuple[str, ...]:
+    """Записи показателей с явным окном, без повторов"""
+    return tuple(dict.fromkeys(
+        ANALYTICS_WINDOW_SEPARATOR.join(parse_spec(spec)) for spec in specs
+    ))
+
+
+def spec_title(spec: str) -> str:
+    """Подпись показателя для таблицы результатов"""
+    name, window = parse_spec(spec)
+    return f'{METRICS[name].title} ({window})'
+
+
+def metric_value(aggregate: str, total, count: int) -> float | int | None:
+    """
+    Значение показателя за день по накопленному итогу и числу часов
+    с данными. Одно и то же для расчёта по часам и векторного
+    """
+    if not count:
+        return None
+    if aggregate == COUNT:
+        return int(total)
+    if aggregate == MEAN:
+        total = total / count
+    return round(float(total), ANALYTICS_PRECISION)
+
+
+class DayAnalyzer:
+    """
+    Средняя температура, часы без осадков и все запрошенные показатели
+    дня за один проход по часам. Для каждого часа заранее составлен
+    список показателей, в окна которых он попадает, поэтому новый
+    показатель добавляет только арифметику, но не проходы по данным
+    """
+
+    def __init__(self, specs: tuple[str, ...]) -> None:
+        self.specs = specs
+        self.slots: list[tuple[Metric, tuple[int, int]]] = [
+            (METRICS['temp'], HOURS_RANGE),
+            (METRICS['good_hours'], HOURS_RANGE),
+        ]
+        for name, window in map(parse_spec, specs):
+            self.slots.append((METRICS[name], ANALYTICS_WINDOWS[window]))
+        self.aggregates = tuple(metric.aggregate for metric, _ in self.slots)
+        # Поля, которые упаковываются после базовых колонок дня
+        self.fields = tuple(dict.fromkeys(
+            metric.field for metric, _ in self.slots
+            if metric.field not in BASE_FIELDS
+        ))
+        columns = {
+            field: index
+            for index, field in enumerate(BASE_FIELDS + self.fields)
+        }
+        plan: dict[int, list] = {}
+        for slot, (metric, (first, last)) in enumerate(self.slots):
+            for hour in range(first, last + 1):
+                plan.setdefault(hour, []).append((
+                    slot,
+                    columns[metric.field],
+                    AGGREGATES[metric.aggregate],
+                    metric.values,
+                    metric.aggregate == COUNT,
+                ))
+        self.plan = {hour: tuple(steps) for hour, steps in plan.items()}
+
+    def __call__(
+            self, day_columns: Iterable[tuple]
+    ) -> tuple[int | None, int | None, tuple]:
+        """
+        Для колонок дня (часы, температура, погода, *fields): средняя
+        температура, часы без осадков и значения показателей specs
+        """
+        hours, *columns = day_columns
+        totals: list = [None] * len(self.slots)
+        counts = [0] * len(self.slots)
+        plan = self.plan
+        for hour, row in zip(hours, zip(*columns)):
+            for slot, column, update, values, counted in plan.get(hour, ()):
+                value = row[column]
+                if value is None:
+                    continue
+                if values is not None:
+                    value = value in values
+                elif counted:
+                    value = 1
+                total = totals[slot]
+                totals[slot] = value if total is None else update(total, value)
+                counts[slot] += 1
+        if not counts[0]:
+            return None, None, ()
+        return (
+            int(round(totals[0] / counts[0], 0)),
+            int(totals[1]),
+            tuple(map(metric_value, self.aggregates[2:], totals[2:], counts[2:])),
+        )
+
+
+@lru_cache(maxsize=None)
+def compile_analytics(specs: tuple[str, ...]) -> DayAnalyzer:
+    """
+    Анализатор для записей после normalize_specs. В процессах пула
+    составляется один раз на набор показателей
+    """
+    return DayAnalyzer(specs)
@@ -1,45 +1,118 @@
 import logging
 import json
-from urllib.request import urlopen
+import time
 from http import HTTPStatus
 
-from utils import CITIES, ERR_MESSAGE_TEMPLATE
-from exceptions import YandexAPIException
+from cache import ResponseCache
+from metrics import metrics
+from connection_pool import (
+    ConnectionPool, PooledResponse, default_pool
+)
+from resilience import Resilience, default_resilience
+from utils import CITIES, ERR_MESSAGE_TEMPLATE, RETRY_STATUSES
+from exceptions import TransientAPIException, YandexAPIException
 
 logger = logging.getLogger()
 
 
+def get_city_url(cities: dict[str, str], city_name: str) -> str:
+    city_url = cities.get(city_name)
+    if not city_url:
+        raise YandexAPIException(
+            "Please check that city {} exists".format(city_name)
+        )
+    return city_url
+
+
 class YandexWeatherAPI:
     """
     Base class for requests
     """
 
-    @staticmethod
-    def _do_req(url: str) -> dict:
+    def __init__(
+            self,
+            pool: ConnectionPool | None = None,
+            cache: ResponseCache | None = None,
+            cities: dict[str, str] | None = None,
+            resilience: Resilience | None = None,
+    ) -> None:
+        self.pool = pool or default_pool
+        self.resilience = resilience or default_resilience
+        self.cache = cache
+        self.cities = CITIES if cities is None else cities
+
+    def _do_req(self, url: str) -> dict:
         """Base request method"""
+        if self.cache is None:
+            return self._parse(self._request(url).body)
+        entry = self.cache.get(url)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.hit()
+            metrics.inc('cache_requests_total', result='hit')
+            return self._parse(entry.body)
+        headers = self.cache.conditional_headers(entry) if entry else None
+        resp = self._request(url, headers)
+        if entry and resp.status == HTTPStatus.NOT_MODIFIED:
+            self.cache.hit()
+            self.cache.revalidate(entry)
+            metrics.inc('cache_requests_total', result='revalidated')
+            return self._parse(entry.body)
+        self.cache.miss()
+        metrics.inc('cache_requests_total', result='miss')
+        data = self._parse(resp.body)
+        self.cache.put(url, resp.body, resp.headers)
+        return data
+
+    def _request(
+            self, url: str, headers: dict[str, str] | None = None
+    ) -> PooledResponse:
+        """
+        Request with timeouts, retries of transient errors, a circuit
+        breaker per host and optional hedging
+        """
+        return self.resilience.call(
+            url, lambda: self._request_once(url, headers)
+        )
+
+    def _request_once(
+            self, url: str, headers: dict[str, str] | None = None
+    ) -> PooledResponse:
+        started = time.perf_counter()
         try:
-            with urlopen(url) as req:
-                resp = req.read().decode("utf-8")
-                resp = json.loads(resp)
-            if req.status != HTTPStatus.OK:
-                raise YandexAPIException(
-                    "Error during execute request. {}: {}".format(
-                        resp.status, resp.reason
-                    )
-                )
-            return resp
+            resp = self.pool.request(url, headers)
         except Exception as ex:
-            logger.exception(ex)
-            raise YandexAPIException(ERR_MESSAGE_TEMPLATE)
+            metrics.inc('fetch_errors_total', client='sync')
+            logger.warning(f'Request to {url} failed: {ex!r}')
+            raise TransientAPIException(ERR_MESSAGE_TEMPLATE) from ex
+        metrics.observe(
+            'fetch_seconds', time.perf_counter() - started, client='sync'
+        )
+        metrics.inc('fetch_requests_total', client='sync', status=resp.status)
+        metrics.inc('fetch_response_bytes_total', len(resp.body), client='sync')
+        if resp.status in RETRY_STATUSES:
+            raise TransientAPIException(
+                "Error during execute request. {}: {}".format(
+                    resp.status, resp.reason
+                )
+            )
+        if resp.status not in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED):
+            raise YandexAPIException(
+                "Error during execute request. {}: {}".format(
+                    resp.status, resp.reason
+                )
+            )
+        return resp
 
     @staticmethod
-    def _get_url_by_city_name(city_name: str) -> str:
+    def _parse(body: bytes) -> dict:
         try:
-            return CITIES[city_name]
-        except KeyError:
-            raise YandexAPIException(
-                "Please check that city {} exists".format(city_name)
-            )
+            return json.loads(body)
+        except ValueError as ex:
+            logger.exception(ex)
+            raise YandexAPIException(ERR_MESSAGE_TEMPLATE)
+
+    def _get_url_by_city_name(self, city_name: str) -> str:
+        return get_city_url(self.cities, city_name)
 
     def get_forecasting(self, city_name: str) -> dict:
         """
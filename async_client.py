@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import ssl
+import time
+from collections import defaultdict
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from api_client import get_city_url
+from cache import ResponseCache
+from exceptions import TransientAPIException, YandexAPIException
+from metrics import metrics
+from resilience import Resilience, default_resilience
+from utils import (
+    ASYNC_FETCH_CONCURRENCY,
+    ASYNC_FETCH_PER_HOST_LIMIT,
+    ASYNC_FETCH_TIMEOUT,
+    CITIES,
+    ERR_MESSAGE_TEMPLATE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    RETRY_STATUSES,
+)
+
+logger = logging.getLogger()
+
+
+class AsyncYandexWeatherAPI:
+    """
+    Non-blocking requests over asyncio streams
+    """
+
+    def __init__(
+            self,
+            concurrency: int = ASYNC_FETCH_CONCURRENCY,
+            per_host_limit: int = ASYNC_FETCH_PER_HOST_LIMIT,
+            timeout: float = ASYNC_FETCH_TIMEOUT,
+            cities: dict[str, str] | None = None,
+            connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+            read_timeout: float = HTTP_READ_TIMEOUT,
+            resilience: Resilience | None = None,
+            cache: ResponseCache | None = None,
+    ) -> None:
+        self.cache = cache
+        self.concurrency = concurrency
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.resilience = resilience or default_resilience
+        self.cities = cities
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._host_semaphores: defaultdict[str, asyncio.Semaphore] = (
+            defaultdict(lambda: asyncio.Semaphore(self.per_host_limit))
+        )
+        self._ssl_context = ssl.create_default_context()
+
+    async def _do_req(self, url: str) -> dict:
+        """
+        Base request method. Transient errors are retried, see Resilience.
+        Cache files are read and written in worker threads, so disk access
+        does not block the event loop
+        """
+        if self.cache is None:
+            _, _, body = await self._request(url)
+            return self._parse(body)
+        entry = await asyncio.to_thread(self.cache.get, url)
+        if entry and self.cache.is_fresh(entry):
+            self.cache.hit()
+            metrics.inc('cache_requests_total', result='hit')
+            return self._parse(entry.body)
+        headers = self.cache.conditional_headers(entry) if entry else None
+        status, response_headers, body = await self._request(url, headers)
+        if entry and status == HTTPStatus.NOT_MODIFIED:
+            self.cache.hit()
+            await asyncio.to_thread(self.cache.revalidate, entry)
+            metrics.inc('cache_requests_total', result='revalidated')
+            return self._parse(entry.body)
+        self.cache.miss()
+        metrics.inc('cache_requests_total', result='miss')
+        data = self._parse(body)
+        await asyncio.to_thread(self.cache.put, url, body, response_headers)
+        return data
+
+    async def _request(
+            self, url: str, headers: dict[str, str] | None = None
+    ) -> tuple[int, dict[str, str], bytes]:
+        return await self.resilience.call_async(
+            url, lambda: self._request_once(url, headers)
+        )
+
+    @staticmethod
+    def _parse(body: bytes) -> dict:
+        """Decode the response"""
+        try:
+            return json.loads(body)
+        except ValueError as ex:
+            logger.exception(ex)
+            raise YandexAPIException(ERR_MESSAGE_TEMPLATE)
+
+    async def _request_once(
+            self, url: str, headers: dict[str, str] | None = None
+    ) -> tuple[int, dict[str, str], bytes]:
+        """One attempt within the global and per-host limits"""
+        parts = urlsplit(url)
+        host = parts.hostname or ''
+        async with self._semaphore, self._host_semaphores[parts.netloc]:
+            started = time.perf_counter()
+            try:
+                status, reason, response_headers, body = (
+                    await asyncio.wait_for(
+                        self._fetch(
+                            parts.scheme, host, parts.port, url, headers
+                        ),
+                        self.timeout,
+                    )
+                )
+            except Exception as ex:
+                metrics.inc('fetch_errors_total', client='async')
+                logger.warning(f'Request to {url} failed: {ex!r}')
+                raise TransientAPIException(ERR_MESSAGE_TEMPLATE) from ex
+        metrics.observe(
+            'fetch_seconds', time.perf_counter() - started, client='async'
+        )
+        metrics.inc('fetch_requests_total', client='async', status=status)
+        metrics.inc('fetch_response_bytes_total', len(body), client='async')
+        if status == HTTPStatus.NOT_MODIFIED and headers:
+            return status, response_headers, body
+        if status != HTTPStatus.OK:
+            exception_class = (
+                TransientAPIException if status in RETRY_STATUSES
+                else YandexAPIException
+            )
+            raise exception_class(
+                "Error during execute request. {}: {}".format(status, reason)
+            )
+        return status, response_headers, body
+
+    async def _fetch(
+            self,
+            scheme: str,
+            host: str,
+            port: int | None,
+            url: str,
+            headers: dict[str, str] | None = None,
+    ) -> tuple[int, str, dict[str, str], bytes]:
+        """Send a GET request and read the whole response"""
+        secure = scheme == 'https'
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port or (443 if secure else 80),
+                ssl=self._ssl_context if secure else None,
+            ),
+            self.connect_timeout,
+        )
+        try:
+            parts = urlsplit(url)
+            target = parts.path or '/'
+            if parts.query:
+                target = f'{target}?{parts.query}'
+            extra_headers = ''.join(
+                f'{name}: {value}\r\n'
+                for name, value in (headers or {}).items()
+            )
+            writer.write(
+                f'GET {target} HTTP/1.1\r\n'
+                f'Host: {parts.netloc}\r\n'
+                'Accept: application/json\r\n'
+                f'{extra_headers}'
+                'Connection: close\r\n\r\n'.encode('latin-1')
+            )
+            await writer.drain()
+            status, reason, response_headers = await asyncio.wait_for(
+                self._read_head(reader), self.read_timeout
+            )
+            body = b''
+            if status != HTTPStatus.NOT_MODIFIED:
+                body = await asyncio.wait_for(
+                    self._read_body(reader, response_headers),
+                    self.read_timeout,
+                )
+        finally:
+            writer.close()
+        return status, reason, response_headers, body
+
+    @staticmethod
+    async def _read_head(
+            reader: asyncio.StreamReader
+    ) -> tuple[int, str, dict[str, str]]:
+        """Read the status line and headers of the response"""
+        status_line = (await reader.readline()).decode('latin-1')
+        _, status, *reason = status_line.split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return int(status), ''.join(reason).strip(), headers
+
+    @staticmethod
+    async def _read_body(
+            reader: asyncio.StreamReader, headers: dict[str, str]
+    ) -> bytes:
+        """Read the body according to the transfer headers"""
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = await reader.readline()
+                size = int(size_line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            return b''.join(chunks)
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length']))
+        return await reader.read()
+
+    async def get_forecasting(self, city_name: str) -> dict:
+        """
+        :param city_name: key as str
+        :return: response data as json
+        """
+        city_url = get_city_url(
+            CITIES if self.cities is None else self.cities, city_name
+        )
+        return await self._do_req(city_url)
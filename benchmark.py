@@ -0,0 +1,346 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, NamedTuple
+
+from executors import get_executor, shutdown_executors
+from memo import city_memo, day_memo
+from metrics import metrics
+from ranking import RatingEngine
+from stub_server import StubForecastServer, synthetic_cities
+from tasks import (
+    DataAggregationTask,
+    DataAnalyzingTask,
+    DataCalculationTask,
+    DataFetchingTask,
+)
+from vectorized import np
+from writers import WRITERS
+from utils import (
+    BENCHMARK_RESULTS_PATH, BENCHMARK_SCALES, BENCHMARK_REGRESSION_THRESHOLD,
+    CALCULATION_ENGINES, CALCULATION_ENGINE_NUMPY, CALCULATION_ENGINE_POOL,
+    CALCULATION_PROCESSES, EXECUTORS, EXECUTOR_AUTO, EXECUTOR_PROCESS,
+    FETCH_MODES,
+    FETCH_MODE_ASYNC, OUTPUT_FORMAT_CSV,
+)
+
+
+class StageResult(NamedTuple):
+    stage: str
+    setting: str
+    cities: int
+    wall: float
+    cpu: float
+    requests: int
+    errors: int
+
+    def to_dict(self) -> dict:
+        result = self._asdict()
+        result['cities_per_second'] = (
+            self.cities / self.wall if self.wall else None
+        )
+        return result
+
+
+def cpu_time() -> float:
+    """
+    Процессорное время текущего процесса и задач процессов пула.
+    Процессы пула живут весь запуск, поэтому их время берётся
+    из метрик, которые они присылают вместе с результатами
+    """
+    return time.process_time() + metrics.value('worker_cpu_seconds_total')
+
+
+class BenchmarkRunner:
+    """
+    Замер времени каждого этапа на синтетических городах, которые
+    отдаёт локальный StubForecastServer. Сервер работает в том же
+    процессе, поэтому его процессорное время входит в замер CPU
+    """
+
+    def __init__(
+            self,
+            server: StubForecastServer,
+            fetch_modes: tuple[str, ...] = FETCH_MODES,
+            engines: tuple[str, ...] = CALCULATION_ENGINES,
+            executors: tuple[str, ...] = EXECUTORS,
+            output_format: str = OUTPUT_FORMAT_CSV,
+    ) -> None:
+        self.server = server
+        self.fetch_modes = fetch_modes
+        self.engines = tuple(
+            engine for engine in engines
+            if engine != CALCULATION_ENGINE_NUMPY or np is not None
+        )
+        self.executors = executors
+        self.output_format = output_format
+        self.results: list[StageResult] = []
+
+    def measure(
+            self, stage: str, setting: str, cities: int, func: Callable
+    ):
+        """Выполнить func, сохранить время выполнения и вернуть результат"""
+        requests, errors = self.server.requests_count, self.server.errors_count
+        start_wall, start_cpu = time.perf_counter(), cpu_time()
+        result = func()
+        wall = time.perf_counter() - start_wall
+        self.results.append(StageResult(
+            stage, setting, cities, wall, cpu_time() - start_cpu,
+            self.server.requests_count - requests,
+            self.server.errors_count - errors,
+        ))
+        logging.info(
+            f'{stage} [{setting}] {cities} cities: {wall:.3f}s'
+        )
+        return result
+
+    def run(self, scale: int) -> list[StageResult]:
+        """
+        Прогнать все этапы для scale городов. На время замеров
+        включаются метрики: с ними процессы пула присылают своё
+        процессорное время
+        """
+        enabled = metrics.enabled
+        metrics.enable()
+        try:
+            self.run_stages(scale)
+        finally:
+            metrics.enabled = enabled
+        return [result for result in self.results if result.cities == scale]
+
+    def run_stages(self, scale: int) -> None:
+        cities = synthetic_cities(scale)
+        self.server.warm_up(cities)
+        cities_urls = self.server.cities_urls(cities)
+        raw_data = None
+        for fetch_mode in self.fetch_modes:
+            task = DataFetchingTask(cities_urls)
+            fetch = (
+                task.start_async if fetch_mode == FETCH_MODE_ASYNC
+                else task.start_threads
+            )
+            raw_data = self.measure('fetching', fetch_mode, scale, fetch)
+        forecasts = None
+        for engine, executor in self.calculation_settings():
+            self.cold_start()
+            forecasts = self.measure(
+                'calculation', f'{engine}-{executor}', scale,
+                DataCalculationTask(raw_data, engine, executor).calculate_data,
+            )
+        # Повторный расчёт тех же данных: все города берутся из памяти
+        self.measure(
+            'calculation', 'unchanged', scale,
+            DataCalculationTask(raw_data).calculate_data,
+        )
+        for fetch_mode in self.fetch_modes:
+            self.cold_start()
+            self.measure(
+                'aggregation', f'staged-{fetch_mode}', scale,
+                DataAggregationTask(cities_urls, fetch_mode).aggregate_data,
+            )
+        self.cold_start()
+        self.measure(
+            'aggregation', 'pipeline', scale,
+            DataAggregationTask(
+                cities_urls, pipeline=True, rating=RatingEngine()
+            ).aggregate_data,
+        )
+        self.measure(
+            'analyzing', self.output_format, scale,
+            lambda: self.analyze(forecasts),
+        )
+
+    @staticmethod
+    def cold_start() -> None:
+        """
+        Забыть сохранённые результаты расчётов, в том числе в процессах
+        пула. Пул запускается заново до начала замера
+        """
+        city_memo.clear()
+        day_memo.clear()
+        shutdown_executors()
+        get_executor(EXECUTOR_PROCESS, workers=CALCULATION_PROCESSES).pool
+
+    def calculation_settings(self) -> list[tuple[str, str]]:
+        """Способы расчёта: исполнитель важен только для расчёта по городам"""
+        return [
+            (engine, executor)
+            for engine in self.engines
+            for executor in (
+                self.executors if engine == CALCULATION_ENGINE_POOL
+                else (EXECUTOR_AUTO,)
+            )
+        ]
+
+    def analyze(self, forecasts: list) -> list[str] | None:
+        """Анализ с записью результатов во временный каталог"""
+        with tempfile.TemporaryDirectory() as directory:
+            writer = WRITERS[self.output_format](
+                os.path.join(directory, 'result'),
+                DataAnalyzingTask(forecasts).get_dates(),
+            )
+            return DataAnalyzingTask(forecasts, writer=writer).analyze_data()
+
+
+def metadata(server: StubForecastServer, args: dict) -> dict:
+    """Окружение и параметры запуска для сравнения результатов"""
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': None if np is None else np.__version__,
+        'server': {
+            'days': server.days,
+            'latency': server.latency,
+            'jitter': server.jitter,
+            'error_rate': server.error_rate,
+        },
+        'args': args,
+    }
+
+
+def compare(
+        baseline: dict,
+        current: dict,
+        threshold: float = BENCHMARK_REGRESSION_THRESHOLD,
+) -> list[dict]:
+    """
+    Сравнить время этапов с прошлым запуском. Возвращает записи
+    об этапах, ставших медленнее больше чем на threshold
+    """
+    def index(report: dict) -> dict:
+        return {
+            (item['stage'], item['setting'], item['cities']): item
+            for item in report['results']
+        }
+
+    previous = index(baseline)
+    regressions = []
+    for key, item in index(current).items():
+        if key not in previous or not previous[key]['wall']:
+            continue
+        ratio = item['wall'] / previous[key]['wall']
+        if ratio > 1 + threshold:
+            stage, setting, cities = key
+            regressions.append({
+                'stage': stage, 'setting': setting, 'cities': cities,
+                'baseline': previous[key]['wall'], 'current': item['wall'],
+                'ratio': ratio,
+            })
+    return regressions
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """Запустить замеры для всех масштабов и собрать отчёт"""
+    with StubForecastServer(
+        args.days, args.latency, args.jitter, args.error_rate, args.seed,
+    ) as server:
+        runner = BenchmarkRunner(
+            server,
+            tuple(args.fetch_modes),
+            tuple(args.engines),
+            tuple(args.executors),
+            args.output_format,
+        )
+        for scale in args.scales:
+            runner.run(scale)
+        return {
+            'metadata': metadata(server, {
+                'scales': args.scales,
+                'fetch_modes': args.fetch_modes,
+                'engines': args.engines,
+                'executors': args.executors,
+                'output_format': args.output_format,
+                'seed': args.seed,
+            }),
+            'results': [result.to_dict() for result in runner.results],
+        }
+
+
+def print_report(report: dict) -> None:
+    print(f'{"этап":<12} {"настройка":<16} {"городов":>8} '
+          f'{"время, с":>10} {"CPU, с":>10} {"городов/с":>12}')
+    for item in report['results']:
+        print(
+            f'{item["stage"]:<12} {item["setting"]:<16} '
+            f'{item["cities"]:>8} {item["wall"]:>10.3f} '
+            f'{item["cpu"]:>10.3f} {item["cities_per_second"] or 0:>12.1f}'
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Замеры производительности этапов анализа погоды'
+    )
+    parser.add_argument(
+        '--scales', type=int, nargs='+', default=list(BENCHMARK_SCALES),
+        help='число городов в каждом прогоне, например 10 1000 100000',
+    )
+    parser.add_argument(
+        '--days', type=int, default=5, help='дней в прогнозе города',
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='задержка ответа сервера, секунд',
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='разброс задержки ответа, секунд',
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0,
+        help='доля ответов с ошибкой 503',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--fetch-modes', nargs='+', choices=FETCH_MODES,
+        default=list(FETCH_MODES),
+    )
+    parser.add_argument(
+        '--engines', nargs='+', choices=CALCULATION_ENGINES,
+        default=list(CALCULATION_ENGINES),
+    )
+    parser.add_argument(
+        '--executors', nargs='+', choices=EXECUTORS, default=list(EXECUTORS),
+    )
+    parser.add_argument(
+        '--output-format', choices=tuple(WRITERS), default=OUTPUT_FORMAT_CSV,
+    )
+    parser.add_argument(
+        '--output', default=BENCHMARK_RESULTS_PATH,
+        help='файл для результатов в формате JSON',
+    )
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='сравнить с результатами прошлого запуска',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=BENCHMARK_REGRESSION_THRESHOLD,
+        help='допустимое замедление этапа, доля',
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args()
+    report = run_benchmark(args)
+    print_report(report)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), report, args.threshold)
+        for item in regressions:
+            print(
+                f'Замедление: {item["stage"]} [{item["setting"]}] '
+                f'{item["cities"]} городов: {item["baseline"]:.3f}s -> '
+                f'{item["current"]:.3f}s'
+            )
+        sys.exit(1 if regressions else 0)
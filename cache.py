@@ -0,0 +1,178 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from utils import (
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_MAX_SIZE,
+    RESPONSE_CACHE_TTL,
+)
+
+logger = logging.getLogger()
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    body: bytes
+    stored_at: float
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+class ResponseCache:
+    """
+    Gzip-compressed responses on disk with TTL and LRU eviction by size
+    """
+
+    suffix = '.json.gz'
+
+    def __init__(
+            self,
+            directory: str = RESPONSE_CACHE_DIR,
+            ttl: float = RESPONSE_CACHE_TTL,
+            max_size: int = RESPONSE_CACHE_MAX_SIZE,
+    ) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        """Restore the LRU order, file mtime is updated on every read"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+            self.size += size
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _name(self, url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest() + self.suffix
+
+    def get(self, url: str) -> CacheEntry | None:
+        """Read the stored response, fresh or stale"""
+        name = self._name(url)
+        try:
+            with open(self._path(name), 'rb') as cache_file:
+                raw = gzip.decompress(cache_file.read())
+            meta, _, body = raw.partition(b'\n')
+            entry = CacheEntry(body=body, **json.loads(meta))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as ex:
+            logger.warning(f'Broken cache entry for {url}: {ex}')
+            self._remove(name)
+            return None
+        try:
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if name in self._sizes:
+                self._sizes.move_to_end(name)
+        return entry
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.stored_at < self.ttl
+
+    def hit(self) -> None:
+        with self._lock:
+            self.hits += 1
+
+    def miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def put(self, url: str, body: bytes, headers: dict[str, str]) -> None:
+        """Store a full response along with its validators"""
+        self._write(CacheEntry(
+            url=url,
+            body=body,
+            stored_at=time.time(),
+            etag=headers.get('etag'),
+            last_modified=headers.get('last-modified'),
+        ))
+
+    def revalidate(self, entry: CacheEntry) -> None:
+        """Mark an entry confirmed by 304 Not Modified as fresh again"""
+        with self._lock:
+            self.revalidations += 1
+        self._write(entry._replace(stored_at=time.time()))
+
+    @staticmethod
+    def conditional_headers(entry: CacheEntry) -> dict[str, str]:
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def _write(self, entry: CacheEntry) -> None:
+        name = self._name(entry.url)
+        meta = json.dumps({
+            field: getattr(entry, field)
+            for field in entry._fields if field != 'body'
+        }).encode('utf-8')
+        data = gzip.compress(meta + b'\n' + entry.body)
+        tmp_path = f'{self._path(name)}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, self._path(name))
+        with self._lock:
+            self.size += len(data) - self._sizes.get(name, 0)
+            self._sizes[name] = len(data)
+            self._sizes.move_to_end(name)
+        self._evict()
+
+    def _evict(self) -> None:
+        """Remove least recently used entries above the size limit"""
+        while True:
+            with self._lock:
+                if len(self._sizes) <= 1 or self.size <= self.max_size:
+                    return
+                name, size = self._sizes.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+            self._unlink(name)
+
+    def _remove(self, name: str) -> None:
+        with self._lock:
+            self.size -= self._sizes.pop(name, 0)
+        self._unlink(name)
+
+    def _unlink(self, name: str) -> None:
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'entries': len(self._sizes),
+                'size': self.size,
+            }
@@ -0,0 +1,162 @@
+import logging
+import os
+import pickle
+import struct
+import threading
+from typing import Iterable, Iterator, Sequence
+
+from analytics import normalize_specs
+from metrics import metrics
+from models import CityForecast
+from utils import CHECKPOINT_PATH
+
+# Тип записи, длина названия города и длина данных
+RECORD_HEADER = struct.Struct('<cHI')
+RECORD_RUN = b'H'
+RECORD_RAW = b'R'
+RECORD_FORECAST = b'F'
+
+
+class CheckpointJournal:
+    """
+    Журнал контрольных точек запуска. Ответы API и результаты расчёта
+    городов дописываются в файл по мере готовности, поэтому после
+    прерванного запуска с resume запрашиваются и рассчитываются только
+    города, которых в журнале нет.
+
+    Ответы API при загрузке не разбираются: запоминается их место
+    в файле, а читаются они, когда понадобятся. Результаты расчёта
+    с другим набором показателей при resume не используются
+    """
+
+    def __init__(
+            self,
+            path: str = CHECKPOINT_PATH,
+            analytics: Sequence[str] = (),
+            resume: bool = False,
+    ) -> None:
+        self.path = path
+        self.analytics = normalize_specs(analytics)
+        self._lock = threading.Lock()
+        # Город -> место и длина ответа API в файле
+        self._raw: dict[str, tuple[int, int]] = {}
+        self.forecasts: dict[str, CityForecast] = {}
+        run_analytics = None
+        if resume and os.path.exists(path):
+            run_analytics = self._load()
+            self._file = open(path, 'a+b')
+        else:
+            self._file = open(path, 'w+b')
+        if run_analytics != self.analytics:
+            self._write(RECORD_RUN, '', self.analytics)
+
+    def __enter__(self) -> 'CheckpointJournal':
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        """Журнал успешно завершённого запуска больше не нужен"""
+        self.close(remove=exc_type is None)
+
+    def close(self, remove: bool = False) -> None:
+        with self._lock:
+            self._file.close()
+        if remove:
+            os.remove(self.path)
+
+    def _load(self) -> tuple[str, ...] | None:
+        """
+        Прочитать журнал. Неполная последняя запись (запуск прервался
+        во время записи) отрезается. Возвращает показатели последнего
+        запуска
+        """
+        run_analytics = None
+        with open(self.path, 'r+b') as file:
+            end = 0
+            while header := file.read(RECORD_HEADER.size):
+                if len(header) < RECORD_HEADER.size:
+                    break
+                kind, city_size, size = RECORD_HEADER.unpack(header)
+                city = file.read(city_size)
+                if len(city) < city_size:
+                    break
+                city = city.decode()
+                offset = file.tell()
+                if kind == RECORD_RAW:
+                    file.seek(size, os.SEEK_CUR)
+                    if file.tell() > os.fstat(file.fileno()).st_size:
+                        break
+                    self._raw[city] = (offset, size)
+                else:
+                    data = file.read(size)
+                    if len(data) < size:
+                        break
+                    if kind == RECORD_RUN:
+                        run_analytics = pickle.loads(data)
+                    elif run_analytics == self.analytics:
+                        self.forecasts[city] = pickle.loads(data)
+                end = file.tell()
+            if end < os.fstat(file.fileno()).st_size:
+                logging.warning(
+                    f'Checkpoint journal {self.path} truncated at {end}'
+                )
+                file.truncate(end)
+        logging.info(
+            f'Checkpoint journal {self.path}: {len(self.forecasts)} '
+            f'calculated cities, {len(self._raw)} API responses'
+        )
+        return run_analytics
+
+    def _write(self, kind: bytes, city: str, value) -> None:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        city_bytes = city.encode()
+        record = RECORD_HEADER.pack(kind, len(city_bytes), len(data))
+        with self._lock:
+            self._file.write(record + city_bytes + data)
+            # После сбоя процесса данные остаются в кэше ОС
+            self._file.flush()
+
+    def record_raw(self, city: str, city_data: dict | None) -> None:
+        """Записать ответ API города"""
+        if city_data is not None:
+            self._write(RECORD_RAW, city, city_data)
+
+    def record_forecast(self, forecast: CityForecast) -> None:
+        """Записать результат расчёта города, если его ещё нет в журнале"""
+        if forecast.has_data and forecast.city not in self.forecasts:
+            self._write(RECORD_FORECAST, forecast.city, forecast)
+
+    def raw_data(self, city: str) -> dict:
+        offset, size = self._raw[city]
+        return pickle.loads(os.pread(self._file.fileno(), size, offset))
+
+    def iter_raw(self, cities: Iterable[str]) -> Iterator[tuple[str, dict]]:
+        """Записанные ответы API городов в виде результата получения данных"""
+        for city in cities:
+            yield city, self.raw_data(city)
+
+    def pending(
+            self, cities_urls: dict[str, str]
+    ) -> tuple[dict[str, CityForecast], list[str], dict[str, str]]:
+        """
+        Разделить города: рассчитанные ранее, с записанным ответом API
+        и те, данные которых нужно получить
+        """
+        done = {
+            city: self.forecasts[city]
+            for city in cities_urls if city in self.forecasts
+        }
+        recorded = [
+            city for city in cities_urls
+            if city not in done and city in self._raw
+        ]
+        to_fetch = {
+            city: url for city, url in cities_urls.items()
+            if city not in done and city not in self._raw
+        }
+        metrics.inc(
+            'cities_total', len(done), stage='checkpoint', result='calculated'
+        )
+        metrics.inc(
+            'cities_total', len(recorded), stage='checkpoint', result='fetched'
+        )
+        return done, recorded, to_fetch
@@ -0,0 +1,406 @@
+import ipaddress
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from collections import Counter, deque
+from itertools import islice
+from multiprocessing.managers import BaseManager
+from typing import Sequence
+
+from analytics import normalize_specs
+from cache import ResponseCache
+from metrics import metrics
+from models import CityForecast
+from tasks import DataAggregationTask
+from utils import (
+    CITIES_DESCRIPTION_MAP, FETCH_MODE_THREADS, CALCULATION_ENGINE_POOL,
+    EXECUTOR_AUTO, CLUSTER_HOST, CLUSTER_PORT, CLUSTER_AUTHKEY_ENV,
+    CLUSTER_AUTHKEY_BYTES,
+    CLUSTER_SHARD_SIZE, CLUSTER_LEASE_TIMEOUT, CLUSTER_HEARTBEAT_INTERVAL,
+    CLUSTER_POLL_INTERVAL, CLUSTER_MAX_ATTEMPTS,
+)
+
+# Ответы ShardBoard.take
+SHARD_RUN = 'run'
+SHARD_WAIT = 'wait'
+SHARD_DONE = 'done'
+
+
+class ShardBoard:
+    """
+    Очередь шардов координатора. Узлы сами забирают следующий шард,
+    поэтому быстрые узлы обрабатывают больше шардов. Шард выдаётся
+    в аренду: узел продлевает её сигналами heartbeat, а шард узла,
+    пропавшего дольше lease_timeout, возвращается в очередь. Когда
+    очередь пуста, свободный узел получает копию самого долгого шарда
+    в работе; засчитывается результат, пришедший первым
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._reset([], (), CLUSTER_LEASE_TIMEOUT, CLUSTER_MAX_ATTEMPTS)
+
+    def _reset(
+            self,
+            shards: list[dict[str, str]],
+            analytics: tuple[str, ...],
+            lease_timeout: float,
+            max_attempts: int,
+    ) -> None:
+        self.shards = shards
+        self.analytics = analytics
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.pending: deque[int] = deque()
+        # Шард -> узел -> время последнего сигнала
+        self.leases: dict[int, dict[str, float]] = {}
+        self.started: dict[int, float] = {}
+        self.results: dict[int, list[CityForecast] | None] = {}
+        self.attempts: Counter = Counter()
+        self.stats: Counter = Counter()
+        self.pending.extend(range(len(shards)))
+
+    def load(
+            self,
+            shards: list[dict[str, str]],
+            analytics: tuple[str, ...] = (),
+            lease_timeout: float = CLUSTER_LEASE_TIMEOUT,
+            max_attempts: int = CLUSTER_MAX_ATTEMPTS,
+    ) -> None:
+        with self._lock:
+            self._reset(shards, analytics, lease_timeout, max_attempts)
+
+    def take(self, worker: str) -> tuple[str, int | None, dict | None, tuple]:
+        """
+        Следующий шард для узла: (SHARD_RUN, номер, города, показатели),
+        либо (SHARD_WAIT, None, None, ()), если свободных шардов пока нет,
+        либо (SHARD_DONE, None, None, ()), если все шарды готовы
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self.results) == len(self.shards):
+                return SHARD_DONE, None, None, ()
+            if self.pending:
+                shard = self.pending.popleft()
+            else:
+                shard = self._steal(worker)
+                if shard is None:
+                    return SHARD_WAIT, None, None, ()
+            self.leases.setdefault(shard, {})[worker] = now
+            self.started.setdefault(shard, now)
+            return SHARD_RUN, shard, self.shards[shard], self.analytics
+
+    def _steal(self, worker: str) -> int | None:
+        """Самый долгий шард в работе, ещё не продублированный"""
+        candidates = [
+            shard for shard, workers in self.leases.items()
+            if worker not in workers and len(workers) < 2
+        ]
+        if not candidates:
+            return None
+        self.stats['stolen'] += 1
+        return min(candidates, key=self.started.__getitem__)
+
+    def _expire(self, now: float) -> None:
+        """Вернуть в очередь шарды узлов, переставших присылать сигналы"""
+        for shard, workers in list(self.leases.items()):
+            for worker, seen in list(workers.items()):
+                if now - seen > self.lease_timeout:
+                    logging.warning(
+                        f'Worker {worker} lost, shard {shard} reassigned'
+                    )
+                    del workers[worker]
+                    self.stats['reassigned'] += 1
+            if not workers:
+                del self.leases[shard]
+                self.started.pop(shard, None)
+                self.pending.appendleft(shard)
+
+    def heartbeat(self, worker: str) -> None:
+        with self._lock:
+            now = time.monotonic()
+            for workers in self.leases.values():
+                if worker in workers:
+                    workers[worker] = now
+
+    def complete(
+            self, worker: str, shard: int, forecasts: list[CityForecast]
+    ) -> bool:
+        """Принять результат шарда; повторный результат отбрасывается"""
+        with self._lock:
+            if shard in self.results:
+                return False
+            self.results[shard] = forecasts
+            self.leases.pop(shard, None)
+            self.stats['completed'] += 1
+            return True
+
+    def fail(self, worker: str, shard: int, error: str) -> None:
+        """
+        Ошибка расчёта шарда на узле. После max_attempts ошибок шард
+        считается готовым без данных
+        """
+        with self._lock:
+            logging.warning(f'Shard {shard} failed on {worker}: {error}')
+            workers = self.leases.get(shard, {})
+            workers.pop(worker, None)
+            self.attempts[shard] += 1
+            self.stats['failed'] += 1
+            if shard in self.results:
+                return
+            if self.attempts[shard] >= self.max_attempts:
+                self.results[shard] = None
+                self.leases.pop(shard, None)
+            elif not workers:
+                self.leases.pop(shard, None)
+                self.started.pop(shard, None)
+                self.pending.appendleft(shard)
+
+    def poll(self) -> tuple[int, int]:
+        """Число готовых шардов и всего шардов"""
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self.results), len(self.shards)
+
+    def collect(self) -> tuple[list, dict[str, int]]:
+        """Результаты шардов по порядку и счётчики"""
+        with self._lock:
+            return (
+                [self.results.get(shard) for shard in range(len(self.shards))],
+                dict(self.stats),
+            )
+
+
+_board: ShardBoard | None = None
+
+
+def _shared_board() -> ShardBoard:
+    """Единственная очередь шардов в процессе сервера координатора"""
+    global _board
+    if _board is None:
+        _board = ShardBoard()
+    return _board
+
+
+class ClusterManager(BaseManager):
+    pass
+
+
+ClusterManager.register('board', callable=_shared_board)
+
+
+def cluster_authkey(key: str | None = None) -> bytes | None:
+    """Ключ кластера: заданный явно или из переменной окружения"""
+    key = key or os.environ.get(CLUSTER_AUTHKEY_ENV)
+    return key.encode() if key else None
+
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def split_shards(
+        cities_urls: dict[str, str], shard_size: int
+) -> list[dict[str, str]]:
+    """Города по shard_size в исходном порядке"""
+    if shard_size < 1:
+        raise ValueError(f'Shard size must be positive: {shard_size}')
+    cities = iter(cities_urls.items())
+    return list(iter(lambda: dict(islice(cities, shard_size)), {}))
+
+
+class Coordinator:
+    """
+    Координатор кластера: делит города на шарды, раздаёт их узлам
+    и собирает результаты в порядке городов для ранжирования
+    и записи результатов. Без ключа кластера создаётся случайный
+    ключ, и координатор можно запустить только на адресе loopback
+    """
+
+    def __init__(
+            self,
+            cities_urls: dict[str, str],
+            address: tuple[str, int] = (CLUSTER_HOST, CLUSTER_PORT),
+            authkey: bytes | None = None,
+            shard_size: int = CLUSTER_SHARD_SIZE,
+            analytics: Sequence[str] = (),
+            lease_timeout: float = CLUSTER_LEASE_TIMEOUT,
+            max_attempts: int = CLUSTER_MAX_ATTEMPTS,
+    ) -> None:
+        authkey = authkey or cluster_authkey()
+        self.generated_key = None
+        if authkey is None:
+            # Узел, знающий ключ, может выполнить код на координаторе
+            if not is_loopback(address[0]):
+                raise ValueError(
+                    f'Coordinator on {address[0]} requires a cluster key'
+                )
+            self.generated_key = secrets.token_hex(CLUSTER_AUTHKEY_BYTES)
+            authkey = self.generated_key.encode()
+        self.shards = split_shards(cities_urls, shard_size)
+        self.analytics = normalize_specs(analytics)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.manager = ClusterManager(address, authkey)
+        self.board = None
+        self.stats: dict[str, int] = {}
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.manager.address
+
+    def start(self) -> 'Coordinator':
+        self.manager.start()
+        self.board = self.manager.board()
+        self.board.load(
+            self.shards, self.analytics, self.lease_timeout, self.max_attempts
+        )
+        logging.info(
+            f'Coordinator listening on {self.address}, '
+            f'{len(self.shards)} shards'
+        )
+        if self.generated_key is not None:
+            print(f'Ключ кластера для узлов: {self.generated_key}')
+        return self
+
+    def stop(self) -> None:
+        self.board = None
+        self.manager.shutdown()
+
+    def __enter__(self) -> 'Coordinator':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def wait(self, timeout: float | None = None) -> list[CityForecast]:
+        """Дождаться результатов всех шардов"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with metrics.span('cluster'):
+            while True:
+                done, total = self.board.poll()
+                if done == total:
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f'{done} of {total} shards completed')
+                time.sleep(CLUSTER_POLL_INTERVAL)
+        results, self.stats = self.board.collect()
+        for result, count in self.stats.items():
+            metrics.inc('shards_total', count, result=result)
+        logging.info(f'Cluster shards: {self.stats}')
+        return self.merge(results)
+
+    def merge(self, results: list) -> list[CityForecast]:
+        """
+        Результаты шардов в порядке городов. Города шарда, который
+        не удалось рассчитать, остаются без данных
+        """
+        forecasts = []
+        for shard, result in zip(self.shards, results):
+            if result is None:
+                result = [
+                    CityForecast(CITIES_DESCRIPTION_MAP.get(city, city))
+                    for city in shard
+                ]
+            forecasts.extend(result)
+        return forecasts
+
+    def run(self, timeout: float | None = None) -> list[CityForecast]:
+        with self:
+            return self.wait(timeout)
+
+
+class ClusterWorker:
+    """
+    Узел кластера: забирает шарды у координатора, получает и
+    рассчитывает данные городов локально и возвращает результаты.
+    Набор показателей задаёт координатор. Ключ кластера обязателен
+    """
+
+    def __init__(
+            self,
+            address: tuple[str, int] = (CLUSTER_HOST, CLUSTER_PORT),
+            authkey: bytes | None = None,
+            fetch_mode: str = FETCH_MODE_THREADS,
+            cache: ResponseCache | None = None,
+            engine: str = CALCULATION_ENGINE_POOL,
+            executor: str = EXECUTOR_AUTO,
+            heartbeat_interval: float = CLUSTER_HEARTBEAT_INTERVAL,
+    ) -> None:
+        self.address = address
+        self.authkey = authkey or cluster_authkey()
+        if self.authkey is None:
+            raise ValueError(
+                f'Cluster key is not set, use {CLUSTER_AUTHKEY_ENV}'
+            )
+        self.fetch_mode = fetch_mode
+        self.cache = cache
+        self.engine = engine
+        self.executor = executor
+        self.heartbeat_interval = heartbeat_interval
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+
+    def process_shard(
+            self, cities_urls: dict[str, str], analytics: tuple[str, ...]
+    ) -> list[CityForecast]:
+        forecasts = DataAggregationTask(
+            cities_urls,
+            self.fetch_mode,
+            self.cache,
+            engine=self.engine,
+            executor=self.executor,
+            analytics=analytics,
+        ).aggregate_data()
+        return forecasts or [
+            CityForecast(CITIES_DESCRIPTION_MAP.get(city, city))
+            for city in cities_urls
+        ]
+
+    def run(self) -> int:
+        """Обрабатывать шарды, пока они есть; возвращает их число"""
+        manager = ClusterManager(self.address, self.authkey)
+        manager.connect()
+        board = manager.board()
+        stopped = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(board, stopped), daemon=True
+        )
+        heartbeat.start()
+        processed = 0
+        try:
+            while True:
+                status, shard, cities_urls, analytics = board.take(
+                    self.name
+                )
+                if status == SHARD_DONE:
+                    break
+                if status == SHARD_WAIT:
+                    time.sleep(CLUSTER_POLL_INTERVAL)
+                    continue
+                logging.info(f'Processing shard {shard} on {self.name}')
+                try:
+                    forecasts = self.process_shard(cities_urls, analytics)
+                except Exception as ex:
+                    board.fail(self.name, shard, repr(ex))
+                    continue
+                board.complete(self.name, shard, forecasts)
+                processed += 1
+        except (EOFError, OSError) as ex:
+            logging.warning(f'Coordinator connection lost: {ex!r}')
+        finally:
+            stopped.set()
+        return processed
+
+    def _heartbeat(self, board, stopped: threading.Event) -> None:
+        while not stopped.wait(self.heartbeat_interval):
+            try:
+                board.heartbeat(self.name)
+            except (EOFError, OSError):
+                return
@@ -0,0 +1,183 @@
+import gzip
+import http.client
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+from utils import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_POOL_IDLE_TIMEOUT,
+    HTTP_POOL_SIZE,
+    HTTP_READ_TIMEOUT,
+)
+
+
+class PooledResponse(NamedTuple):
+    status: int
+    reason: str
+    headers: dict[str, str]
+    body: bytes
+
+
+class ConnectionPool:
+    """
+    Keep-alive http.client connections shared between calls and threads.
+    Connecting and waiting for data have separate timeouts
+    """
+
+    _stale_errors = (
+        http.client.RemoteDisconnected,
+        http.client.BadStatusLine,
+        ConnectionResetError,
+        BrokenPipeError,
+    )
+
+    def __init__(
+            self,
+            maxsize: int = HTTP_POOL_SIZE,
+            idle_timeout: float = HTTP_POOL_IDLE_TIMEOUT,
+            connect_timeout: float | None = HTTP_CONNECT_TIMEOUT,
+            read_timeout: float | None = HTTP_READ_TIMEOUT,
+    ) -> None:
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle: defaultdict[
+            tuple[str, str], deque[tuple[http.client.HTTPConnection, float]]
+        ] = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def request(
+            self, url: str, headers: dict[str, str] | None = None
+    ) -> PooledResponse:
+        """GET the url, reusing an idle connection to the host if possible"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path or '/'
+        if parts.query:
+            target = f'{target}?{parts.query}'
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers or {})
+
+        conn, reused = self._get_conn(key)
+        try:
+            self._connect(conn)
+            resp, will_close = self._send(conn, target, request_headers)
+        except self._stale_errors:
+            conn.close()
+            if not reused:
+                raise
+            conn = self._new_conn(key)
+            resp, will_close = self._retry(conn, target, request_headers)
+        except Exception:
+            conn.close()
+            raise
+
+        if will_close:
+            conn.close()
+        else:
+            self._put_conn(key, conn)
+        return resp
+
+    def _retry(
+            self,
+            conn: http.client.HTTPConnection,
+            target: str,
+            headers: dict[str, str],
+    ) -> tuple[PooledResponse, bool]:
+        """Repeat the request on a fresh connection after a stale one"""
+        try:
+            self._connect(conn)
+            return self._send(conn, target, headers)
+        except Exception:
+            conn.close()
+            raise
+
+    def _connect(self, conn: http.client.HTTPConnection) -> None:
+        """Open the connection if needed and switch to the read timeout"""
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+
+    @staticmethod
+    def _send(
+            conn: http.client.HTTPConnection,
+            target: str,
+            headers: dict[str, str],
+    ) -> tuple[PooledResponse, bool]:
+        conn.request('GET', target, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        resp_headers = {
+            name.lower(): value for name, value in resp.getheaders()
+        }
+        if resp_headers.get('content-encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return (
+            PooledResponse(resp.status, resp.reason, resp_headers, body),
+            resp.will_close,
+        )
+
+    def _get_conn(
+            self, key: tuple[str, str]
+    ) -> tuple[http.client.HTTPConnection, bool]:
+        """Take the most recently used live connection or open a new one"""
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_conn(key), False
+
+    def _put_conn(
+            self, key: tuple[str, str], conn: http.client.HTTPConnection
+    ) -> None:
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _new_conn(self, key: tuple[str, str]) -> http.client.HTTPConnection:
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(
+                netloc, timeout=self.connect_timeout
+            )
+        return http.client.HTTPConnection(
+            netloc, timeout=self.connect_timeout
+        )
+
+    def idle_count(self, url: str) -> int:
+        """Number of idle connections kept for the host of url"""
+        parts = urlsplit(url)
+        with self._lock:
+            return len(self._idle[(parts.scheme, parts.netloc)])
+
+    def close(self) -> None:
+        """Close every idle connection"""
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop()[0].close()
+            self._idle.clear()
+
+    def forget(self) -> None:
+        """
+        Drop idle connections without closing them: after fork their
+        sockets are still used by the parent process
+        """
+        self._lock = threading.Lock()
+        self._idle.clear()
+
+
+default_pool = ConnectionPool()
+os.register_at_fork(after_in_child=default_pool.forget)
@@ -3,6 +3,16 @@ class YandexAPIException(Exception):
     pass
 
 
+class TransientAPIException(YandexAPIException):
+    """Raised when a weather request failed but may succeed if repeated"""
+    pass
+
+
+class CircuitOpenException(YandexAPIException):
+    """Raised when requests to a host are suspended after repeated failures"""
+    pass
+
+
 class RequirementsException(Exception):
     """Raised when the system does not meet the requirements"""
     pass
@@ -0,0 +1,287 @@
+import atexit
+import os
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, wait,
+)
+from multiprocessing import Pool
+from multiprocessing.pool import Pool as ProcessPool
+from typing import Callable, Iterable, Iterator
+
+from metrics import metrics
+from profiling import profiler
+from utils import (
+    CALCULATION_PROCESSES,
+    EXECUTOR_AUTO,
+    EXECUTOR_INLINE,
+    EXECUTOR_INLINE_MAX_ITEMS,
+    EXECUTOR_PROCESS,
+    EXECUTOR_THREAD,
+    FETCH_THREADS,
+)
+
+
+class Executor:
+    """
+    Способ выполнения задач. Пулы создаются при первом обращении
+    и переиспользуются до вызова close
+    """
+    name = ''
+
+    def __init__(self, workers: int = 1) -> None:
+        self.workers = workers
+
+    def map(self, func: Callable, items: Iterable) -> list:
+        """Результаты в порядке аргументов"""
+        raise NotImplementedError
+
+    def imap(self, func: Callable, items: Iterable) -> Iterator:
+        """Результаты в порядке аргументов, по мере готовности"""
+        raise NotImplementedError
+
+    def imap_unordered(
+            self,
+            func: Callable,
+            items: Iterable,
+            max_pending: int | None = None,
+    ) -> Iterator:
+        """
+        Результаты в порядке готовности, аргументы читаются лениво.
+        max_pending - сколько аргументов источник может отдать, пока
+        не получены результаты предыдущих
+        """
+        raise NotImplementedError
+
+    def submit(self, func: Callable, *args) -> Future:
+        raise NotImplementedError
+
+    def close(self, wait: bool = False) -> None:
+        """
+        Остановить пул, если он был создан. С wait процессы пула
+        завершаются сами, выполнив уже полученные задачи
+        """
+
+    def chunksize(self, items: Iterable) -> int:
+        """Размер порции задач, как в Pool.map"""
+        if not hasattr(items, '__len__'):
+            return 1
+        chunksize, extra = divmod(len(items), self.workers * 4)
+        return chunksize + 1 if extra else max(chunksize, 1)
+
+
+class InlineExecutor(Executor):
+    """Выполнение в текущем потоке, без накладных расходов пула"""
+    name = EXECUTOR_INLINE
+
+    def map(self, func: Callable, items: Iterable) -> list:
+        return list(map(func, items))
+
+    def imap(self, func: Callable, items: Iterable) -> Iterator:
+        return map(func, items)
+
+    def imap_unordered(
+            self,
+            func: Callable,
+            items: Iterable,
+            max_pending: int | None = None,
+    ) -> Iterator:
+        return map(func, items)
+
+    def submit(self, func: Callable, *args) -> Future:
+        future: Future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+
+class ThreadExecutor(Executor):
+    """Пул потоков для задач, ожидающих ввода-вывода"""
+    name = EXECUTOR_THREAD
+
+    def __init__(self, workers: int = FETCH_THREADS) -> None:
+        super().__init__(workers)
+        self._pool: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers)
+            return self._pool
+
+    def map(self, func: Callable, items: Iterable) -> list:
+        return list(self.imap(func, items))
+
+    def imap(self, func: Callable, items: Iterable) -> Iterator:
+        return self.pool.map(profiler.wrap(func), items)
+
+    def imap_unordered(
+            self,
+            func: Callable,
+            items: Iterable,
+            max_pending: int | None = None,
+    ) -> Iterator:
+        func = profiler.wrap(func)
+        # Аргументы читаются в потоке получателя результатов: задач
+        # в работе не больше, чем потоков и чем отдаст источник
+        # аргументов без получения результатов
+        limit = min(self.workers, max_pending or self.workers)
+        pending: set[Future] = set()
+        for item in items:
+            pending.add(self.pool.submit(func, item))
+            if len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    def submit(self, func: Callable, *args) -> Future:
+        return self.pool.submit(profiler.wrap(func), *args)
+
+    def close(self, wait: bool = False) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+class ProcessExecutor(Executor):
+    """
+    Пул процессов для расчётов. Метрики процессов пула передаются
+    вместе с результатами
+    """
+    name = EXECUTOR_PROCESS
+
+    def __init__(self, workers: int = CALCULATION_PROCESSES) -> None:
+        super().__init__(workers)
+        self._pool: ProcessPool | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ProcessPool:
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(processes=self.workers)
+            return self._pool
+
+    def map(self, func: Callable, items: Iterable) -> list:
+        items = list(items)
+        chunksize = self.chunksize(items)
+        func, items = metrics.worker_task(*profiler.worker_task(func, items))
+        return list(profiler.collect(metrics.collect(
+            self.pool.map(func, items, chunksize)
+        )))
+
+    def imap(self, func: Callable, items: Iterable) -> Iterator:
+        items = list(items)
+        chunksize = self.chunksize(items)
+        func, items = metrics.worker_task(*profiler.worker_task(func, items))
+        return profiler.collect(metrics.collect(
+            self.pool.imap(func, items, chunksize)
+        ))
+
+    def imap_unordered(
+            self,
+            func: Callable,
+            items: Iterable,
+            max_pending: int | None = None,
+    ) -> Iterator:
+        # Аргументы читает поток пула, max_pending ему не мешает
+        return profiler.collect(metrics.collect(self.pool.imap_unordered(
+            *metrics.worker_task(*profiler.worker_task(func, items))
+        )))
+
+    def submit(self, func: Callable, *args) -> Future:
+        future: Future = Future()
+        self.pool.apply_async(
+            func, args,
+            callback=future.set_result,
+            error_callback=future.set_exception,
+        )
+        return future
+
+    def close(self, wait: bool = False) -> None:
+        with self._lock:
+            if self._pool is not None:
+                if wait:
+                    self._pool.close()
+                else:
+                    self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+
+EXECUTOR_CLASSES: dict[str, type[Executor]] = {
+    EXECUTOR_INLINE: InlineExecutor,
+    EXECUTOR_THREAD: ThreadExecutor,
+    EXECUTOR_PROCESS: ProcessExecutor,
+}
+_executors: dict[tuple[str, str], Executor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(
+        kind: str, name: str = 'calculation', workers: int | None = None
+) -> Executor:
+    """
+    Общий для всех запусков исполнитель заданного типа. У получения
+    данных и расчётов разные пулы: потоки получения данных могут
+    ждать места в очереди, которую освобождает расчёт
+    """
+    with _executors_lock:
+        if (name, kind) not in _executors:
+            executor_class = EXECUTOR_CLASSES[kind]
+            _executors[name, kind] = (
+                executor_class() if workers is None
+                else executor_class(workers)
+            )
+        return _executors[name, kind]
+
+
+def choose_executor(
+        kind: str,
+        items_count: int | None,
+        inline_max_items: int = EXECUTOR_INLINE_MAX_ITEMS,
+) -> Executor:
+    """
+    Исполнитель расчётов для items_count задач. В режиме auto
+    небольшие наборы выполняются в текущем потоке, остальные - в пуле
+    процессов. Если размер неизвестен (потоковая обработка),
+    выбирается пул процессов. На одном ядре пул только добавляет
+    пересылку данных, поэтому расчёт всегда идёт в текущем потоке
+    """
+    if kind == EXECUTOR_AUTO:
+        small = items_count is not None and items_count <= inline_max_items
+        if small or CALCULATION_PROCESSES == 1:
+            kind = EXECUTOR_INLINE
+        else:
+            kind = EXECUTOR_PROCESS
+    return get_executor(kind, workers=CALCULATION_PROCESSES)
+
+
+@atexit.register
+def shutdown_executors(wait: bool = False) -> None:
+    """Остановить все созданные пулы"""
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.close(wait)
+        _executors.clear()
+
+
+def forget_executors() -> None:
+    """
+    Пулы, унаследованные через fork, в дочернем процессе не работают:
+    их потоки и процессы остались в родителе
+    """
+    global _executors_lock
+    _executors_lock = threading.Lock()
+    _executors.clear()
+
+
+os.register_at_fork(after_in_child=forget_executors)
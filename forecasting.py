@@ -1,35 +1,431 @@
+import argparse
 import logging
 import time
+from contextlib import nullcontext
 import pathlib
+from typing import Sequence
 
+from analytics import METRICS, normalize_specs
+from cache import ResponseCache
+from checkpoint import CheckpointJournal
+from cluster import ClusterWorker, Coordinator, cluster_authkey, is_loopback
+from executors import shutdown_executors
+from history import HistoryStore
+from metrics import metrics
+from profiling import profiler
+from ranking import RatingEngine
+from resilience import RetryPolicy, default_resilience
+from service import ForecastService, serve
+from sources import InputSource, get_source
+from writers import WRITERS, ResultWriter, date_range
 from tasks import (
     DataAggregationTask,
     DataAnalyzingTask,
 )
-from utils import CITIES, CSV_FILE_RELATIVE_PATH
+from utils import (
+    CITIES, FETCH_MODES, FETCH_MODE_ASYNC, FETCH_MODE_THREADS,
+    RESPONSE_CACHE_DIR, CALCULATION_ENGINES, CALCULATION_ENGINE_POOL,
+    OUTPUT_FORMAT_CSV, OUTPUT_FILE_RELATIVE_PATHS, FORECAST_DAYS,
+    METRICS_FORMATS, METRICS_FORMAT_JSON, EXECUTORS, EXECUTOR_AUTO,
+    SERVICE_HOST, SERVICE_PORT, SERVICE_REFRESH_INTERVAL, RETRY_ATTEMPTS,
+    ANALYTICS_WINDOWS, HISTORY_DB_PATH, PROFILE_DIR,
+    CLUSTER_HOST, CLUSTER_PORT, CLUSTER_AUTHKEY_ENV, CLUSTER_SHARD_SIZE,
+    CHECKPOINT_PATH,
+)
 
 
-def forecast_weather():
+def forecast_weather(
+        fetch_mode: str = FETCH_MODE_THREADS,
+        cache_dir: str | None = None,
+        pipeline: bool = False,
+        engine: str = CALCULATION_ENGINE_POOL,
+        output_format: str = OUTPUT_FORMAT_CSV,
+        start_date: str | None = None,
+        days: int = FORECAST_DAYS,
+        metrics_file: str | None = None,
+        metrics_format: str = METRICS_FORMAT_JSON,
+        executor: str = EXECUTOR_AUTO,
+        analytics: Sequence[str] = (),
+        history_path: str | None = None,
+        profile_dir: str | None = None,
+        profile_memory: bool = False,
+        batch_size: int | None = None,
+        coordinator: Coordinator | None = None,
+        journal: CheckpointJournal | None = None,
+        source: InputSource | None = None,
+):
     """
-    Анализ погодных условий по городам
+    Анализ погодных условий по городам. Если задан metrics_file,
+    в него записываются метрики и длительности этапов. Показатели
+    analytics рассчитываются вместе с основными и попадают в результаты.
+    Если задан history_path, результаты добавляются в историю запусков.
+    Если задан profile_dir, в него записываются профили этапов.
+    С batch_size города обрабатываются и записываются пакетами,
+    без хранения всех результатов в памяти. С coordinator города
+    получают и рассчитывают узлы кластера, а здесь составляются
+    рейтинг и файл результатов; pipeline и batch_size тогда
+    не используются. Без coordinator полученные и рассчитанные города
+    записываются в journal, а записанные в нём ранее пропускаются;
+    узлы кластера журнал не ведут. С source без coordinator и journal
+    вместо запросов к API читаются сохранённые ответы
     """
     logging.info('Start of weather analysis')
+    if metrics_file:
+        metrics.enable()
+    if profile_dir:
+        profiler.enable(profile_dir, profile_memory)
     start = time.time()
-    data = DataAggregationTask(CITIES).aggregate_data()
-    best_weather_cities = DataAnalyzingTask(data).analyze_data()
+    pipeline = pipeline and coordinator is None
+    batch_size = batch_size if coordinator is None else None
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    rating = RatingEngine() if pipeline or batch_size else None
+    output_path = OUTPUT_FILE_RELATIVE_PATHS[output_format]
+    analytics = normalize_specs(analytics)
+    writer = None
+    if start_date:
+        writer = WRITERS[output_format](
+            output_path, date_range(start_date, days), analytics
+        )
+    cities_urls = CITIES if source is None else source.index
+    aggregation_task = DataAggregationTask(
+        cities_urls, fetch_mode, cache, pipeline, engine, rating,
+        stream_writer(writer, pipeline), executor, analytics, batch_size,
+        journal, source,
+    )
+    data = None
+    if batch_size:
+        best_weather_cities = DataAnalyzingTask(
+            [], rating, writer
+        ).analyze_batches(
+            aggregation_task.iter_batches(),
+            lambda dates: WRITERS[output_format](
+                output_path, dates, analytics
+            ),
+        )
+        if history_path:
+            logging.warning('History is not saved in batched mode')
+    else:
+        data = collect_data(aggregation_task, coordinator)
+        if writer is None and data and output_format != OUTPUT_FORMAT_CSV:
+            writer = WRITERS[output_format](
+                output_path, DataAnalyzingTask(data).get_dates(), analytics
+            )
+        best_weather_cities = DataAnalyzingTask(
+            data, rating, writer
+        ).analyze_data()
+    if history_path and data:
+        with HistoryStore(history_path) as history:
+            run = history.save_run(data, start)
+        logging.info(f'Run {run} saved to history {history_path}')
     delta = time.time() - start
     logging.info(f'Analysis completed. Execution time - {delta:.2f}s')
+    if metrics_file:
+        metrics.export(metrics_file, metrics_format)
+    if profile_dir:
+        shutdown_executors(wait=True)
+        profiler.report(profiler.save())
     print(
         'Анализ погодных условий окончен. '
         'Наиболее благоприятные для поездки города: '
         f'{", ".join(best_weather_cities)}.'
     )
     print(
-        'CSV-файл с анализом создан по адресу: '
-        f'{pathlib.Path().resolve().joinpath(CSV_FILE_RELATIVE_PATH)}'
+        'Файл с анализом создан по адресу: '
+        f'{pathlib.Path().resolve().joinpath(output_path)}'
+    )
+
+
+def collect_data(
+        aggregation_task: DataAggregationTask,
+        coordinator: Coordinator | None,
+) -> list | None:
+    """Данные городов от узлов кластера или рассчитанные в этом процессе"""
+    if coordinator is not None:
+        if aggregation_task.journal is not None:
+            logging.warning('Checkpoint journal is not kept in cluster mode')
+        return coordinator.run()
+    return aggregation_task.aggregate_data()
+
+
+def stream_writer(
+        writer: ResultWriter | None, pipeline: bool
+) -> ResultWriter | None:
+    """
+    Открыть файл результатов для записи городов по мере готовности.
+    В CSV рейтинг пишется в строке города, поэтому CSV записывается
+    после расчёта рейтинга
+    """
+    if writer is None or not pipeline or not writer.supports_late_rating:
+        return None
+    writer.open()
+    return writer
+
+
+def analytics_spec(spec: str) -> str:
+    """Проверка записи показателя для argparse"""
+    try:
+        return normalize_specs([spec])[0]
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def cluster_address(address: str) -> tuple[str, int]:
+    """Адрес HOST:PORT координатора для argparse"""
+    host, _, port = address.rpartition(':')
+    try:
+        return host or CLUSTER_HOST, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid address {address}')
+
+
+def positive_int(value: str) -> int:
+    """Целое число больше нуля для argparse"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'Expected a positive integer: {value}')
+    return number
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Анализ погодных условий')
+    parser.add_argument(
+        '--fetch-mode', choices=FETCH_MODES, default=FETCH_MODE_THREADS,
+        help='способ получения данных: пул потоков или asyncio',
+    )
+    parser.add_argument(
+        '--cache-dir', default=RESPONSE_CACHE_DIR,
+        help='каталог для кэша ответов API',
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='не использовать кэш ответов API',
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='обрабатывать данные города сразу после получения',
+    )
+    parser.add_argument(
+        '--engine', choices=CALCULATION_ENGINES,
+        default=CALCULATION_ENGINE_POOL,
+        help='вычисления в пуле процессов или векторно через numpy',
+    )
+    parser.add_argument(
+        '--output-format', choices=tuple(WRITERS), default=OUTPUT_FORMAT_CSV,
+        help='формат файла с результатами',
+    )
+    parser.add_argument(
+        '--start-date',
+        help='первый день таблицы (YYYY-MM-DD); без него даты берутся '
+             'из полученных данных',
+    )
+    parser.add_argument(
+        '--days', type=int, default=FORECAST_DAYS,
+        help='число дней в таблице, начиная со --start-date',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='файл для метрик и длительностей этапов',
+    )
+    parser.add_argument(
+        '--metrics-format', choices=METRICS_FORMATS,
+        default=METRICS_FORMAT_JSON,
+        help='формат файла метрик: JSON или текстовый формат Prometheus',
+    )
+    parser.add_argument(
+        '--executor', choices=EXECUTORS, default=EXECUTOR_AUTO,
+        help='где выполнять расчёт по городам: auto выбирает по числу '
+             'городов между текущим потоком и пулом процессов',
+    )
+    parser.add_argument(
+        '--analytics', nargs='+', type=analytics_spec, default=(),
+        metavar='METRIC[@WINDOW]',
+        help='дополнительные показатели по дням, например humidity@evening. '
+             f'Показатели: {", ".join(METRICS)}; окна: '
+             f'{", ".join(ANALYTICS_WINDOWS)}',
+    )
+    parser.add_argument(
+        '--history', nargs='?', const=HISTORY_DB_PATH,
+        help='добавить результаты запуска в базу истории SQLite '
+             f'(по умолчанию {HISTORY_DB_PATH})',
+    )
+    parser.add_argument(
+        '--profile', nargs='?', const=PROFILE_DIR, metavar='DIR',
+        help='профилировать этапы, включая потоки и процессы пула; '
+             'профили записываются в DIR/<этап>.prof '
+             f'(по умолчанию {PROFILE_DIR})',
+    )
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help='вместе с --profile записать пики выделения памяти '
+             'по этапам (tracemalloc) в DIR/memory.json',
+    )
+    parser.add_argument(
+        '--batch-size', type=positive_int,
+        help='обрабатывать города пакетами такого размера: в памяти '
+             'хранятся ответы API только одного пакета, а от остальных '
+             'городов - только значения для рейтинга',
+    )
+    parser.add_argument(
+        '--replay', metavar='PATH',
+        help='считать сохранённые ответы API вместо запросов: каталог '
+             'с файлами <ГОРОД>.json или архив, собранный '
+             '"python sources.py КАТАЛОГ АРХИВ"',
+    )
+    parser.add_argument(
+        '--checkpoint', nargs='?', const=CHECKPOINT_PATH, metavar='PATH',
+        help='записывать полученные и рассчитанные города в журнал, '
+             'чтобы продолжить прерванный запуск с --resume; журнал '
+             'удаляется после успешного запуска '
+             f'(по умолчанию {CHECKPOINT_PATH})',
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='продолжить прерванный запуск: не запрашивать и не '
+             'рассчитывать города, которые есть в журнале --checkpoint',
+    )
+    parser.add_argument(
+        '--coordinator', nargs='?', type=cluster_address,
+        const=(CLUSTER_HOST, CLUSTER_PORT), metavar='HOST:PORT',
+        help='раздавать города узлам кластера, запущенным с --worker, '
+             'и собрать их результаты '
+             f'(по умолчанию {CLUSTER_HOST}:{CLUSTER_PORT})',
+    )
+    parser.add_argument(
+        '--worker', nargs='?', type=cluster_address,
+        const=(CLUSTER_HOST, CLUSTER_PORT), metavar='HOST:PORT',
+        help='работать узлом кластера: получать и рассчитывать города, '
+             'которые раздаёт координатор',
+    )
+    parser.add_argument(
+        '--shard-size', type=positive_int, default=CLUSTER_SHARD_SIZE,
+        help='число городов в шарде, который координатор отдаёт узлу',
+    )
+    parser.add_argument(
+        '--cluster-key',
+        help='общий ключ координатора и узлов кластера '
+             f'(по умолчанию из переменной {CLUSTER_AUTHKEY_ENV}). '
+             'Без ключа координатор создаёт случайный и выводит его',
+    )
+    parser.add_argument(
+        '--retries', type=int, default=RETRY_ATTEMPTS,
+        help='число попыток запроса при временных ошибках',
+    )
+    parser.add_argument(
+        '--hedge-percentile', type=float,
+        help='отправить дублирующий запрос, если ответа нет дольше '
+             'этого перцентиля времени ответа хоста',
+    )
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='работать как сервис: обновлять данные по расписанию '
+             'и отдавать таблицу и рейтинг по HTTP',
+    )
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument(
+        '--refresh-interval', type=float, default=SERVICE_REFRESH_INTERVAL,
+        help='период обновления данных сервиса, секунд',
     )
+    args = parser.parse_args()
+    if args.coordinator and (args.pipeline or args.batch_size):
+        parser.error(
+            '--coordinator cannot be combined with --pipeline or --batch-size'
+        )
+    if args.pipeline and args.fetch_mode == FETCH_MODE_ASYNC:
+        parser.error('--pipeline fetches data with threads only')
+    if (args.checkpoint or args.resume) and (
+            args.coordinator or args.worker or args.serve
+    ):
+        parser.error(
+            '--checkpoint and --resume cannot be combined with '
+            '--coordinator, --worker or --serve'
+        )
+    if args.replay and (
+            args.coordinator or args.worker or args.serve
+            or args.checkpoint or args.resume
+    ):
+        parser.error(
+            '--replay cannot be combined with --coordinator, --worker, '
+            '--serve, --checkpoint or --resume'
+        )
+    authkey = cluster_authkey(args.cluster_key)
+    if args.worker and authkey is None:
+        parser.error(
+            f'--worker requires --cluster-key or {CLUSTER_AUTHKEY_ENV}'
+        )
+    if args.coordinator and authkey is None and not is_loopback(
+            args.coordinator[0]
+    ):
+        parser.error(
+            '--coordinator on a non-loopback address requires --cluster-key '
+            f'or {CLUSTER_AUTHKEY_ENV}'
+        )
+    return args
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    forecast_weather()
+    args = parse_args()
+    default_resilience.retry = RetryPolicy(args.retries)
+    default_resilience.hedge_percentile = args.hedge_percentile
+    if args.worker:
+        ClusterWorker(
+            args.worker,
+            cluster_authkey(args.cluster_key),
+            args.fetch_mode,
+            None if args.no_cache else ResponseCache(args.cache_dir),
+            args.engine,
+            args.executor,
+        ).run()
+    elif args.serve:
+        metrics.enable()
+        serve(
+            ForecastService(
+                CITIES,
+                args.refresh_interval,
+                None if args.no_cache else ResponseCache(args.cache_dir),
+                args.fetch_mode,
+                args.engine,
+                args.executor,
+                args.analytics,
+                HistoryStore(args.history) if args.history else None,
+            ),
+            args.host,
+            args.port,
+        )
+    else:
+        checkpoint = args.checkpoint or (
+            CHECKPOINT_PATH if args.resume else None
+        )
+        with CheckpointJournal(
+                checkpoint, args.analytics, args.resume
+        ) if checkpoint else nullcontext() as journal:
+            forecast_weather(
+                args.fetch_mode,
+                None if args.no_cache else args.cache_dir,
+                args.pipeline,
+                args.engine,
+                args.output_format,
+                args.start_date,
+                args.days,
+                args.metrics_file,
+                args.metrics_format,
+                args.executor,
+                args.analytics,
+                args.history,
+                args.profile,
+                args.profile_memory,
+                args.batch_size,
+                Coordinator(
+                    CITIES,
+                    args.coordinator,
+                    cluster_authkey(args.cluster_key),
+                    args.shard_size,
+                    args.analytics,
+                ) if args.coordinator else None,
+                journal,
+                get_source(args.replay) if args.replay else None,
+            )
@@ -0,0 +1,225 @@
+import datetime
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, NamedTuple
+
+from metrics import metrics
+from models import CityForecast
+from utils import HISTORY_DB_PATH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    cities INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS days (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    city TEXT NOT NULL,
+    date TEXT NOT NULL,
+    temp INTEGER,
+    good_hours INTEGER
+);
+CREATE INDEX IF NOT EXISTS days_city_date ON days (city, date);
+CREATE TABLE IF NOT EXISTS ratings (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    city TEXT NOT NULL,
+    rating INTEGER,
+    average_temp INTEGER,
+    average_good_hours INTEGER
+);
+CREATE INDEX IF NOT EXISTS ratings_run_rating ON ratings (run, rating);
+CREATE INDEX IF NOT EXISTS ratings_city ON ratings (city);
+CREATE TABLE IF NOT EXISTS analytics (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    city TEXT NOT NULL,
+    date TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS analytics_city_metric_date
+    ON analytics (city, metric, date);
+"""
+
+
+class DayTrend(NamedTuple):
+    """Последний прогноз города на дату и запуск, в котором он получен"""
+    date: str
+    temp: int | None
+    good_hours: int | None
+    run: int
+    started_at: float
+
+
+class RunRating(NamedTuple):
+    run: int
+    started_at: float
+    city: str
+    rating: int | None
+
+
+def iso_date(date: str, run_date: datetime.date) -> str:
+    """
+    Дата YYYY-MM-DD для даты таблицы dd-mm. Год выбирается так,
+    чтобы дата была ближе всего к дате запуска
+    """
+    day, month = map(int, date.split('-'))
+    candidates = []
+    for year in (run_date.year - 1, run_date.year, run_date.year + 1):
+        try:
+            candidates.append(datetime.date(year, month, day))
+        except ValueError:
+            # 29 февраля в невисокосный год
+            continue
+    return min(
+        candidates, key=lambda candidate: abs(candidate - run_date)
+    ).isoformat()
+
+
+class HistoryStore:
+    """
+    История запусков в SQLite: результаты городов по дням, рейтинг
+    и дополнительные показатели. Запуск записывается одной транзакцией
+    """
+
+    def __init__(self, path: str = HISTORY_DB_PATH) -> None:
+        self.path = path
+        # Сервис записывает и читает историю из разных потоков
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def __enter__(self) -> 'HistoryStore':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def save_run(
+            self,
+            forecasts: Iterable[CityForecast],
+            started_at: float | None = None,
+    ) -> int:
+        """Записать результаты запуска, возвращает номер запуска"""
+        started_at = time.time() if started_at is None else started_at
+        run_date = datetime.date.fromtimestamp(started_at)
+        forecasts = [
+            forecast for forecast in forecasts if forecast.has_data
+        ]
+        with metrics.span('history'), self._lock, self._connection:
+            run = self._connection.execute(
+                'INSERT INTO runs (started_at, cities) VALUES (?, ?)',
+                (started_at, len(forecasts)),
+            ).lastrowid
+            self._connection.executemany(
+                'INSERT INTO days VALUES (?, ?, ?, ?, ?)',
+                (
+                    (run, forecast.city, iso_date(date, run_date), temp, hours)
+                    for forecast in forecasts
+                    for date, temp, hours in forecast.days()
+                ),
+            )
+            self._connection.executemany(
+                'INSERT INTO ratings VALUES (?, ?, ?, ?, ?)',
+                (
+                    (run, forecast.city, forecast.rating, *forecast.average)
+                    for forecast in forecasts
+                ),
+            )
+            self._connection.executemany(
+                'INSERT INTO analytics VALUES (?, ?, ?, ?, ?)',
+                self._analytics_rows(run, run_date, forecasts),
+            )
+        return run
+
+    @staticmethod
+    def _analytics_rows(
+            run: int, run_date: datetime.date, forecasts: list[CityForecast]
+    ) -> Iterator[tuple]:
+        for forecast in forecasts:
+            dates = [iso_date(date, run_date) for date in forecast.dates]
+            for spec, values in forecast.analytics.items():
+                for date, value in zip(dates, values):
+                    yield run, forecast.city, date, spec, value
+
+    def _query(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def runs(self, limit: int = 10) -> list[tuple[int, float, int]]:
+        """Последние запуски: номер, время начала, число городов"""
+        return self._query(
+            'SELECT id, started_at, cities FROM runs '
+            'ORDER BY id DESC LIMIT ?',
+            (limit,),
+        )
+
+    def city_trend(
+            self,
+            city: str,
+            date_from: str | None = None,
+            date_to: str | None = None,
+    ) -> list[DayTrend]:
+        """
+        Температура и часы без осадков города по датам (YYYY-MM-DD)
+        из последнего запуска, в котором была эта дата
+        """
+        rows = self._query(
+            'SELECT date, temp, good_hours, MAX(run), started_at '
+            'FROM days JOIN runs ON runs.id = days.run '
+            'WHERE city = ? AND date BETWEEN ? AND ? '
+            'GROUP BY date ORDER BY date',
+            (city, date_from or '', date_to or '9999'),
+        )
+        return [DayTrend(*row) for row in rows]
+
+    def city_forecasts(self, city: str, date: str) -> list[DayTrend]:
+        """Как менялся прогноз города на одну дату от запуска к запуску"""
+        rows = self._query(
+            'SELECT date, temp, good_hours, run, started_at '
+            'FROM days JOIN runs ON runs.id = days.run '
+            'WHERE city = ? AND date = ? ORDER BY run',
+            (city, date),
+        )
+        return [DayTrend(*row) for row in rows]
+
+    def metric_trend(
+            self, city: str, metric: str
+    ) -> list[tuple[str, float | None]]:
+        """Дополнительный показатель города по датам из последних запусков"""
+        return [
+            (date, value) for date, value, _ in self._query(
+                'SELECT date, value, MAX(run) FROM analytics '
+                'WHERE city = ? AND metric = ? GROUP BY date ORDER BY date',
+                (city, metric),
+            )
+        ]
+
+    def best_cities(self, limit: int = 10) -> list[RunRating]:
+        """Лучшие города последних limit запусков, от новых к старым"""
+        rows = self._query(
+            'SELECT run, started_at, city, rating '
+            'FROM ratings JOIN runs ON runs.id = ratings.run '
+            'WHERE run IN (SELECT id FROM runs ORDER BY id DESC LIMIT ?) '
+            'AND rating = 1 ORDER BY run DESC, city',
+            (limit,),
+        )
+        return [RunRating(*row) for row in rows]
+
+    def rating_history(self, city: str) -> list[RunRating]:
+        """Место города в рейтинге по запускам"""
+        rows = self._query(
+            'SELECT run, started_at, city, rating '
+            'FROM ratings JOIN runs ON runs.id = ratings.run '
+            'WHERE city = ? ORDER BY run',
+            (city,),
+        )
+        return [RunRating(*row) for row in rows]
@@ -0,0 +1,67 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from metrics import metrics
+from utils import CITY_MEMO_SIZE, DAY_MEMO_SIZE
+
+
+def content_hash(value) -> bytes:
+    """
+    Хэш содержимого из чисел, строк, None и кортежей. repr таких
+    значений зависит только от содержимого - не от того, один ли это
+    объект или равные копии (в отличие от marshal, который записывает
+    ссылки на уже встреченные объекты), и не от PYTHONHASHSEED,
+    поэтому хэш одинаков во всех процессах
+    """
+    return hashlib.blake2b(repr(value).encode(), digest_size=16).digest()
+
+
+class Memo:
+    """Результаты вычислений по ключу с вытеснением давно не нужных"""
+
+    def __init__(self, name: str, maxsize: int) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable):
+        """Сохранённый результат или None"""
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.inc(
+            'memo_requests_total',
+            memo=self.name,
+            result='miss' if value is None else 'hit',
+        )
+        return value
+
+    def put(self, key: Hashable, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+# Результаты по дням: (город, дата, хэш часов дня) -> (температура, часы)
+day_memo = Memo('day', DAY_MEMO_SIZE)
+# Результаты городов: (город, хэш данных всех дней) -> CityForecast
+city_memo = Memo('city', CITY_MEMO_SIZE)
@@ -0,0 +1,303 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterable, Iterator
+
+from profiling import profiler
+from utils import (
+    METRICS_FORMAT_JSON,
+    METRICS_FORMAT_PROMETHEUS,
+    METRICS_LATENCY_BUCKETS,
+    METRICS_PREFIX,
+)
+
+Labels = tuple[tuple[str, str], ...]
+MetricKey = tuple[str, Labels]
+
+_DISABLED_SPAN = nullcontext()
+
+
+def _key(name: str, labels: dict) -> MetricKey:
+    return name, tuple(
+        sorted((key, str(value)) for key, value in labels.items())
+    )
+
+
+class Histogram:
+    """Per-bucket (not cumulative) counts, sum and count of observations"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: dict) -> None:
+        for index, count in enumerate(other['counts']):
+            self.counts[index] += count
+        self.sum += other['sum']
+        self.count += other['count']
+
+    def to_dict(self) -> dict:
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics:
+    """
+    Counters, histograms and spans of one process.
+
+    Disabled by default: every recording method returns right away, so
+    instrumented code pays one attribute check. Pool workers record into
+    their own instance; ``worker_task`` ships the recorded values back
+    with each result and ``collect`` merges them into the parent.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        self._pid = os.getpid()
+        with self._lock:
+            self.counters: dict[MetricKey, float] = {}
+            self.histograms: dict[MetricKey, Histogram] = {}
+            self.spans: list[dict] = []
+
+    def start_worker(self) -> None:
+        """
+        Enable recording in a pool worker. A forked worker starts with
+        a copy of the parent's values, they are dropped on first use
+        """
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._local = threading.local()
+            self.reset()
+        self.enabled = True
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Increase a counter"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add an observation to a histogram"""
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def span(self, name: str, **labels):
+        """
+        Context manager timing a block: wall and process CPU time are
+        recorded as a span and added to the span_* counters. When the
+        profiler is enabled the block is also profiled as a stage
+        """
+        if profiler.enabled:
+            return self._profiled_span(name, labels)
+        if not self.enabled:
+            return _DISABLED_SPAN
+        return self._span(name, labels)
+
+    @contextmanager
+    def _profiled_span(self, name: str, labels: dict) -> Iterator[None]:
+        with profiler.stage(name):
+            with self._span(name, labels) if self.enabled else _DISABLED_SPAN:
+                yield
+
+    @contextmanager
+    def _span(self, name: str, labels: dict) -> Iterator[None]:
+        stack = self._local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        started_at = time.time()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            stack.pop()
+            with self._lock:
+                self.spans.append({
+                    'name': name,
+                    'parent': parent,
+                    'labels': dict(_key(name, labels)[1]),
+                    'started_at': started_at,
+                    'wall': wall,
+                    'cpu': cpu,
+                })
+            self.inc('span_calls_total', span=name, **labels)
+            self.inc('span_wall_seconds_total', wall, span=name, **labels)
+            self.inc('span_cpu_seconds_total', cpu, span=name, **labels)
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter"""
+        with self._lock:
+            return self.counters.get(_key(name, labels), 0)
+
+    def snapshot(self) -> dict:
+        """Picklable copy of everything recorded so far"""
+        with self._lock:
+            return {
+                'counters': [
+                    (name, labels, value)
+                    for (name, labels), value in self.counters.items()
+                ],
+                'histograms': [
+                    (name, labels, histogram.to_dict())
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+                'spans': list(self.spans),
+            }
+
+    def drain(self) -> dict:
+        """Snapshot and reset"""
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        """Add values recorded by another process"""
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                key = name, tuple(map(tuple, labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, data in snapshot['histograms']:
+                key = name, tuple(map(tuple, labels))
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(tuple(data['buckets']))
+                self.histograms[key].merge(data)
+            self.spans.extend(snapshot['spans'])
+
+    def worker_task(
+            self, func: Callable, items: Iterable
+    ) -> tuple[Callable, Iterable]:
+        """
+        Prepare a function and its arguments for Pool.map/imap. When
+        enabled the worker also reports queue time and its metrics
+        """
+        if not self.enabled:
+            return func, items
+        return _WorkerTask(func), ((time.time(), item) for item in items)
+
+    def collect(self, results: Iterable) -> Iterator:
+        """Results of worker_task, with worker metrics merged in"""
+        if not self.enabled:
+            yield from results
+            return
+        for result, snapshot in results:
+            self.merge(snapshot)
+            yield result
+
+    def to_dict(self) -> dict:
+        snapshot = self.snapshot()
+        return {
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for name, labels, value in snapshot['counters']
+            ],
+            'histograms': [
+                {'name': name, 'labels': dict(labels), **data}
+                for name, labels, data in snapshot['histograms']
+            ],
+            'spans': snapshot['spans'],
+        }
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for name, labels, value in sorted(snapshot['counters']):
+            name = f'{METRICS_PREFIX}_{name}'
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        for name, labels, data in sorted(
+                snapshot['histograms'], key=lambda item: item[:2]
+        ):
+            name = f'{METRICS_PREFIX}_{name}'
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            bounds = [*map(repr, data['buckets']), '+Inf']
+            for bound, count in zip(bounds, data['counts']):
+                cumulative += count
+                bucket_labels = _format_labels((*labels, ('le', bound)))
+                lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {data["sum"]}')
+            lines.append(
+                f'{name}_count{_format_labels(labels)} {data["count"]}'
+            )
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, format: str = METRICS_FORMAT_JSON) -> None:
+        """Write the metrics to a file as JSON or Prometheus text"""
+        with open(path, 'w', encoding='utf-8') as file:
+            if format == METRICS_FORMAT_PROMETHEUS:
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), file, ensure_ascii=False, indent=2)
+
+
+class _WorkerTask:
+    """Picklable wrapper returning a worker result with its metrics"""
+
+    def __init__(self, func: Callable) -> None:
+        self.func = func
+
+    def __call__(self, stamped_item: tuple[float, object]) -> tuple:
+        queued_at, item = stamped_item
+        metrics.start_worker()
+        metrics.observe('worker_queue_seconds', time.time() - queued_at)
+        start_cpu = time.process_time()
+        result = self.func(item)
+        metrics.inc('worker_cpu_seconds_total', time.process_time() - start_cpu)
+        return result, metrics.drain()
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            key, value.replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for key, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+metrics = Metrics()
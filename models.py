@@ -0,0 +1,126 @@
+import sys
+from array import array
+from typing import Iterable, Iterator, Mapping
+
+from utils import ANALYTICS_PRECISION
+
+AVERAGE_COLUMN = 'Среднее'
+RATING_COLUMN = 'Рейтинг'
+
+
+class CityForecast:
+    """
+    Результат расчёта для города: колонки по дням, средние значения
+    за период, место в рейтинге и дополнительные показатели по дням
+    """
+    __slots__ = (
+        'city', 'dates', 'temps', 'good_hours', 'average', 'rating',
+        'analytics',
+    )
+
+    def __init__(
+            self,
+            city: str,
+            dates: Iterable[str] = (),
+            temps: Iterable[int] = (),
+            good_hours: Iterable[int] = (),
+            average: tuple[int | None, int | None] | None = None,
+            rating: int | None = None,
+            analytics: Mapping[str, Iterable] | None = None,
+    ) -> None:
+        self.city = city
+        # Даты у всех городов одни и те же, хранится одна копия строки
+        self.dates = tuple(sys.intern(date) for date in dates)
+        self.temps = array('i', temps)
+        self.good_hours = array('i', good_hours)
+        self.average = average
+        self.rating = rating
+        # Показатель -> значения по дням, в порядке dates
+        self.analytics = {
+            spec: tuple(values) for spec, values in (analytics or {}).items()
+        }
+
+    @property
+    def has_data(self) -> bool:
+        """Были ли получены данные о погоде для города"""
+        return self.average is not None
+
+    @property
+    def is_rated(self) -> bool:
+        """Можно ли учитывать город в рейтинге"""
+        return self.average is not None and None not in self.average
+
+    def days(self) -> Iterator[tuple[str, int, int]]:
+        """Данные по дням: дата, средняя температура, часы без осадков"""
+        return zip(self.dates, self.temps, self.good_hours)
+
+    def analytics_average(self) -> dict[str, float | None]:
+        """Средние значения дополнительных показателей за период"""
+        averages = {}
+        for spec, values in self.analytics.items():
+            present = [value for value in values if value is not None]
+            averages[spec] = round(
+                sum(present) / len(present), ANALYTICS_PRECISION
+            ) if present else None
+        return averages
+
+    def copy(self) -> 'CityForecast':
+        return self.__class__(*self.__reduce__()[1])
+
+    def to_dict(self) -> dict:
+        """Представление в виде словаря {'city': ..., 'data': {...}}"""
+        data = {
+            date: (temp, good_hours)
+            for date, temp, good_hours in self.days()
+        }
+        if self.average is not None:
+            data[AVERAGE_COLUMN] = self.average
+        if self.rating is not None:
+            data[RATING_COLUMN] = self.rating
+        result = {'city': self.city, 'data': data}
+        if self.analytics:
+            averages = self.analytics_average()
+            result['analytics'] = {
+                spec: {
+                    **dict(zip(self.dates, values)),
+                    AVERAGE_COLUMN: averages[spec],
+                }
+                for spec, values in self.analytics.items()
+            }
+        return result
+
+    @classmethod
+    def from_dict(cls, forecast: dict) -> 'CityForecast':
+        """Обратное преобразование для to_dict"""
+        data = dict(forecast['data'])
+        average = data.pop(AVERAGE_COLUMN, None)
+        rating = data.pop(RATING_COLUMN, None)
+        return cls(
+            forecast['city'],
+            data.keys(),
+            (day[0] for day in data.values()),
+            (day[1] for day in data.values()),
+            average,
+            rating,
+            {
+                spec: [values.get(date) for date in data]
+                for spec, values in forecast.get('analytics', {}).items()
+            },
+        )
+
+    def __reduce__(self):
+        return self.__class__, (
+            self.city, self.dates, self.temps, self.good_hours,
+            self.average, self.rating, self.analytics,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CityForecast):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.to_dict()!r})'
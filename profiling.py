@@ -0,0 +1,326 @@
+import cProfile
+import glob
+import json
+import logging
+import os
+import pickle
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from multiprocessing.util import Finalize
+from typing import Callable, Iterable, Iterator
+
+from utils import PROFILE_TOP_FUNCTIONS
+
+_DISABLED_STAGE = nullcontext()
+
+
+class Profiler:
+    """
+    cProfile profiles of pipeline stages, merged into one pstats file
+    per stage from the parent process, its pool threads and pool
+    worker processes.
+
+    A thread runs one profile at a time, so a nested stage pauses the
+    enclosing one: each stage file holds the time spent in the stage
+    itself, without its nested stages. With ``trace_memory`` the peak
+    of traced allocations is recorded for every stage.
+    """
+
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self) -> None:
+        self.directory: str | None = None
+        self.trace_memory = False
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_stage: str | None = None
+        self._profiles: dict[str, list[cProfile.Profile]] = {}
+        self.memory_peaks: dict[str, int] = {}
+        # Profiles of a pool worker process, saved when it exits
+        self._worker_directory: str | None = None
+        self._worker_profiles: dict[str, cProfile.Profile] = {}
+        self._worker_peaks: dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def enable(self, directory: str, trace_memory: bool = False) -> None:
+        os.makedirs(directory, exist_ok=True)
+        # Files of workers from a previous run must not be merged again
+        for path in _worker_files(directory, '*'):
+            os.remove(path)
+        self.directory = directory
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self) -> None:
+        if self.trace_memory:
+            tracemalloc.stop()
+        self.directory = None
+        self.trace_memory = False
+        with self._lock:
+            self._profiles = {}
+            self.memory_peaks = {}
+
+    def stage(self, name: str):
+        """Context manager profiling a block as the stage name"""
+        if not self.enabled:
+            return _DISABLED_STAGE
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[None]:
+        stack = self._stack()
+        if stack:
+            stack[-1][1].disable()
+        self._record_peak(stack)
+        profile = cProfile.Profile()
+        stack.append((name, profile))
+        self._last_stage = name
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._record_peak(stack)
+            stack.pop()
+            self.add(name, profile)
+            if stack:
+                stack[-1][1].enable()
+
+    def _stack(self) -> list[tuple[str, cProfile.Profile]]:
+        return self._local.__dict__.setdefault('stack', [])
+
+    def _record_peak(self, stack: list) -> None:
+        """Add the allocation peak so far to all stages of the stack"""
+        if not self.trace_memory:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        with self._lock:
+            for name, _ in stack:
+                self.memory_peaks[name] = max(
+                    self.memory_peaks.get(name, 0), peak
+                )
+        tracemalloc.reset_peak()
+
+    def add(self, stage: str, profile: cProfile.Profile) -> None:
+        with self._lock:
+            self._profiles.setdefault(stage, []).append(profile)
+
+    def current_stage(self) -> str:
+        """
+        Stage of the calling thread; pool threads have no stages of their
+        own, their work belongs to the stage entered last
+        """
+        stack = self._stack()
+        return stack[-1][0] if stack else self._last_stage or 'unknown'
+
+    def wrap(self, func: Callable) -> Callable:
+        """Function for a pool thread, profiled as the current stage"""
+        if not self.enabled:
+            return func
+        return _ProfiledTask(func, self.current_stage(), self.directory)
+
+    def worker_task(
+            self, func: Callable, items: Iterable
+    ) -> tuple[Callable, Iterable]:
+        """
+        Prepare a function and its arguments for Pool.map/imap. Arguments
+        and results are pickled inside the profiled code, so transfer
+        costs show up in the stage profiles of both processes
+        """
+        if not self.enabled:
+            return func, items
+        task = _ProfiledTask(
+            func, self.current_stage(), self.directory,
+            self.trace_memory, pickled=True,
+        )
+        return task, (
+            pickle.dumps(item, pickle.HIGHEST_PROTOCOL) for item in items
+        )
+
+    def collect(self, results: Iterable) -> Iterator:
+        """Results of worker_task"""
+        if not self.enabled:
+            yield from results
+            return
+        for result in results:
+            yield pickle.loads(result)
+
+    def run_thread_task(self, task: '_ProfiledTask', args: tuple):
+        """
+        Run a task in a thread of this process with a profile of its own.
+        If the thread is already profiled, or the interpreter allows only
+        one profiler (Python 3.12+, where it covers all threads), the
+        enclosing profile records the task
+        """
+        if self._stack() or getattr(self._local, 'profiled', False):
+            return task.func(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return task.func(*args)
+        self._local.profiled = True
+        try:
+            return task.func(*args)
+        finally:
+            profile.disable()
+            self._local.profiled = False
+            self.add(task.stage, profile)
+
+    def run_worker_task(self, task: '_ProfiledTask', args: tuple):
+        """
+        Run a task in a pool worker process. The profile of the stage
+        accumulates all tasks of the process and is saved once, when the
+        worker exits
+        """
+        self.start_worker()
+        if self._worker_directory is None:
+            self._worker_directory = task.directory
+            Finalize(None, self._save_worker, exitpriority=0)
+        if task.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        profile = self._worker_profiles.get(task.stage)
+        if profile is None:
+            profile = self._worker_profiles[task.stage] = cProfile.Profile()
+        if task.trace_memory:
+            tracemalloc.reset_peak()
+        profile.enable()
+        try:
+            if task.pickled:
+                args = tuple(map(pickle.loads, args))
+            result = task.func(*args)
+            if task.pickled:
+                result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        finally:
+            profile.disable()
+        if task.trace_memory:
+            self._worker_peaks[task.stage] = max(
+                self._worker_peaks.get(task.stage, 0),
+                tracemalloc.get_traced_memory()[1],
+            )
+        return result
+
+    def _save_worker(self) -> None:
+        """Write the profiles and memory peaks of a pool worker process"""
+        for stage, profile in self._worker_profiles.items():
+            path = os.path.join(
+                self._worker_directory, f'{stage}.{os.getpid()}'
+            )
+            profile.dump_stats(path + '.prof')
+            if stage in self._worker_peaks:
+                with open(path + '.mem', 'w') as file:
+                    file.write(str(self._worker_peaks[stage]))
+
+    def start_worker(self) -> None:
+        """
+        Forget profiles inherited by a forked worker; the fork may happen
+        in the middle of a stage with its profile running
+        """
+        if self._pid == os.getpid():
+            return
+        for _, profile in self._stack():
+            profile.disable()
+        self._reset()
+
+    def save(self) -> dict[str, str]:
+        """
+        Merge the profiles of every stage into <directory>/<stage>.prof,
+        write memory peaks to memory.json. Returns stage -> file. Pool
+        workers write their profiles when they exit, so the pools must
+        be shut down with shutdown_executors(wait=True) first
+        """
+        with self._lock:
+            profiles = {
+                stage: list(stage_profiles)
+                for stage, stage_profiles in self._profiles.items()
+            }
+        worker_files: dict[str, list[str]] = {}
+        for path in _worker_files(self.directory, 'prof'):
+            stage = os.path.basename(path).split('.')[0]
+            worker_files.setdefault(stage, []).append(path)
+        paths = {}
+        for stage in sorted({*profiles, *worker_files}):
+            sources = [*profiles.get(stage, ()), *worker_files.get(stage, ())]
+            stats = pstats.Stats(sources[0])
+            for source in sources[1:]:
+                stats.add(source)
+            paths[stage] = os.path.join(self.directory, f'{stage}.prof')
+            stats.dump_stats(paths[stage])
+        if self.trace_memory:
+            self._save_memory()
+        return paths
+
+    def _save_memory(self) -> None:
+        memory = {
+            stage: {'peak_bytes': peak}
+            for stage, peak in self.memory_peaks.items()
+        }
+        for path in _worker_files(self.directory, 'mem'):
+            stage = os.path.basename(path).split('.')[0]
+            with open(path) as file:
+                peak = int(file.read())
+            stage_memory = memory.setdefault(stage, {})
+            stage_memory['worker_peak_bytes'] = max(
+                stage_memory.get('worker_peak_bytes', 0), peak
+            )
+        with open(os.path.join(self.directory, 'memory.json'), 'w') as file:
+            json.dump(memory, file, indent=2)
+
+    def report(
+            self, paths: dict[str, str], limit: int = PROFILE_TOP_FUNCTIONS
+    ) -> None:
+        """Log the functions with the largest own time of every stage"""
+        for stage, path in paths.items():
+            stats = pstats.Stats(path)
+            total = stats.total_tt
+            logging.info(f'Profile of stage {stage}: {total:.3f}s in {path}')
+            entries = sorted(
+                stats.stats.items(), key=lambda entry: entry[1][2],
+                reverse=True,
+            )
+            for (file, line, function), entry in entries[:limit]:
+                logging.info(
+                    f'  {entry[2]:8.3f}s own {entry[3]:8.3f}s cumulative '
+                    f'{entry[1]:>8} calls  {function} '
+                    f'({os.path.basename(file)}:{line})'
+                )
+
+
+class _ProfiledTask:
+    """Picklable wrapper running a pool task under the stage profile"""
+
+    def __init__(
+            self,
+            func: Callable,
+            stage: str,
+            directory: str,
+            trace_memory: bool = False,
+            pickled: bool = False,
+    ) -> None:
+        self.func = func
+        self.stage = stage
+        self.directory = directory
+        self.trace_memory = trace_memory
+        self.pickled = pickled
+        self.parent_pid = os.getpid()
+
+    def __call__(self, *args):
+        if os.getpid() == self.parent_pid:
+            return profiler.run_thread_task(self, args)
+        return profiler.run_worker_task(self, args)
+
+
+def _worker_files(directory: str, extension: str) -> list[str]:
+    """Files saved by worker processes: <stage>.<pid>.<extension>"""
+    return glob.glob(os.path.join(directory, f'*.*.{extension}'))
+
+
+profiler = Profiler()
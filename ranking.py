@@ -0,0 +1,124 @@
+import bisect
+import heapq
+from collections import OrderedDict
+
+from models import CityForecast
+from utils import RATING_TOP_K
+
+Score = tuple[int, int]
+
+
+class RatingEngine:
+    """
+    Рейтинг городов, пополняемый по мере поступления данных.
+    Лучшие top_k значений (средняя температура, часы без осадков)
+    хранятся в куче вместе со всеми городами с такими значениями,
+    полный рейтинг считается только по запросу. Значения города
+    можно обновить: пересчитывается только то, что изменилось
+    """
+
+    def __init__(self, top_k: int = RATING_TOP_K) -> None:
+        self.top_k = top_k
+        self._scores: dict[str, Score] = {}
+        self._heap: list[Score] = []
+        self._groups: dict[Score, list[str]] = {}
+        # Значения всех городов по возрастанию, для места одного города.
+        # Сортируются при первом запросе места после изменений
+        self._sorted_scores: list[Score] | None = []
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def add(self, city: str, average_temp: int, good_hours: int) -> None:
+        """Учесть средние значения города или обновить их"""
+        score = (average_temp, good_hours)
+        previous_score = self._scores.get(city)
+        if previous_score == score:
+            return
+        if previous_score is not None:
+            self.remove(city)
+        self._scores[city] = score
+        self._sorted_scores = None
+        if score in self._groups:
+            self._groups[score].append(city)
+        elif len(self._heap) < self.top_k:
+            heapq.heappush(self._heap, score)
+            self._groups[score] = [city]
+        elif score > self._heap[0]:
+            del self._groups[heapq.heapreplace(self._heap, score)]
+            self._groups[score] = [city]
+
+    def remove(self, city: str) -> None:
+        """Исключить город из рейтинга"""
+        score = self._scores.pop(city, None)
+        if score is None:
+            return
+        self._sorted_scores = None
+        group = self._groups.get(score)
+        if group is None:
+            return
+        group.remove(city)
+        if not group:
+            # Из лучших значений ушло одно, следующее ищется среди всех
+            del self._groups[score]
+            self._rebuild_top()
+
+    def _rebuild_top(self) -> None:
+        top_scores = heapq.nlargest(self.top_k, set(self._scores.values()))
+        self._heap = sorted(top_scores)
+        self._groups = {score: [] for score in top_scores}
+        for city, score in self._scores.items():
+            if score in self._groups:
+                self._groups[score].append(city)
+
+    def add_forecast(self, forecast: CityForecast) -> None:
+        """
+        Учесть город, если для него есть средние значения. Город,
+        для которого значений больше нет, исключается из рейтинга
+        """
+        if forecast.is_rated:
+            self.add(forecast.city, *forecast.average)
+        else:
+            self.remove(forecast.city)
+
+    def rank(self, city: str) -> int | None:
+        """Место города: число городов с лучшими значениями плюс один"""
+        score = self._scores.get(city)
+        if score is None:
+            return None
+        if self._sorted_scores is None:
+            self._sorted_scores = sorted(self._scores.values())
+        better = len(self._sorted_scores) - bisect.bisect_right(
+            self._sorted_scores, score
+        )
+        return better + 1
+
+    def top(self) -> list[tuple[Score, list[str]]]:
+        """Лучшие значения по убыванию и города с каждым из них"""
+        return [
+            (score, list(self._groups[score]))
+            for score in sorted(self._heap, reverse=True)
+        ]
+
+    def best(self) -> list[str]:
+        """Все города с наилучшими значениями"""
+        if not self._heap:
+            return []
+        return list(self._groups[max(self._heap)])
+
+    def ranks(self) -> OrderedDict[str, int]:
+        """
+        Полный рейтинг. Города с одинаковыми значениями делят место,
+        следующее место пропускается
+        """
+        sorted_cities = sorted(
+            self._scores.items(), key=lambda item: item[1], reverse=True
+        )
+        ranks: OrderedDict[str, int] = OrderedDict()
+        previous_score = None
+        for position, (city, score) in enumerate(sorted_cities, start=1):
+            if score != previous_score:
+                rank = position
+                previous_score = score
+            ranks[city] = rank
+        return ranks
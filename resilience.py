@@ -0,0 +1,262 @@
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Awaitable, Callable, Iterator
+from urllib.parse import urlsplit
+
+from exceptions import CircuitOpenException, TransientAPIException
+from executors import get_executor
+from metrics import metrics
+from utils import (
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RESET_TIMEOUT,
+    EXECUTOR_THREAD,
+    FETCH_THREADS,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_PERCENTILE,
+    LATENCY_WINDOW,
+    RETRY_ATTEMPTS,
+    RETRY_BACKOFF_BASE,
+    RETRY_BACKOFF_MAX,
+)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter between attempts
+    """
+
+    def __init__(
+            self,
+            attempts: int = RETRY_ATTEMPTS,
+            base: float = RETRY_BACKOFF_BASE,
+            max_delay: float = RETRY_BACKOFF_MAX,
+    ) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.max_delay = max_delay
+
+    def delays(self) -> Iterator[float]:
+        """Pauses before the second and following attempts"""
+        for attempt in range(self.attempts - 1):
+            yield random.uniform(
+                0, min(self.max_delay, self.base * 2 ** attempt)
+            )
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a host after failure_threshold consecutive
+    failures. After reset_timeout one trial request is let through:
+    success closes the circuit, failure opens it again
+    """
+
+    def __init__(
+            self,
+            failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial:
+                return False
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._trial:
+                    metrics.inc('circuit_opened_total')
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+class LatencyTracker:
+    """Recent successful response times of one host"""
+
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        self._samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(
+            self, percent: float, min_samples: int = HEDGE_MIN_SAMPLES
+    ) -> float | None:
+        """None until enough samples are collected"""
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+
+class Resilience:
+    """
+    Retries, per-host circuit breakers and hedged requests around one
+    request attempt. An attempt raises TransientAPIException for errors
+    worth repeating; any other exception is returned to the caller as is
+    """
+
+    def __init__(
+            self,
+            retry: RetryPolicy | None = None,
+            hedge_percentile: float | None = HEDGE_PERCENTILE,
+            failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+    ) -> None:
+        self.retry = retry or RetryPolicy()
+        self.hedge_percentile = hedge_percentile
+        self.breakers: defaultdict[str, CircuitBreaker] = defaultdict(
+            lambda: CircuitBreaker(failure_threshold, reset_timeout)
+        )
+        self.latencies: defaultdict[str, LatencyTracker] = defaultdict(
+            LatencyTracker
+        )
+
+    def hedge_delay(self, host: str) -> float | None:
+        """How long to wait for a response before sending a duplicate"""
+        if self.hedge_percentile is None:
+            return None
+        return self.latencies[host].percentile(self.hedge_percentile)
+
+    def call(self, url: str, attempt: Callable[[], object]):
+        host = urlsplit(url).netloc
+        breaker = self.breakers[host]
+        delays = self.retry.delays()
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenException(
+                    f'Requests to {host} are suspended after failures'
+                )
+            started = time.perf_counter()
+            try:
+                result = self._hedged(attempt, self.hedge_delay(host))
+            except TransientAPIException:
+                breaker.record_failure()
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                metrics.inc('fetch_retries_total', client='sync')
+                time.sleep(delay)
+                continue
+            except Exception:
+                # The host answered, the error is not about availability
+                breaker.record_success()
+                raise
+            breaker.record_success()
+            self.latencies[host].add(time.perf_counter() - started)
+            return result
+
+    @staticmethod
+    def _hedged(attempt: Callable[[], object], delay: float | None):
+        """
+        Run the attempt; if it is slower than delay, start a duplicate
+        and return whichever succeeds first
+        """
+        if delay is None:
+            return attempt()
+        pool = get_executor(EXECUTOR_THREAD, 'hedging', FETCH_THREADS)
+        pending: set[Future] = {pool.submit(attempt)}
+        done, _ = wait(pending, timeout=delay)
+        if not done:
+            metrics.inc('fetch_hedges_total', client='sync')
+            pending.add(pool.submit(attempt))
+        error: BaseException | None = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def call_async(
+            self, url: str, attempt: Callable[[], Awaitable]
+    ):
+        host = urlsplit(url).netloc
+        breaker = self.breakers[host]
+        delays = self.retry.delays()
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenException(
+                    f'Requests to {host} are suspended after failures'
+                )
+            started = time.perf_counter()
+            try:
+                result = await self._hedged_async(
+                    attempt, self.hedge_delay(host)
+                )
+            except TransientAPIException:
+                breaker.record_failure()
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                metrics.inc('fetch_retries_total', client='async')
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                # The host answered, the error is not about availability
+                breaker.record_success()
+                raise
+            breaker.record_success()
+            self.latencies[host].add(time.perf_counter() - started)
+            return result
+
+    @staticmethod
+    async def _hedged_async(
+            attempt: Callable[[], Awaitable], delay: float | None
+    ):
+        if delay is None:
+            return await attempt()
+        pending = {asyncio.ensure_future(attempt())}
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            metrics.inc('fetch_hedges_total', client='async')
+            pending.add(asyncio.ensure_future(attempt()))
+        error: BaseException | None = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error
+
+
+default_resilience = Resilience()
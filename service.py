@@ -0,0 +1,301 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Hashable, Iterable, NamedTuple, Sequence
+from urllib.parse import unquote
+
+from cache import ResponseCache
+from history import HistoryStore
+from metrics import metrics
+from models import CityForecast
+from ranking import RatingEngine
+from tasks import DataAggregationTask
+from utils import (
+    CALCULATION_ENGINE_POOL,
+    CITIES,
+    EXECUTOR_AUTO,
+    FETCH_MODE_THREADS,
+    SERVICE_HOST,
+    SERVICE_PORT,
+    SERVICE_REFRESH_INTERVAL,
+)
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одним ключом: функция
+    выполняется один раз, остальные вызовы ждут её результата
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, func: Callable):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(func())
+        except Exception as ex:
+            future.set_exception(ex)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+
+class Snapshot(NamedTuple):
+    """Последние рассчитанные данные городов и рейтинг"""
+    forecasts: dict[str, CityForecast]
+    ranks: dict[str, int]
+    best: list[str]
+    updated_at: dict[str, float]
+
+
+class ForecastService:
+    """
+    Держит в памяти последнюю таблицу и рейтинг, обновляя их
+    по расписанию. Пулы и кэш ответов живут всё время работы сервиса.
+    Если задана history, в неё записывается каждое полное обновление
+    """
+
+    def __init__(
+            self,
+            cities_urls: dict[str, str] = CITIES,
+            refresh_interval: float = SERVICE_REFRESH_INTERVAL,
+            cache: ResponseCache | None = None,
+            fetch_mode: str = FETCH_MODE_THREADS,
+            engine: str = CALCULATION_ENGINE_POOL,
+            executor: str = EXECUTOR_AUTO,
+            analytics: Sequence[str] = (),
+            history: HistoryStore | None = None,
+    ) -> None:
+        self.cities_urls = cities_urls
+        self.refresh_interval = refresh_interval
+        self.cache = cache
+        self.fetch_mode = fetch_mode
+        self.engine = engine
+        self.executor = executor
+        self.analytics = analytics
+        self.history = history
+        self.snapshot = Snapshot({}, {}, [], {})
+        self.rating = RatingEngine()
+        self.refreshes = 0
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._scheduler: threading.Thread | None = None
+
+    def refresh(self) -> Snapshot:
+        """Пересчитать все города. Одновременные вызовы объединяются"""
+        return self._flight.do('refresh', self._refresh)
+
+    def _refresh(self) -> Snapshot:
+        logging.info('Refreshing all cities')
+        forecasts = self.aggregate(self.cities_urls)
+        now = time.time()
+        with self._lock:
+            self.snapshot = self.rate(
+                forecasts, dict.fromkeys(forecasts, now), forecasts.values()
+            )
+            self.refreshes += 1
+            snapshot = self.snapshot
+        if self.history is not None:
+            self.history.save_run(snapshot.forecasts.values(), now)
+        return snapshot
+
+    def city(self, city: str) -> CityForecast:
+        """
+        Данные города. Если они старше интервала обновления, город
+        пересчитывается; одновременные запросы одного города объединяются
+        """
+        if city not in self.cities_urls:
+            raise KeyError(city)
+        snapshot = self.snapshot
+        if self.is_fresh(snapshot, city):
+            return snapshot.forecasts[city]
+        return self._flight.do(('city', city), lambda: self._refresh_city(city))
+
+    def _refresh_city(self, city: str) -> CityForecast:
+        forecast = self.aggregate({city: self.cities_urls[city]})[city]
+        with self._lock:
+            forecasts = {**self.snapshot.forecasts, city: forecast}
+            updated_at = {**self.snapshot.updated_at, city: time.time()}
+            self.snapshot = self.rate(forecasts, updated_at, [forecast])
+        return self.snapshot.forecasts[city]
+
+    def is_fresh(self, snapshot: Snapshot, city: str) -> bool:
+        updated_at = snapshot.updated_at.get(city)
+        return (
+            updated_at is not None
+            and time.time() - updated_at < self.refresh_interval
+        )
+
+    def aggregate(self, cities_urls: dict[str, str]) -> dict:
+        """Получить и обработать данные городов, ключи - как в cities_urls"""
+        forecasts = DataAggregationTask(
+            cities_urls,
+            self.fetch_mode,
+            self.cache,
+            engine=self.engine,
+            executor=self.executor,
+            analytics=self.analytics,
+        ).aggregate_data() or []
+        return dict(zip(cities_urls, forecasts))
+
+    def rate(
+            self,
+            forecasts: dict[str, CityForecast],
+            updated_at: dict[str, float],
+            updated: Iterable[CityForecast],
+    ) -> Snapshot:
+        """
+        Снимок с рейтингом после обновления городов updated. Рейтинг
+        меняется только для городов, значения которых изменились.
+        Города предыдущего снимка не изменяются: город с новым местом
+        в рейтинге копируется
+        """
+        for forecast in updated:
+            self.rating.add_forecast(forecast)
+        ranks = self.rating.ranks()
+        rated = {}
+        for key, forecast in forecasts.items():
+            rating = ranks.get(forecast.city)
+            if forecast.rating != rating:
+                forecast = forecast.copy()
+                forecast.rating = rating
+            rated[key] = forecast
+        return Snapshot(rated, dict(ranks), self.rating.best(), updated_at)
+
+    def start(self) -> 'ForecastService':
+        """Обновить данные и запустить обновление по расписанию"""
+        self.refresh()
+        self._stopped.clear()
+        self._scheduler = threading.Thread(
+            target=self._schedule, name='forecast-refresh', daemon=True
+        )
+        self._scheduler.start()
+        return self
+
+    def _schedule(self) -> None:
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as ex:
+                logging.exception(ex)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._scheduler is not None:
+            self._scheduler.join()
+            self._scheduler = None
+
+
+class ForecastHTTPServer(ThreadingHTTPServer):
+    """
+    Отдаёт данные ForecastService в JSON:
+    /table - все города, /rating - рейтинг,
+    /cities/<город> - один город, /health - время обновления.
+    /metrics - метрики в текстовом формате Prometheus
+    """
+    daemon_threads = True
+
+    def __init__(
+            self,
+            service: ForecastService,
+            host: str = SERVICE_HOST,
+            port: int = SERVICE_PORT,
+    ) -> None:
+        super().__init__((host, port), ForecastRequestHandler)
+        self.service = service
+
+
+class ForecastRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: ForecastHTTPServer
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path == '/table':
+            snapshot = service.snapshot
+            self.send_json([
+                forecast.to_dict() for forecast in snapshot.forecasts.values()
+            ])
+        elif path == '/rating':
+            snapshot = service.snapshot
+            self.send_json({'ranks': snapshot.ranks, 'best': snapshot.best})
+        elif path == '/health':
+            snapshot = service.snapshot
+            self.send_json({
+                'cities': len(snapshot.forecasts),
+                'refreshes': service.refreshes,
+                'updated_at': max(snapshot.updated_at.values(), default=None),
+            })
+        elif path == '/metrics':
+            self.send_body(
+                metrics.to_prometheus().encode('utf-8'),
+                'text/plain; version=0.0.4',
+            )
+        elif path.startswith('/cities/'):
+            self.send_city(unquote(path[len('/cities/'):]))
+        else:
+            self.send_json({'error': 'not found'}, HTTPStatus.NOT_FOUND)
+
+    def send_city(self, city: str) -> None:
+        try:
+            forecast = self.server.service.city(city)
+        except KeyError:
+            self.send_json(
+                {'error': f'unknown city {city}'}, HTTPStatus.NOT_FOUND
+            )
+            return
+        self.send_json(forecast.to_dict())
+
+    def send_json(self, data, status: HTTPStatus = HTTPStatus.OK) -> None:
+        self.send_body(
+            json.dumps(data, ensure_ascii=False).encode('utf-8'),
+            'application/json',
+            status,
+        )
+
+    def send_body(
+            self,
+            body: bytes,
+            content_type: str,
+            status: HTTPStatus = HTTPStatus.OK,
+    ) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def serve(
+        service: ForecastService,
+        host: str = SERVICE_HOST,
+        port: int = SERVICE_PORT,
+) -> None:
+    """Запустить сервис и обслуживать запросы до прерывания"""
+    service.start()
+    with ForecastHTTPServer(service, host, port) as server:
+        logging.info(f'Serving forecasts on http://{host}:{port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.stop()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import shutil
+from functools import cached_property, lru_cache
+from typing import NamedTuple
+
+from metrics import metrics
+from utils import (
+    REPLAY_ARCHIVE_INDEX_SUFFIX,
+    REPLAY_OPEN_ARCHIVES,
+    REPLAY_RESPONSE_SUFFIX,
+)
+
+logger = logging.getLogger()
+
+
+class ResponseLocation(NamedTuple):
+    """Сохранённый ответ: файл целиком или часть архива"""
+    path: str
+    offset: int = 0
+    length: int | None = None
+
+
+class InputSource:
+    """
+    Сохранённые ответы API вместо запросов по сети. Источник только
+    сообщает, где лежит ответ каждого города, а читает и разбирает
+    ответы read_response в исполнителе расчётов
+    """
+
+    name = 'stored'
+
+    def locations(self) -> dict[str, ResponseLocation]:
+        """Город -> место его ответа"""
+        raise NotImplementedError
+
+    @cached_property
+    def index(self) -> dict[str, ResponseLocation]:
+        """Места ответов, прочитанные один раз"""
+        return self.locations()
+
+    def read(self, city: str) -> dict | None:
+        return read_response(self.index[city])
+
+
+class DirectorySource(InputSource):
+    """Каталог с файлом ответа <ГОРОД>.json для каждого города"""
+
+    name = 'directory'
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def locations(self) -> dict[str, ResponseLocation]:
+        return {
+            name[:-len(REPLAY_RESPONSE_SUFFIX)]: ResponseLocation(
+                os.path.join(self.directory, name)
+            )
+            for name in sorted(os.listdir(self.directory))
+            if name.endswith(REPLAY_RESPONSE_SUFFIX)
+        }
+
+
+class ArchiveSource(InputSource):
+    """
+    Ответы, записанные подряд в один файл, с индексом в формате JSON
+    {город: [смещение, длина]} в <архив>.index.json. Исполнители
+    отображают архив в память один раз на процесс и разбирают только
+    части своих городов
+    """
+
+    name = 'archive'
+
+    def __init__(self, path: str, index_path: str | None = None) -> None:
+        self.path = path
+        self.index_path = index_path or path + REPLAY_ARCHIVE_INDEX_SUFFIX
+
+    def locations(self) -> dict[str, ResponseLocation]:
+        with open(self.index_path) as file:
+            index = json.load(file)
+        return {
+            city: ResponseLocation(self.path, offset, length)
+            for city, (offset, length) in index.items()
+        }
+
+    @classmethod
+    def write(
+            cls, source: InputSource, path: str
+    ) -> 'ArchiveSource':
+        """Записать ответы source подряд, не разбирая их"""
+        archive = cls(path)
+        index = {}
+        with open(path, 'wb') as file:
+            for city, location in source.locations().items():
+                with open(location.path, 'rb') as response:
+                    response.seek(location.offset)
+                    offset = file.tell()
+                    if location.length is None:
+                        shutil.copyfileobj(response, file)
+                    else:
+                        file.write(response.read(location.length))
+                    index[city] = (offset, file.tell() - offset)
+        with open(archive.index_path, 'w') as file:
+            json.dump(index, file)
+        return archive
+
+
+def get_source(path: str) -> InputSource:
+    """Источник-каталог или источник-архив по пути"""
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    return ArchiveSource(path)
+
+
+def read_response(location: ResponseLocation) -> dict | None:
+    """
+    Прочитать и разобрать сохранённый ответ. Выполняется
+    в исполнителе расчётов: ему передаётся только место ответа,
+    а не сами данные
+    """
+    try:
+        if location.length is None:
+            with open(location.path, 'rb') as file:
+                body = file.read()
+        else:
+            archive = _map_archive(
+                location.path, os.stat(location.path).st_mtime_ns
+            )
+            body = archive[location.offset:location.offset + location.length]
+        data = json.loads(body)
+    except (OSError, ValueError) as ex:
+        logger.error(f'Unable to read response {location}: {ex!r}')
+        metrics.inc('cities_total', stage='reading', result='missing')
+        return None
+    metrics.inc('cities_total', stage='reading', result='ok')
+    return data
+
+
+@lru_cache(maxsize=REPLAY_OPEN_ARCHIVES)
+def _map_archive(path: str, mtime_ns: int) -> mmap.mmap:
+    """
+    Архив, отображённый в память один раз на процесс. Перезаписанный
+    архив отображается заново
+    """
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Собрать каталог ответов API в архив для --replay'
+    )
+    parser.add_argument('directory')
+    parser.add_argument('archive')
+    args = parser.parse_args()
+    archive = ArchiveSource.write(DirectorySource(args.directory), args.archive)
+    print(f'Записано ответов: {len(archive.index)}, архив {args.archive}')
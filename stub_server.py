@@ -0,0 +1,214 @@
+import copy
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from functools import lru_cache
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONDITIONS = (
+    'clear', 'partly-cloudy', 'cloudy', 'overcast', 'drizzle', 'light-rain',
+    'rain', 'moderate-rain', 'heavy-rain', 'continuous-heavy-rain',
+    'showers', 'wet-snow', 'light-snow', 'snow', 'snow-showers', 'hail',
+    'thunderstorm', 'thunderstorm-with-rain', 'thunderstorm-with-hail',
+)
+EXAMPLE_RESPONSE_PATH = 'examples/response.json'
+
+
+@lru_cache(maxsize=1)
+def load_template(path: str = EXAMPLE_RESPONSE_PATH) -> dict:
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def generate_response(
+        city: str,
+        days: int = 5,
+        start_date: str = '2022-05-18',
+        template_path: str = EXAMPLE_RESPONSE_PATH,
+) -> dict:
+    """
+    Синтетический ответ API той же структуры, что examples/response.json.
+    Значения детерминированы названием города
+    """
+    template = load_template(template_path)
+    day_template = template['forecasts'][0]
+    hour_template = day_template['hours'][0]
+    rng = random.Random(city)
+    base_temp = rng.randint(-20, 35)
+    first_day = datetime.date.fromisoformat(start_date)
+    response = {
+        key: copy.deepcopy(value)
+        for key, value in template.items() if key != 'forecasts'
+    }
+    response['forecasts'] = []
+    for offset in range(days):
+        date = first_day + datetime.timedelta(days=offset)
+        timestamp = int(
+            datetime.datetime.combine(date, datetime.time()).timestamp()
+        )
+        day = {
+            key: copy.deepcopy(value)
+            for key, value in day_template.items() if key != 'hours'
+        }
+        day.update(date=date.isoformat(), date_ts=timestamp, hours=[])
+        for hour in range(24):
+            hour_data = dict(hour_template)
+            hour_data.update(
+                hour=str(hour),
+                hour_ts=timestamp + hour * 3600,
+                temp=base_temp + rng.randint(-8, 8),
+                condition=rng.choice(CONDITIONS),
+            )
+            day['hours'].append(hour_data)
+        response['forecasts'].append(day)
+    return response
+
+
+def synthetic_cities(count: int) -> list[str]:
+    """Названия синтетических городов для count городов"""
+    return [f'CITY{index:06d}' for index in range(count)]
+
+
+class StubForecastServer:
+    """
+    Локальная замена API прогнозов: отдаёт синтетические ответы
+    по адресу /<город>.json с заданной задержкой, разбросом задержки
+    и долей ошибок. Поддерживает keep-alive, gzip и ETag
+    """
+
+    def __init__(
+            self,
+            days: int = 5,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            error_rate: float = 0.0,
+            seed: int = 0,
+            host: str = '127.0.0.1',
+            port: int = 0,
+            cache_size: int = 1024,
+    ) -> None:
+        self.days = days
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests_count = 0
+        self.errors_count = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _StubHTTPServer((host, port), _StubHandler)
+        self._server.stub = self
+        self._thread: threading.Thread | None = None
+        self.cache_size = cache_size
+        self.body = lru_cache(maxsize=cache_size)(self._body)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url(self, city: str) -> str:
+        return f'{self.base_url}/{city}.json'
+
+    def cities_urls(self, cities: list[str]) -> dict[str, str]:
+        return {city: self.url(city) for city in cities}
+
+    def _body(self, city: str) -> tuple[bytes, str]:
+        body = json.dumps(
+            generate_response(city, self.days), separators=(',', ':')
+        ).encode('utf-8')
+        return body, '"{}"'.format(hashlib.md5(body).hexdigest())
+
+    def warm_up(self, cities: list[str]) -> None:
+        """
+        Заранее подготовить ответы, чтобы их генерация не попадала
+        в замеры. Если ответы не помещаются в кэш, они генерируются
+        при каждом запросе
+        """
+        if len(cities) <= self.cache_size:
+            for city in cities:
+                self.body(city)
+
+    def next_delay_and_error(self) -> tuple[float, bool]:
+        """Задержка и признак ошибки для очередного запроса"""
+        with self._lock:
+            self.requests_count += 1
+            delay = self.latency + self._random.uniform(
+                -self.jitter, self.jitter
+            )
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors_count += 1
+        return max(delay, 0.0), failed
+
+    def start(self) -> 'StubForecastServer':
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'StubForecastServer':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Асинхронный клиент открывает сотни соединений одновременно
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Клиент не дождался ответа, например по таймауту чтения
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело уходят отдельными write, без этого keep-alive
+    # соединения ждут подтверждения TCP
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        stub: StubForecastServer = self.server.stub
+        delay, failed = stub.next_delay_and_error()
+        if delay:
+            time.sleep(delay)
+        city, _, extension = self.path.strip('/').rpartition('.')
+        if failed or not city or extension != 'json':
+            self.send_error(
+                HTTPStatus.SERVICE_UNAVAILABLE if failed
+                else HTTPStatus.NOT_FOUND
+            )
+            return
+        body, etag = stub.body(city)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
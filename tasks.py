@@ -1,198 +1,749 @@
+import asyncio
 import datetime
 import logging
-import csv
+import queue
+import threading
+import time
 
-from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Pool
-from collections import OrderedDict
+from functools import partial
+from itertools import chain, islice
+from typing import Callable, Iterable, Iterator, Sequence
 
+from analytics import compile_analytics, normalize_specs
 from api_client import YandexWeatherAPI
+from async_client import AsyncYandexWeatherAPI
+from cache import ResponseCache
+from checkpoint import CheckpointJournal
+from executors import Executor, choose_executor, get_executor
+from memo import city_memo, content_hash, day_memo
+from metrics import metrics
+from models import AVERAGE_COLUMN, RATING_COLUMN, CityForecast
+from ranking import RatingEngine
+from sources import InputSource, ResponseLocation, read_response
+from writers import CsvResultWriter, ResultWriter
+from transport import PackedCityData, pack_city_data, pack_day_hours
+from vectorized import calculate_vectorized
 from exceptions import YandexAPIException
 from utils import (
-    HOURS_RANGE, GOOD_CONDITIONS, CITIES_DESCRIPTION_MAP, CSV_FILE_RELATIVE_PATH
+    HOURS_RANGE, GOOD_CONDITIONS, CITIES_DESCRIPTION_MAP, CSV_FILE_RELATIVE_PATH,
+    ASYNC_FETCH_CONCURRENCY, ASYNC_FETCH_PER_HOST_LIMIT, FETCH_MODE_ASYNC,
+    FETCH_MODE_THREADS, PIPELINE_QUEUE_SIZE, FETCH_THREADS,
+    CALCULATION_ENGINE_POOL, CALCULATION_ENGINE_NUMPY,
+    EXECUTOR_AUTO, EXECUTOR_INLINE, EXECUTOR_THREAD,
 )
 
 
 class DataFetchingTask:
-    def __init__(self, cities_urls: dict[str, str]) -> None:
+    def __init__(
+            self,
+            cities_urls: dict[str, str],
+            cache: ResponseCache | None = None,
+            journal: CheckpointJournal | None = None,
+    ) -> None:
         self.cities_urls = cities_urls
+        self.cache = cache
+        self.journal = journal
 
     def start_threads(self) -> list[tuple[str, dict]]:
-        """Запускает пул потоков для получения данных о погоде"""
-        with ThreadPoolExecutor() as pool:
-            data_generator = pool.map(
-                self.get_data, self.cities_urls.keys(), chunksize=4
-            )
+        """
+        Получить данные о погоде в пуле потоков. Данные одного города
+        запрашиваются в текущем потоке
+        """
+        executor = (
+            get_executor(EXECUTOR_INLINE) if len(self.cities_urls) <= 1
+            else self.executor()
+        )
+        with metrics.span('fetching', mode=FETCH_MODE_THREADS):
+            data = executor.map(self.get_data, self.cities_urls.keys())
         logging.info('Weather data received')
-        return list(data_generator)
+        return data
 
     @staticmethod
-    def get_data(city: str) -> tuple[str, dict | None]:
+    def executor() -> Executor:
+        """Общий для всех запусков пул потоков получения данных"""
+        return get_executor(EXECUTOR_THREAD, 'fetching', FETCH_THREADS)
+
+    def iter_threads(
+            self, queue_size: int = PIPELINE_QUEUE_SIZE
+    ) -> Iterator[tuple[str, dict | None]]:
+        """
+        Отдавать данные городов по мере получения. Потоки ждут,
+        пока в ограниченной очереди не освободится место
+        """
+        results: queue.Queue = queue.Queue(maxsize=queue_size)
+        stopped = threading.Event()
+        executor = self.executor()
+        for city in self.cities_urls:
+            executor.submit(self.put_data, city, results, stopped)
+        try:
+            for _ in range(len(self.cities_urls)):
+                yield results.get()
+        finally:
+            stopped.set()
+        logging.info('Weather data received')
+
+    def put_data(
+            self, city: str, results: queue.Queue, stopped: threading.Event
+    ) -> None:
+        """Получить данные города и положить их в очередь"""
+        if stopped.is_set():
+            return
+        try:
+            city_data = self.get_data(city)
+        except Exception as er:
+            logging.exception(er)
+            city_data = (city, None)
+        while not stopped.is_set():
+            try:
+                results.put(city_data, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get_data(self, city: str) -> tuple[str, dict | None]:
         """Возвращает название города и сырые данные из YandexWeatherAPI"""
         try:
-            return city, YandexWeatherAPI().get_forecasting(city)
+            api = YandexWeatherAPI(
+                cache=self.cache,
+                cities=self.cities_urls,
+            )
+            city_data = api.get_forecasting(city)
         except YandexAPIException as er:
             logging.error(
                 f'Error getting weather data for city {city}: {er}'
             )
+            metrics.inc('cities_total', stage='fetching', result='missing')
             return city, None
+        metrics.inc('cities_total', stage='fetching', result='ok')
+        if self.journal is not None:
+            self.journal.record_raw(city, city_data)
+        return city, city_data
+
+    def start_async(
+            self,
+            concurrency: int = ASYNC_FETCH_CONCURRENCY,
+            per_host_limit: int = ASYNC_FETCH_PER_HOST_LIMIT,
+    ) -> list[tuple[str, dict | None]]:
+        """Запускает цикл событий для асинхронного получения данных"""
+        with metrics.span('fetching', mode=FETCH_MODE_ASYNC):
+            return asyncio.run(
+                self.fetch_async(concurrency, per_host_limit)
+            )
+
+    async def fetch_async(
+            self,
+            concurrency: int = ASYNC_FETCH_CONCURRENCY,
+            per_host_limit: int = ASYNC_FETCH_PER_HOST_LIMIT,
+    ) -> list[tuple[str, dict | None]]:
+        """
+        Получить данные о погоде для всех городов в одном потоке,
+        ограничивая число одновременных запросов
+        """
+        api = AsyncYandexWeatherAPI(
+            concurrency,
+            per_host_limit,
+            cities=self.cities_urls,
+            cache=self.cache,
+        )
+        data = await asyncio.gather(*(
+            self.get_data_async(api, city, self.journal)
+            for city in self.cities_urls
+        ))
+        logging.info('Weather data received')
+        return list(data)
+
+    @staticmethod
+    async def get_data_async(
+            api: AsyncYandexWeatherAPI,
+            city: str,
+            journal: CheckpointJournal | None = None,
+    ) -> tuple[str, dict | None]:
+        """Асинхронная версия get_data"""
+        try:
+            city_data = await api.get_forecasting(city)
+        except YandexAPIException as er:
+            logging.error(
+                f'Error getting weather data for city {city}: {er}'
+            )
+            metrics.inc('cities_total', stage='fetching', result='missing')
+            return city, None
+        metrics.inc('cities_total', stage='fetching', result='ok')
+        if journal is not None:
+            journal.record_raw(city, city_data)
+        return city, city_data
 
 
 class DataCalculationTask:
-    def __init__(self, raw_data: list[tuple[str, dict]]) -> None:
+    def __init__(
+            self,
+            raw_data: list[tuple[str, dict]],
+            engine: str = CALCULATION_ENGINE_POOL,
+            executor: str = EXECUTOR_AUTO,
+            analytics: Sequence[str] = (),
+            journal: CheckpointJournal | None = None,
+    ) -> None:
         self.raw_data = raw_data
+        self.engine = engine
+        self.executor = executor
+        self.analytics = normalize_specs(analytics)
+        self.journal = journal
 
-    def calculate_data(self) -> list[dict]:
+    def calculate_data(self) -> list[CityForecast]:
         """Обработать данные погоды для всех городов"""
         logging.info('Start weather data calculations')
         if not self.raw_data:
             logging.warning('No data to calculate!')
             return []
-        with Pool(processes=4) as pool:
-            poll_map_iterator = pool.map(self.get_forecast_data, self.raw_data)
+        with metrics.span('calculation', engine=self.engine):
+            forecasts_data = self.calculate_with_engine()
         logging.info('Data calculated')
-        return list(poll_map_iterator)
+        return forecasts_data
+
+    def calculate_with_engine(self) -> list[CityForecast]:
+        """
+        Рассчитать города, данные которых изменились с прошлого расчёта.
+        Для остальных берётся сохранённый результат. Результаты
+        записываются в журнал контрольных точек по мере готовности
+        """
+        packed_data = list(map(
+            self.packer(self.analytics), self.raw_data
+        ))
+        keys = [
+            (city, self.analytics, content_hash(days))
+            for city, days in packed_data
+        ]
+        results = {key: city_memo.get(key) for key in keys}
+        changed = {
+            key: packed_city_data
+            for key, packed_city_data in zip(keys, packed_data)
+            if results[key] is None
+        }
+        logging.info(f'Cities to calculate: {len(changed)}/{len(keys)}')
+        if self.journal is not None:
+            for key in keys:
+                if key not in changed:
+                    self.journal.record_forecast(results[key])
+        if changed:
+            calculated = self.calculate_packed(list(changed.values()))
+            for key, forecast in zip(changed, calculated):
+                results[key] = forecast
+                city_memo.put(key, forecast)
+                if self.journal is not None:
+                    self.journal.record_forecast(forecast)
+        # Сохранённый результат не должен меняться дальше по конвейеру
+        return [results[key].copy() for key in keys]
+
+    def calculate_packed(
+            self, packed_data: list[PackedCityData]
+    ) -> Iterable[CityForecast]:
+        """
+        Расчёт выбранным способом: векторно или по городам
+        в исполнителе, выбранном по числу городов. Результаты
+        по городам отдаются в порядке городов по мере готовности
+        """
+        if self.engine == CALCULATION_ENGINE_NUMPY:
+            return calculate_vectorized(packed_data, self.analytics)
+        executor = choose_executor(self.executor, len(packed_data))
+        logging.info(f'Calculation executor: {executor.name}')
+        return executor.imap(
+            partial(self.get_packed_forecast_data, analytics=self.analytics),
+            packed_data,
+        )
+
+    @classmethod
+    def calculate_stored(
+            cls,
+            locations: dict[str, ResponseLocation],
+            engine: str = CALCULATION_ENGINE_POOL,
+            executor: str = EXECUTOR_AUTO,
+            analytics: Sequence[str] = (),
+    ) -> list[CityForecast]:
+        """
+        Расчёт по сохранённым ответам API. Ответы читаются и
+        разбираются исполнителем расчётов, процессам пула передаются
+        только места ответов. Для numpy процессы возвращают
+        упакованные данные, а расчёт выполняется векторно
+        """
+        logging.info('Start weather data calculations over stored responses')
+        analytics = normalize_specs(analytics)
+        executor = choose_executor(executor, len(locations))
+        logging.info(f'Calculation executor: {executor.name}')
+        with metrics.span('calculation', engine=engine, source='stored'):
+            if engine == CALCULATION_ENGINE_NUMPY:
+                return calculate_vectorized(executor.map(
+                    partial(cls.get_stored_packed_data, analytics=analytics),
+                    locations.items(),
+                ), analytics)
+            return executor.map(
+                partial(cls.get_stored_forecast_data, analytics=analytics),
+                locations.items(),
+            )
+
+    @classmethod
+    def get_stored_packed_data(
+            cls,
+            city_location: tuple[str, ResponseLocation],
+            analytics: tuple[str, ...] = (),
+    ) -> PackedCityData:
+        """Прочитать сохранённый ответ города и упаковать его"""
+        city, location = city_location
+        return cls.packer(analytics)((city, read_response(location)))
+
+    @classmethod
+    def get_stored_forecast_data(
+            cls,
+            city_location: tuple[str, ResponseLocation],
+            analytics: tuple[str, ...] = (),
+    ) -> CityForecast:
+        """get_packed_forecast_data для сохранённого ответа города"""
+        return cls.get_packed_forecast_data(
+            cls.get_stored_packed_data(city_location, analytics), analytics
+        )
 
     @staticmethod
+    def packer(analytics: tuple[str, ...]):
+        """
+        pack_city_data с колонками полей, нужных показателям analytics
+        """
+        if not analytics:
+            return pack_city_data
+        return partial(
+            pack_city_data, fields=compile_analytics(analytics).fields
+        )
+
+    @classmethod
+    def calculate_stream(
+            cls,
+            raw_data: Iterable[tuple[str, dict | None]],
+            max_in_flight: int = PIPELINE_QUEUE_SIZE,
+            executor: str = EXECUTOR_AUTO,
+            analytics: Sequence[str] = (),
+    ) -> Iterator[CityForecast]:
+        """
+        Обрабатывать данные по мере поступления и отдавать результаты
+        в порядке готовности. Число переданных в пул, но ещё
+        не обработанных городов не превышает max_in_flight
+        """
+        logging.info('Start streaming weather data calculations')
+        in_flight = threading.Semaphore(max_in_flight)
+        stopped = threading.Event()
+        analytics = normalize_specs(analytics)
+        pack = cls.packer(analytics)
+
+        def tasks() -> Iterator[PackedCityData]:
+            for raw_city_data in raw_data:
+                in_flight.acquire()
+                # Пул общий, после закрытия генератора задачи не нужны
+                if stopped.is_set():
+                    return
+                yield pack(raw_city_data)
+
+        results = choose_executor(executor, None).imap_unordered(
+            partial(cls.get_packed_forecast_data, analytics=analytics),
+            tasks(),
+            max_in_flight,
+        )
+        try:
+            for result in results:
+                in_flight.release()
+                yield result
+        finally:
+            stopped.set()
+            # Разблокировать поток пула, ожидающий места для задачи
+            in_flight.release(max_in_flight)
+        logging.info('Data calculated')
+
+    @classmethod
     def get_data_per_day(
-            forecast_day_hours: list) -> tuple[int | None, int | None]:
+            cls, forecast_day_hours: list) -> tuple[int | None, int | None]:
         """
         Получить среднее значение температуры и количество часов погоды
         без осадков за день
         """
+        return cls.get_data_per_day_columns(
+            *pack_day_hours(forecast_day_hours)
+        )
+
+    @staticmethod
+    def get_data_per_day_columns(
+            hours: tuple[int, ...],
+            temps: tuple[float, ...],
+            conditions: tuple[str, ...],
+    ) -> tuple[int | None, int | None]:
+        """То же, что get_data_per_day, для данных дня в виде колонок"""
         average_temp = 0
         temp_count = 0
         good_condition_hours = 0
-        for hour in forecast_day_hours:
-            if HOURS_RANGE[1] >= int(hour['hour']) >= HOURS_RANGE[0]:
-                average_temp += hour['temp']
+        for hour, temp, condition in zip(hours, temps, conditions):
+            if HOURS_RANGE[1] >= hour >= HOURS_RANGE[0]:
+                average_temp += temp
                 temp_count += 1
-                if hour['condition'] in GOOD_CONDITIONS:
+                if condition in GOOD_CONDITIONS:
                     good_condition_hours += 1
         if temp_count:
             average_temp /= temp_count
             return int(round(average_temp, 0)), good_condition_hours
         return None, None
 
+    @classmethod
+    def get_memoized_day_data(
+            cls,
+            city: str,
+            forecast_date: str,
+            day_columns: list,
+            analytics: tuple[str, ...] = (),
+    ) -> tuple[int | None, int | None, tuple]:
+        """
+        Средняя температура, часы без осадков и значения показателей
+        analytics с сохранением результата по городу, дате и хэшу часов
+        дня. В процессах пула результаты хранятся всё время жизни процесса
+        """
+        key = (
+            city, forecast_date, analytics, content_hash(tuple(day_columns))
+        )
+        day_data = day_memo.get(key)
+        if day_data is None:
+            if analytics:
+                day_data = compile_analytics(analytics)(day_columns)
+            else:
+                day_data = (*cls.get_data_per_day_columns(*day_columns), ())
+            day_memo.put(key, day_data)
+        return day_data
+
     @staticmethod
     def get_average_city_data(
-            city_data: dict[str, tuple[int, int]]
+            temps: Sequence[int], good_hours: Sequence[int]
     ) -> tuple[int | None, int | None]:
         """
         Получить средние значения температуры и часов без осадков за весь период
         """
-        if not city_data:
+        if not temps:
             logging.warning('Unable to calculate averages. No data')
             return None, None
 
-        good_conditions_hours = 0
-        average_temp = 0
-        for day in city_data.values():
-            average_temp += day[0]
-            good_conditions_hours += day[1]
-        average_temp /= len(city_data.values())
-        average_temp = int(round(average_temp, 0))
-        good_conditions_hours /= len(city_data.values())
-        good_conditions_hours = int(round(good_conditions_hours, 0))
+        average_temp = int(round(sum(temps) / len(temps), 0))
+        good_conditions_hours = int(round(sum(good_hours) / len(temps), 0))
         return average_temp, good_conditions_hours
 
-    def get_forecast_data(self, raw_city_data: tuple[str, dict]) -> dict:
+    @classmethod
+    def get_forecast_data(
+            cls, raw_city_data: tuple[str, dict]
+    ) -> CityForecast:
         """
         Получить среднее значение температуры и количество часов погоды
         без осадков для города за каждый день, а также средние
         значения этих характеристик за весь период
         """
-        forecasts_data = {
-            'city': raw_city_data[0],
-            'data': dict()
-        }
-        if not raw_city_data[1]:
-            logging.warning(f'No data for the city {raw_city_data[0]}!')
-            return forecasts_data
-        for forecast in raw_city_data[1]['forecasts']:
-            average_temp, good_condition_hours = self.get_data_per_day(
-                forecast['hours']
+        return cls.get_packed_forecast_data(pack_city_data(raw_city_data))
+
+    @classmethod
+    def get_packed_forecast_data(
+            cls,
+            packed_city_data: PackedCityData,
+            analytics: tuple[str, ...] = (),
+    ) -> CityForecast:
+        """
+        То же, что get_forecast_data, для данных после pack_city_data.
+        Процессам пула передаются только они, а не весь ответ API.
+        Показатели analytics считаются в том же проходе по часам дня
+        """
+        city, city_days = packed_city_data
+        if city_days is None:
+            logging.warning(f'No data for the city {city}!')
+            metrics.inc('cities_total', stage='calculation', result='missing')
+            return CityForecast(city)
+        started = time.perf_counter()
+        dates, temps, good_hours, days_analytics = [], [], [], []
+        for forecast_date, *day_columns in city_days:
+            average_temp, good_condition_hours, day_analytics = (
+                cls.get_memoized_day_data(
+                    city, forecast_date, day_columns, analytics
+                )
             )
             if average_temp is not None:
-                date = datetime.datetime.strptime(forecast['date'], '%Y-%m-%d')
-                forecasts_data['data'][date.strftime('%d-%m')] = (
-                    average_temp, good_condition_hours
-                )
-
-        forecasts_data['data']['Среднее'] = self.get_average_city_data(
-            forecasts_data['data']
+                date = datetime.datetime.strptime(forecast_date, '%Y-%m-%d')
+                dates.append(date.strftime('%d-%m'))
+                temps.append(average_temp)
+                good_hours.append(good_condition_hours)
+                days_analytics.append(day_analytics)
+        forecast = CityForecast(
+            city, dates, temps, good_hours,
+            cls.get_average_city_data(temps, good_hours),
+            analytics={
+                spec: [day[index] for day in days_analytics]
+                for index, spec in enumerate(analytics)
+            },
         )
-        return forecasts_data
+        metrics.observe('calculation_seconds', time.perf_counter() - started)
+        metrics.inc('cities_total', stage='calculation', result='ok')
+        return forecast
 
 
 class DataAggregationTask:
-    def __init__(self, cities_urls: dict[str, str]) -> None:
+    def __init__(
+            self,
+            cities_urls: dict[str, str],
+            fetch_mode: str = FETCH_MODE_THREADS,
+            cache: ResponseCache | None = None,
+            pipeline: bool = False,
+            engine: str = CALCULATION_ENGINE_POOL,
+            rating: RatingEngine | None = None,
+            writer: ResultWriter | None = None,
+            executor: str = EXECUTOR_AUTO,
+            analytics: Sequence[str] = (),
+            batch_size: int | None = None,
+            journal: CheckpointJournal | None = None,
+            source: InputSource | None = None,
+    ) -> None:
+        # С source значения cities_urls - места сохранённых ответов
+        # из source.locations(), данные не запрашиваются по сети
         self.cities_urls = cities_urls
+        self.journal = journal
+        self.source = source
+        self.executor = executor
+        self.analytics = analytics
+        self.batch_size = batch_size
+        self.fetch_mode = fetch_mode
+        self.rating = rating
+        self.writer = writer
+        self.cache = cache
+        self.pipeline = pipeline
+        self.engine = engine
 
-    def aggregate_data(self) -> list[dict] | None:
+    def aggregate_data(self) -> list[CityForecast] | None:
         """Получить данные и обработать их"""
-        raw_data = DataFetchingTask(self.cities_urls).start_threads()
-        forecasts_data = DataCalculationTask(raw_data).calculate_data()
+        if self.batch_size:
+            return [
+                forecast
+                for forecasts in self.iter_batches()
+                for forecast in forecasts
+            ] or None
+        with metrics.span('aggregation', pipeline=self.pipeline):
+            if self.source is not None:
+                forecasts_data = DataCalculationTask.calculate_stored(
+                    self.cities_urls,
+                    self.engine,
+                    self.executor,
+                    self.analytics,
+                )
+                if self.pipeline:
+                    for forecast in forecasts_data:
+                        self.publish(forecast)
+            elif self.pipeline:
+                forecasts_data = self.calculate_pipeline()
+            else:
+                forecasts_data = self.calculate_staged()
+        if self.cache is not None:
+            logging.info(f'Response cache stats: {self.cache.stats()}')
         if not forecasts_data or len(forecasts_data) == 0:
             logging.warning('Aggregated data is empty')
             return None
         return self.replace_city_name(forecasts_data)
 
+    def iter_batches(self) -> Iterator[list[CityForecast]]:
+        """
+        Получать и обрабатывать города пакетами по batch_size. Ответы
+        API пакета освобождаются после его расчёта, поэтому память
+        определяется размером пакета, а не числом городов. Города
+        сразу попадают в рейтинг, если он задан
+        """
+        cities = iter(self.cities_urls.items())
+        while batch := dict(islice(cities, self.batch_size)):
+            logging.info(f'Processing a batch of {len(batch)} cities')
+            forecasts = DataAggregationTask(
+                batch,
+                self.fetch_mode,
+                self.cache,
+                self.pipeline,
+                self.engine,
+                executor=self.executor,
+                analytics=self.analytics,
+                journal=self.journal,
+                source=self.source,
+            ).aggregate_data() or []
+            if self.rating is not None:
+                for forecast in forecasts:
+                    self.rating.add_forecast(forecast)
+            metrics.inc('batches_total')
+            yield forecasts
+
+    def pending(
+            self
+    ) -> tuple[dict[str, CityForecast], list[str], dict[str, str]]:
+        """
+        Города, рассчитанные в прерванном запуске, города с полученными
+        в нём данными и города, данные которых нужно получить
+        """
+        if self.journal is None:
+            return {}, [], self.cities_urls
+        return self.journal.pending(self.cities_urls)
+
+    def record(self, forecasts: Iterable[CityForecast]) -> None:
+        """Записать результаты расчёта в журнал контрольных точек"""
+        if self.journal is not None:
+            for forecast in forecasts:
+                self.journal.record_forecast(forecast)
+
+    def calculate_staged(self) -> list[CityForecast]:
+        """
+        Получить данные всех городов, затем обработать их. Города
+        из журнала контрольных точек не запрашиваются и не
+        рассчитываются повторно
+        """
+        done, recorded, cities_urls = self.pending()
+        fetching_task = DataFetchingTask(cities_urls, self.cache, self.journal)
+        if self.fetch_mode == FETCH_MODE_ASYNC:
+            raw_data = fetching_task.start_async()
+        else:
+            raw_data = fetching_task.start_threads()
+        if recorded:
+            raw_data = [*self.journal.iter_raw(recorded), *raw_data]
+        forecasts = DataCalculationTask(
+            raw_data, self.engine, self.executor, self.analytics, self.journal
+        ).calculate_data() if raw_data or not done else []
+        if self.journal is None:
+            return forecasts
+        # Города из журнала и полученные сейчас - в исходном порядке
+        done.update((forecast.city, forecast) for forecast in forecasts)
+        return [done[city] for city in self.cities_urls]
+
+    def calculate_pipeline(self) -> list[CityForecast]:
+        """
+        Обрабатывать данные каждого города сразу после получения,
+        не дожидаясь остальных городов. Готовые города сразу попадают
+        в рейтинг и в файл результатов, если они заданы. Города,
+        рассчитанные в прерванном запуске, берутся из журнала.
+        Данные получаются пулом потоков при любом fetch_mode
+        """
+        if self.fetch_mode == FETCH_MODE_ASYNC:
+            logging.warning(
+                'Pipeline fetches data with threads, async mode is ignored'
+            )
+        done, recorded, cities_urls = self.pending()
+        raw_data = DataFetchingTask(
+            cities_urls, self.cache, self.journal
+        ).iter_threads()
+        if recorded:
+            raw_data = chain(self.journal.iter_raw(recorded), raw_data)
+        order = {city: index for index, city in enumerate(self.cities_urls)}
+        forecasts_data = []
+        forecasts = DataCalculationTask.calculate_stream(
+            raw_data, executor=self.executor, analytics=self.analytics
+        )
+        for forecast in chain(done.values(), forecasts):
+            self.record([forecast])
+            forecasts_data.append((order[forecast.city], forecast))
+            self.publish(forecast)
+        forecasts_data.sort(key=lambda item: item[0])
+        return [forecast for _, forecast in forecasts_data]
+
+    def publish(self, forecast: CityForecast) -> None:
+        """Передать готовый город в рейтинг и файл результатов"""
+        self.replace_city_name([forecast])
+        if self.rating is not None:
+            self.rating.add_forecast(forecast)
+            logging.debug(
+                f'Partial rating of {len(self.rating)} cities, '
+                f'best: {self.rating.best()}'
+            )
+        if self.writer is not None:
+            self.writer.write(forecast)
+
     @staticmethod
-    def replace_city_name(data: list[dict]) -> list[dict]:
+    def replace_city_name(data: list[CityForecast]) -> list[CityForecast]:
         """Заменить названия городов в соответствии с настройками"""
         logging.info('Replacing city names')
         for forecast in data:
-            forecast['city'] = CITIES_DESCRIPTION_MAP.get(
-                forecast['city'], forecast['city']
+            forecast.city = CITIES_DESCRIPTION_MAP.get(
+                forecast.city, forecast.city
             )
         return data
 
 
 class DataAnalyzingTask:
-    def __init__(self, data: list[dict]) -> None:
+    def __init__(
+            self,
+            data: list[CityForecast],
+            rating: RatingEngine | None = None,
+            writer: ResultWriter | None = None,
+    ) -> None:
         self.data = data
+        self.rating = rating
+        self.writer = writer
         self.cities_rating = None
 
     def analyze_data(self) -> list[str] | None:
-        """Провести анализ погоды в городах и записать данные в csv-файл"""
+        """
+        Провести анализ погоды в городах и записать данные в файл.
+        Возвращает все города, лучшие по средним значениям
+        """
         logging.info('Start analyzing weather data')
         if not self.data:
             print('Data not provided, analysis stopped')
             return
-        self.set_rating_for_city()
-        self.create_csv_file()
-        return list(self.cities_rating)[:3]
+        with metrics.span('analyzing'):
+            with metrics.span('rating'):
+                self.set_rating_for_city()
+            with metrics.span('writing'):
+                if self.writer is None:
+                    self.create_csv_file()
+                else:
+                    self.write_results(self.writer)
+        return self.rating.best()
+
+    def analyze_batches(
+            self,
+            batches: Iterable[list[CityForecast]],
+            make_writer: Callable[[list[str]], ResultWriter],
+    ) -> list[str] | None:
+        """
+        Записывать города пакетами по мере расчёта, не храня их. Рейтинг
+        хранит только средние значения городов и дописывается в файл
+        после всех пакетов. Если файл не был открыт заранее, он создаётся
+        make_writer по датам первого пакета
+        """
+        logging.info('Start analyzing weather data in batches')
+        writer = self.writer
+        with metrics.span('analyzing', batched=True):
+            for forecasts in batches:
+                if not forecasts:
+                    continue
+                if writer is None:
+                    writer = make_writer(DataAnalyzingTask(forecasts).get_dates())
+                if writer.file is None:
+                    writer.open()
+                with metrics.span('writing'):
+                    for forecast in forecasts:
+                        writer.write(forecast)
+            if writer is None or writer.file is None:
+                print('Data not provided, analysis stopped')
+                return None
+            with metrics.span('rating'):
+                self.cities_rating = self.rating.ranks()
+            with metrics.span('writing'):
+                try:
+                    writer.write_rating(self.cities_rating)
+                finally:
+                    writer.close()
+        return self.rating.best()
 
     def set_rating_for_city(self) -> None:
         """Добавить данные рейтинга городов"""
         logging.info('Formation of city rating')
-        intermediate_data = []
+        if self.rating is None:
+            self.rating = RatingEngine()
+            for city in self.data:
+                self.rating.add_forecast(city)
+        self.cities_rating = self.rating.ranks()
         for city in self.data:
-            try:
-                average_temp = city['data']['Среднее'][0]
-                good_days = city['data']['Среднее'][1]
-                intermediate_data.append(
-                    (city['city'], average_temp, good_days)
-                )
-            except KeyError:
-                continue
-        rating = self.compute_rating(intermediate_data)
-        if rating:
-            for city_data in self.data:
-                try:
-                    city_data['data']['Рейтинг'] = rating[city_data['city']]
-                except KeyError:
-                    continue
+            city.rating = self.cities_rating.get(city.city)
 
     def compute_rating(self, summary_data: list) -> dict:
         """Составить рейтинг городов"""
-        sorted_list = sorted(
-            summary_data, key=lambda x: (x[1], x[2]), reverse=True
-        )
-        self.cities_rating = OrderedDict({
-            city[0]: grade + 1 for grade, city in enumerate(sorted_list)
-        })
+        rating = RatingEngine()
+        for city, average_temp, good_hours in summary_data:
+            rating.add(city, average_temp, good_hours)
+        self.cities_rating = rating.ranks()
         return self.cities_rating
 
     def create_csv_file(self) -> None:
@@ -201,44 +752,42 @@ class DataAnalyzingTask:
         и рейтинге городов
         """
         logging.info('Create the CSV file with analysis data')
-        head = self.get_csv_head()
-        with open(CSV_FILE_RELATIVE_PATH, 'w') as csv_file:
-            writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=head)
-            writer.writerow({column: column for column in head})
-            for city in self.data:
-                if not city['data']:
-                    logging.warning('No data to write to file')
-                    continue
-                temp_row = {
-                    'Город/день': city['city'],
-                    '': 'Температура, среднее'
-                }
-                condition_row = {
-                    'Город/день': '',
-                    '': 'Без осадков, часов'
-                }
-                for column in head[2:]:
-                    try:
-                        temp_row[column] = city['data'][column][0]
-                        condition_row[column] = city['data'][column][1]
-                    except KeyError:
-                        temp_row[column] = ''
-                        condition_row[column] = ''
-                    except TypeError:
-                        temp_row[column] = city['data'][column]
-                        condition_row[column] = ''
-                writer.writerow(temp_row)
-                writer.writerow(condition_row)
+        self.write_results(CsvResultWriter(
+            CSV_FILE_RELATIVE_PATH, self.get_dates(), self.get_analytics()
+        ))
+
+    def write_results(self, writer: ResultWriter) -> None:
+        """
+        Записать результаты за один проход. Если города уже были
+        записаны по мере готовности, дописывается только рейтинг
+        """
+        if writer.file is None:
+            writer.open()
+        try:
+            if not writer.written:
+                for city in self.data:
+                    writer.write(city)
+            writer.write_rating(self.cities_rating or {})
+        finally:
+            writer.close()
+
+    def get_dates(self) -> list[str]:
+        """Даты города с самым длинным прогнозом"""
+        return list(max(self.data, key=lambda city: len(city.dates)).dates)
+
+    def get_analytics(self) -> list[str]:
+        """Дополнительные показатели, рассчитанные для городов"""
+        return list(dict.fromkeys(
+            spec for city in self.data for spec in city.analytics
+        ))
 
     def get_csv_head(self) -> list[str]:
         """Получить шапку для csv-файла"""
         head = ['Город/день', '']
-        max_count_date = 0
-        index = 0
-        for i, city_data in enumerate(self.data):
-            if len(city_data['data']) > max_count_date:
-                max_count_date = len(city_data['data'])
-                index = i
-        for column_name in self.data[index]['data'].keys():
-            head.append(column_name)
+        longest = max(self.data, key=lambda city: len(city.dates))
+        head.extend(longest.dates)
+        if longest.has_data:
+            head.append(AVERAGE_COLUMN)
+        if longest.rating is not None:
+            head.append(RATING_COLUMN)
         return head
@@ -1,8 +1,79 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import pickle
+import pstats
 import unittest
+from unittest import mock
 import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+from analytics import (
+    COUNT,
+    METRICS,
+    compile_analytics,
+    normalize_specs,
+    register_metric,
+)
+from api_client import YandexWeatherAPI
+from benchmark import BenchmarkRunner, compare
+from async_client import AsyncYandexWeatherAPI
+from cache import ResponseCache
+from checkpoint import CheckpointJournal
+from cluster import ClusterWorker, Coordinator
+from connection_pool import ConnectionPool
+from exceptions import (
+    CircuitOpenException,
+    TransientAPIException,
+    YandexAPIException,
+)
+from executors import (
+    ThreadExecutor,
+    choose_executor,
+    get_executor,
+    shutdown_executors,
+)
+from history import HistoryStore, iso_date
+from models import CityForecast
+from ranking import RatingEngine
+from resilience import CircuitBreaker, Resilience, RetryPolicy
+from service import ForecastHTTPServer, ForecastService, SingleFlight
+from sources import ArchiveSource, DirectorySource, get_source
+from stub_server import StubForecastServer, generate_response
+from writers import (
+    ColumnarResultWriter,
+    CsvResultWriter,
+    JsonLinesResultWriter,
+    date_range,
+    read_columnar,
+)
+from memo import city_memo, content_hash, day_memo
+from metrics import Metrics, metrics
+from profiling import profiler
+from transport import pack_city_data
+from vectorized import calculate_vectorized, np
+from utils import (
+    CLUSTER_AUTHKEY_ENV,
+    CSV_FILE_RELATIVE_PATH,
+    EXECUTOR_AUTO,
+    EXECUTOR_INLINE,
+    EXECUTOR_PROCESS,
+    EXECUTOR_THREAD,
+    EXECUTORS,
+    FETCH_MODE_ASYNC,
+    GOOD_CONDITIONS,
+    RETRY_ATTEMPTS,
+)
 from tasks import (
     DataCalculationTask,
+    DataFetchingTask,
     DataAggregationTask,
     DataAnalyzingTask,
 )
@@ -10,12 +81,237 @@ from tasks import (
 with open('examples/response.json', 'r') as json_file:
     test_data = [('MOSCOW', json.load(json_file))]
 
+with open('examples/response.json', 'rb') as json_file:
+    test_response_body = json_file.read()
+test_response_etag = '"response-v1"'
+
+
+class ResponseHandler(BaseHTTPRequestHandler):
+    """Отдаёт examples/response.json по пути /response.json"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections_count += 1
+
+    def do_GET(self):
+        if self.path != '/response.json':
+            self.send_error(404)
+            return
+        body = test_response_body
+        if self.headers.get('If-None-Match') == test_response_etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', test_response_etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServerTestCase(unittest.TestCase):
+    """Поднимает локальный HTTP-сервер на время тестов класса"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ResponseHandler)
+        cls.server.connections_count = 0
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+
+class AsyncYandexWeatherAPITest(LocalServerTestCase):
+    def test_do_req(self):
+        api = AsyncYandexWeatherAPI(concurrency=2, per_host_limit=1)
+        result = asyncio.run(
+            api._do_req(f'{self.base_url}/response.json')
+        )
+        self.assertEqual(test_data[0][1], result)
+
+    def test_do_req_concurrent(self):
+        async def fetch_all():
+            api = AsyncYandexWeatherAPI(concurrency=4, per_host_limit=2)
+            return await asyncio.gather(*(
+                api._do_req(f'{self.base_url}/response.json')
+                for _ in range(10)
+            ))
+        self.assertEqual([test_data[0][1]] * 10, asyncio.run(fetch_all()))
+
+    def test_do_req_error(self):
+        api = AsyncYandexWeatherAPI()
+        with self.assertRaises(YandexAPIException):
+            asyncio.run(api._do_req(f'{self.base_url}/missing.json'))
+
+
+class ConnectionPoolTest(LocalServerTestCase):
+    def test_keep_alive_and_gzip(self):
+        pool = ConnectionPool(maxsize=2)
+        url = f'{self.base_url}/response.json'
+        connections_before = self.server.connections_count
+        for _ in range(3):
+            resp = pool.request(url)
+            self.assertEqual(200, resp.status)
+            self.assertEqual('gzip', resp.headers['content-encoding'])
+            self.assertEqual(test_response_body, resp.body)
+        self.assertEqual(1, self.server.connections_count - connections_before)
+        self.assertEqual(1, pool.idle_count(url))
+        pool.close()
+        self.assertEqual(0, pool.idle_count(url))
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=0)
+        url = f'{self.base_url}/response.json'
+        connections_before = self.server.connections_count
+        pool.request(url)
+        pool.request(url)
+        self.assertEqual(2, self.server.connections_count - connections_before)
+        pool.close()
+
+    def test_api_do_req(self):
+        api = YandexWeatherAPI(ConnectionPool())
+        self.assertEqual(
+            test_data[0][1], api._do_req(f'{self.base_url}/response.json')
+        )
+        with self.assertRaises(YandexAPIException):
+            api._do_req(f'{self.base_url}/missing.json')
+
+
+class ResponseCacheTest(LocalServerTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.url = f'{self.base_url}/response.json'
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_fresh_hit(self):
+        cache = ResponseCache(self.cache_dir.name, ttl=60)
+        api = YandexWeatherAPI(ConnectionPool(), cache)
+        self.assertEqual(test_data[0][1], api._do_req(self.url))
+        connections_before = self.server.connections_count
+        self.assertEqual(test_data[0][1], api._do_req(self.url))
+        self.assertEqual(connections_before, self.server.connections_count)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_revalidation(self):
+        cache = ResponseCache(self.cache_dir.name, ttl=0)
+        api = YandexWeatherAPI(ConnectionPool(), cache)
+        api._do_req(self.url)
+        entry = cache.get(self.url)
+        self.assertEqual(test_response_etag, entry.etag)
+        self.assertEqual(test_response_body, entry.body)
+
+        restored_cache = ResponseCache(self.cache_dir.name, ttl=0)
+        api = YandexWeatherAPI(ConnectionPool(), restored_cache)
+        self.assertEqual(test_data[0][1], api._do_req(self.url))
+        self.assertEqual(1, restored_cache.revalidations)
+        self.assertEqual(1, restored_cache.hits)
+        self.assertEqual(0, restored_cache.misses)
+
+    def test_async_fresh_hit_and_revalidation(self):
+        cache = ResponseCache(self.cache_dir.name, ttl=60)
+        api = AsyncYandexWeatherAPI(cache=cache)
+        self.assertEqual(test_data[0][1], asyncio.run(api._do_req(self.url)))
+        connections_before = self.server.connections_count
+        api = AsyncYandexWeatherAPI(cache=cache)
+        self.assertEqual(test_data[0][1], asyncio.run(api._do_req(self.url)))
+        self.assertEqual(connections_before, self.server.connections_count)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        restored_cache = ResponseCache(self.cache_dir.name, ttl=0)
+        api = AsyncYandexWeatherAPI(cache=restored_cache)
+        self.assertEqual(test_data[0][1], asyncio.run(api._do_req(self.url)))
+        self.assertEqual(1, restored_cache.revalidations)
+        self.assertEqual(0, restored_cache.misses)
+
+    def test_async_fetching_uses_cache(self):
+        cache = ResponseCache(self.cache_dir.name, ttl=60)
+        with StubForecastServer(days=2) as stub:
+            cities_urls = stub.cities_urls(['CITY0', 'CITY1'])
+            first = DataFetchingTask(cities_urls, cache).start_async()
+            requests_before = stub.requests_count
+            second = DataFetchingTask(cities_urls, cache).start_async()
+            self.assertEqual(requests_before, stub.requests_count)
+        self.assertEqual(first, second)
+        self.assertEqual(2, cache.hits)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.cache_dir.name, max_size=10 ** 9)
+        for name in ('first', 'second', 'third'):
+            cache.put(name, test_response_body, {})
+        cache.get('first')
+        cache.max_size = cache.size - 1
+        cache.put('fourth', b'{}', {})
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(3, len(os.listdir(self.cache_dir.name)))
+
+
+class DataFetchingTest(unittest.TestCase):
+    def test_start_async(self):
+        fetching_task = DataFetchingTask({'WrongCity': ''})
+        self.assertEqual([('WrongCity', None)], fetching_task.start_async())
+
+    def test_iter_threads(self):
+        cities = {f'WrongCity{i}': '' for i in range(10)}
+        fetching_task = DataFetchingTask(cities)
+        result = list(fetching_task.iter_threads(queue_size=2))
+        self.assertCountEqual([(city, None) for city in cities], result)
+
+    def test_iter_threads_early_close(self):
+        cities = {f'WrongCity{i}': '' for i in range(10)}
+        data_iterator = DataFetchingTask(cities).iter_threads(queue_size=1)
+        self.assertIsNone(next(data_iterator)[1])
+        data_iterator.close()
+
+
+class TransportTest(unittest.TestCase):
+    def test_pack_city_data(self):
+        city, days = pack_city_data(test_data[0])
+        self.assertEqual('MOSCOW', city)
+        self.assertEqual(
+            len(test_data[0][1]['forecasts']), len(days)
+        )
+        date, hours, temps, conditions = days[0]
+        first_day = test_data[0][1]['forecasts'][0]
+        self.assertEqual(first_day['date'], date)
+        self.assertEqual(
+            [int(hour['hour']) for hour in first_day['hours']], list(hours)
+        )
+        self.assertEqual(
+            [hour['temp'] for hour in first_day['hours']], list(temps)
+        )
+        self.assertEqual(
+            [hour['condition'] for hour in first_day['hours']],
+            list(conditions)
+        )
+        self.assertEqual(('Test', None), pack_city_data(('Test', None)))
+
 
 class DataCalculationTest(unittest.TestCase):
     calculation_task = DataCalculationTask(list(test_data))
 
     def test_calculate_data(self):
-        result = self.calculation_task.calculate_data()
+        result = [
+            forecast.to_dict()
+            for forecast in self.calculation_task.calculate_data()
+        ]
         self.assertEqual(
             [
                 {
@@ -58,12 +354,12 @@ class DataCalculationTest(unittest.TestCase):
         self.assertEqual((2, 2), result)
 
     def test_get_average_city_data(self):
-        data = {'18-05': (15, 11), '19-05': (11, 5), '20-05': (10, 11)}
-        result = self.calculation_task.get_average_city_data(data)
+        result = self.calculation_task.get_average_city_data(
+            [15, 11, 10], [11, 5, 11]
+        )
         self.assertEqual((12, 9), result)
 
-        data = {}
-        result = self.calculation_task.get_average_city_data(data)
+        result = self.calculation_task.get_average_city_data([], [])
         self.assertEqual((None, None), result)
 
     def test_get_forecast_data(self):
@@ -78,31 +374,248 @@ class DataCalculationTest(unittest.TestCase):
                     'Среднее': (12, 9)
                 }
             },
-            result
+            result.to_dict()
         )
 
         result = self.calculation_task.get_forecast_data(('Test', dict()))
-        self.assertEqual({'city': 'Test', 'data': {}}, result)
+        self.assertEqual({'city': 'Test', 'data': {}}, result.to_dict())
+        self.assertFalse(result.has_data)
+
+    def test_calculate_stream(self):
+        raw_data = iter(test_data * 3 + [('Test', None)])
+        result = list(
+            DataCalculationTask.calculate_stream(raw_data, max_in_flight=1)
+        )
+        self.assertEqual(4, len(result))
+        self.assertIn(CityForecast('Test'), result)
+        self.assertEqual(
+            3, sum(forecast.city == 'MOSCOW' for forecast in result)
+        )
+
+
+class AnalyticsTest(unittest.TestCase):
+    specs = ('humidity', 'prec_mm@all', 'good_hours@morning', 'temp_min@night')
+
+    def expected(self, day, field, window, aggregate):
+        values = [
+            hour[field] for hour in day['hours']
+            if window[0] <= int(hour['hour']) <= window[1]
+        ]
+        if aggregate == 'count':
+            return sum(value in GOOD_CONDITIONS for value in values)
+        if aggregate == 'min':
+            return float(min(values))
+        if aggregate == 'sum':
+            return round(float(sum(values)), 1)
+        return round(sum(values) / len(values), 1)
+
+    def test_day_analyzer(self):
+        analyzer = compile_analytics(normalize_specs(self.specs))
+        self.assertEqual(
+            ('humidity@day', 'prec_mm@all', 'good_hours@morning',
+             'temp_min@night'),
+            analyzer.specs
+        )
+        self.assertEqual(('humidity', 'prec_mm'), analyzer.fields)
+        day = test_data[0][1]['forecasts'][0]
+        _, *day_columns = pack_city_data(test_data[0], analyzer.fields)[1][0]
+        average_temp, good_hours, values = analyzer(day_columns)
+        self.assertEqual(
+            DataCalculationTask.get_data_per_day(day['hours']),
+            (average_temp, good_hours)
+        )
+        self.assertEqual(
+            (
+                self.expected(day, 'humidity', (9, 19), 'mean'),
+                self.expected(day, 'prec_mm', (0, 23), 'sum'),
+                self.expected(day, 'condition', (6, 11), 'count'),
+                self.expected(day, 'temp', (0, 5), 'min'),
+            ),
+            values
+        )
+        self.assertEqual((None, None, ()), analyzer(
+            ((3,), (1,), ('clear',), (50,), (0,))
+        ))
+        with self.assertRaises(ValueError):
+            normalize_specs(['pressure'])
+        with self.assertRaises(ValueError):
+            normalize_specs(['humidity@noon'])
+
+    def test_calculate_data(self):
+        forecast, = DataCalculationTask(
+            list(test_data), analytics=self.specs
+        ).calculate_data()
+        self.assertEqual(
+            DataCalculationTask(list(test_data)).calculate_data()[0].to_dict(
+            )['data'],
+            forecast.to_dict()['data']
+        )
+        days = [
+            day for day in test_data[0][1]['forecasts']
+            if any(9 <= int(hour['hour']) <= 19 for hour in day['hours'])
+        ]
+        self.assertEqual(
+            [self.expected(day, 'humidity', (9, 19), 'mean') for day in days],
+            list(forecast.analytics['humidity@day'])
+        )
+        humidity = forecast.analytics['humidity@day']
+        self.assertEqual(
+            round(sum(humidity) / len(humidity), 1),
+            forecast.analytics_average()['humidity@day']
+        )
+        self.assertEqual(
+            forecast, CityForecast.from_dict(forecast.to_dict())
+        )
+        self.assertEqual(forecast, pickle.loads(pickle.dumps(forecast)))
+        streamed, = DataCalculationTask.calculate_stream(
+            iter(test_data), analytics=self.specs
+        )
+        self.assertEqual(forecast, streamed)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_vectorized(self):
+        raw_data = test_data + [('Test', None), ('Empty', {'forecasts': []})]
+        self.assertEqual(
+            DataCalculationTask(
+                list(raw_data), analytics=self.specs
+            ).calculate_data(),
+            DataCalculationTask(
+                list(raw_data), engine='numpy', analytics=self.specs
+            ).calculate_data()
+        )
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_count_without_values(self):
+        register_metric('humidity_hours', 'humidity', COUNT, 'Часов')
+        self.addCleanup(METRICS.pop, 'humidity_hours')
+        specs = normalize_specs(['humidity_hours@day'])
+        forecast, = DataCalculationTask(
+            list(test_data), analytics=specs
+        ).calculate_data()
+        days = [
+            sum(9 <= int(hour['hour']) <= 19 for hour in day['hours'])
+            for day in test_data[0][1]['forecasts']
+        ]
+        self.assertEqual(
+            [count for count in days if count],
+            list(forecast.analytics['humidity_hours@day']),
+        )
+        self.assertEqual(
+            [forecast],
+            DataCalculationTask(
+                list(test_data), engine='numpy', analytics=specs
+            ).calculate_data()
+        )
+
+    def test_writers(self):
+        forecast, = DataCalculationTask(
+            list(test_data), analytics=self.specs
+        ).calculate_data()
+        specs = list(forecast.analytics)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'result.wfc')
+            dates = ['17-05', *forecast.dates]
+            with ColumnarResultWriter(path, dates, specs) as writer:
+                writer.write(forecast)
+            self.assertEqual(([*dates], [forecast]), read_columnar(path))
+
+            path = os.path.join(directory, 'result.csv')
+            with CsvResultWriter(path, forecast.dates, specs) as writer:
+                writer.write(forecast)
+            with open(path, encoding='utf-8') as csv_file:
+                rows = list(csv.reader(csv_file))
+        self.assertEqual(3 + len(specs), len(rows))
+        self.assertEqual(
+            [
+                '', 'Влажность, % (day)',
+                *map(str, forecast.analytics['humidity@day']),
+                str(forecast.analytics_average()['humidity@day']), '',
+            ],
+            rows[3]
+        )
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class VectorizedCalculationTest(unittest.TestCase):
+    def test_calculate_data(self):
+        calculation_task = DataCalculationTask(
+            list(test_data), engine='numpy'
+        )
+        self.assertEqual(
+            DataCalculationTask(list(test_data)).calculate_data(),
+            calculation_task.calculate_data()
+        )
+
+    def test_rounding_and_missing_data(self):
+        raw_data = [
+            ('Half', {'forecasts': [
+                {'date': '2022-05-18', 'hours': [
+                    {'hour': '10', 'temp': 2, 'condition': 'clear'},
+                    {'hour': '11', 'temp': 3, 'condition': 'rain'},
+                ]},
+                {'date': '2022-05-19', 'hours': [
+                    {'hour': '10', 'temp': -1, 'condition': 'clear'},
+                    {'hour': '11', 'temp': -2, 'condition': 'clear'},
+                ]},
+                {'date': '2022-05-20', 'hours': [
+                    {'hour': '3', 'temp': 30, 'condition': 'clear'},
+                ]},
+            ]}),
+            ('Night', {'forecasts': [{'date': '2022-05-18', 'hours': [
+                {'hour': '23', 'temp': 5, 'condition': 'clear'},
+            ]}]}),
+            ('Empty', {'forecasts': []}),
+            ('Test', None),
+        ] + test_data
+        self.assertEqual(
+            [
+                DataCalculationTask.get_forecast_data(raw_city_data)
+                for raw_city_data in raw_data
+            ],
+            calculate_vectorized(list(map(pack_city_data, raw_data)))
+        )
 
 
 class DataAggregationTest(unittest.TestCase):
     cities = {
-        'WrongCity': 'https://code.s3.yandex.net',
+        'WrongCity': '',
     }
     aggregate_task = DataAggregationTask(cities)
 
     def test_aggregate_data(self):
         aggregated_data = self.aggregate_task.aggregate_data()
-        self.assertEqual([{'city': 'WrongCity', 'data': {}}], aggregated_data)
+        self.assertEqual([CityForecast('WrongCity')], aggregated_data)
+
+    def test_aggregate_data_pipeline(self):
+        cities = {'WrongCity': '', 'MOSCOW_WRONG': ''}
+        aggregated_data = DataAggregationTask(
+            cities, pipeline=True
+        ).aggregate_data()
+        self.assertEqual(
+            [CityForecast('WrongCity'), CityForecast('MOSCOW_WRONG')],
+            aggregated_data
+        )
+
+    def test_pipeline_ignores_async_mode(self):
+        task = DataAggregationTask(
+            {'WrongCity': ''}, FETCH_MODE_ASYNC, pipeline=True
+        )
+        with self.assertLogs(level='WARNING') as logs:
+            aggregated_data = task.aggregate_data()
+        self.assertIn('async mode is ignored', logs.output[0])
+        self.assertEqual([CityForecast('WrongCity')], aggregated_data)
 
     def test_replace_city_name(self):
         data = [
-            {
+            CityForecast.from_dict({
                 'city': 'MOSCOW',
                 'data': {'26-05': (18, 7), 'Среднее': (18, 7)}
-            }
+            })
+        ]
+        replaced_data = [
+            forecast.to_dict()
+            for forecast in self.aggregate_task.replace_city_name(data)
         ]
-        replaced_data = self.aggregate_task.replace_city_name(data)
         self.assertEqual(
             [
                 {
@@ -115,7 +628,7 @@ class DataAggregationTest(unittest.TestCase):
 
 
 class DataAnalyzingTest(unittest.TestCase):
-    data = [
+    data = [CityForecast.from_dict(forecast) for forecast in [
         {
             'city': 'Лондон',
             'data': {
@@ -131,7 +644,7 @@ class DataAnalyzingTest(unittest.TestCase):
                 'Среднее': (18, 10)
             }
         }
-    ]
+    ]]
     analyzing_task = DataAnalyzingTask(data)
 
     def test_set_rating_for_city(self):
@@ -155,7 +668,7 @@ class DataAnalyzingTest(unittest.TestCase):
                         'Рейтинг': 1
                     }
                 }
-            ], self.analyzing_task.data
+            ], [forecast.to_dict() for forecast in self.analyzing_task.data]
         )
 
     def test_compute_rating(self):
@@ -165,12 +678,1173 @@ class DataAnalyzingTest(unittest.TestCase):
             self.analyzing_task.compute_rating(summary_data)
         )
 
+    def test_analyze_data_ties(self):
+        data = [
+            CityForecast('Лондон', ['18-05'], [10], [5], (10, 5)),
+            CityForecast('Москва', ['18-05'], [18], [10], (18, 10)),
+            CityForecast('Рим', ['18-05'], [18], [10], (18, 10)),
+            CityForecast('Каир'),
+        ]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                best = DataAnalyzingTask(data).analyze_data()
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(['Москва', 'Рим'], best)
+        self.assertEqual([3, 1, 1, None], [city.rating for city in data])
+
     def test_get_csv_head(self):
         self.assertEqual(
             ['Город/день', '', '18-05', '19-05', 'Среднее'],
             self.analyzing_task.get_csv_head()
         )
 
+    def test_create_csv_file(self):
+        data = [
+            CityForecast('Лондон', ['18-05'], [10], [5], (10, 5), 2),
+            CityForecast(
+                'Москва', ['18-05', '19-05'], [13, 23], [11, 9], (18, 10), 1
+            ),
+            CityForecast('Каир'),
+            CityForecast('Рим', average=(None, None)),
+        ]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                DataAnalyzingTask(data).create_csv_file()
+                with open(CSV_FILE_RELATIVE_PATH) as csv_file:
+                    rows = list(csv.reader(csv_file))
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(
+            [
+                ['Город/день', '', '18-05', '19-05', 'Среднее', 'Рейтинг'],
+                ['Лондон', 'Температура, среднее', '10', '', '10', '2'],
+                ['', 'Без осадков, часов', '5', '', '5', ''],
+                ['Москва', 'Температура, среднее', '13', '23', '18', '1'],
+                ['', 'Без осадков, часов', '11', '9', '10', ''],
+                ['Рим', 'Температура, среднее', '', '', '', ''],
+                ['', 'Без осадков, часов', '', '', '', ''],
+            ],
+            rows
+        )
+
+
+class RatingEngineTest(unittest.TestCase):
+    def test_top_k_with_ties(self):
+        rating = RatingEngine(top_k=2)
+        self.assertEqual([], rating.best())
+        rating.add('A', 10, 5)
+        rating.add('B', 20, 1)
+        self.assertEqual(['B'], rating.best())
+        rating.add('C', 15, 3)
+        rating.add('D', 20, 1)
+        rating.add('E', 1, 1)
+        self.assertEqual(
+            [((20, 1), ['B', 'D']), ((15, 3), ['C'])], rating.top()
+        )
+        self.assertEqual(['B', 'D'], rating.best())
+        self.assertEqual(5, len(rating))
+        self.assertEqual(
+            {'B': 1, 'D': 1, 'C': 3, 'A': 4, 'E': 5}, rating.ranks()
+        )
+
+    def test_update_and_remove(self):
+        rating = RatingEngine(top_k=2)
+        for city, score in {'A': (10, 5), 'B': (20, 1), 'C': (15, 3)}.items():
+            rating.add(city, *score)
+        rating.add('B', 5, 0)
+        self.assertEqual([((15, 3), ['C']), ((10, 5), ['A'])], rating.top())
+        self.assertEqual({'C': 1, 'A': 2, 'B': 3}, rating.ranks())
+        self.assertEqual(3, rating.rank('B'))
+        rating.remove('C')
+        self.assertEqual(['A'], rating.best())
+        self.assertEqual(1, rating.rank('A'))
+        self.assertIsNone(rating.rank('C'))
+        rating.add_forecast(CityForecast('A'))
+        self.assertEqual({'B': 1}, rating.ranks())
+
+    def test_add_forecast(self):
+        rating = RatingEngine()
+        rating.add_forecast(CityForecast('Каир'))
+        rating.add_forecast(CityForecast('Рим', average=(None, None)))
+        rating.add_forecast(CityForecast('Москва', average=(18, 10)))
+        self.assertEqual({'Москва': 1}, rating.ranks())
+
+
+class ResultWritersTest(unittest.TestCase):
+    ranks = {'Москва': 1, 'Лондон': 2}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = [
+            CityForecast('Лондон', ['18-05'], [10], [5], (10, 5)),
+            CityForecast(
+                'Москва', ['18-05', '20-05'], [13, 23], [11, 9], (18, 10)
+            ),
+            CityForecast('Каир'),
+            CityForecast('Рим', average=(None, None)),
+        ]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_date_range(self):
+        self.assertEqual(
+            ['31-12', '01-01', '02-01'], date_range('2022-12-31', 3)
+        )
+
+    def test_csv(self):
+        path = self.path('result.csv')
+        dates = date_range('2022-05-18', 3)
+        with CsvResultWriter(path, dates) as writer:
+            for forecast in self.data:
+                writer.write(forecast)
+        with open(path, encoding='utf-8') as csv_file:
+            rows = list(csv.reader(csv_file))
+        self.assertEqual(
+            [
+                [
+                    'Город/день', '', '18-05', '19-05', '20-05',
+                    'Среднее', 'Рейтинг'
+                ],
+                ['Лондон', 'Температура, среднее', '10', '', '', '10', ''],
+                ['', 'Без осадков, часов', '5', '', '', '5', ''],
+                ['Москва', 'Температура, среднее', '13', '', '23', '18', ''],
+                ['', 'Без осадков, часов', '11', '', '9', '10', ''],
+                ['Рим', 'Температура, среднее', '', '', '', '', ''],
+                ['', 'Без осадков, часов', '', '', '', '', ''],
+            ],
+            rows
+        )
+
+    def test_jsonl(self):
+        path = self.path('result.jsonl')
+        with JsonLinesResultWriter(path, []) as writer:
+            for forecast in self.data:
+                writer.write(forecast)
+            writer.write_rating(self.ranks)
+        with open(path, encoding='utf-8') as jsonl_file:
+            lines = [json.loads(line) for line in jsonl_file]
+        self.assertEqual(5, len(lines))
+        self.assertEqual(
+            {
+                'type': 'city',
+                'city': 'Москва',
+                'days': {'18-05': [13, 11], '20-05': [23, 9]},
+                'average': [18, 10],
+                'rating': None,
+            },
+            lines[1]
+        )
+        self.assertEqual({'type': 'rating', 'ranks': self.ranks}, lines[-1])
+
+    def test_columnar_round_trip(self):
+        path = self.path('result.wfc')
+        dates = date_range('2022-05-18', 3)
+        with ColumnarResultWriter(path, dates, row_group_size=3) as writer:
+            for forecast in self.data:
+                writer.write(forecast)
+            writer.write_rating(self.ranks)
+        read_dates, forecasts = read_columnar(path)
+        self.assertEqual(dates, read_dates)
+        expected = [
+            CityForecast('Лондон', ['18-05'], [10], [5], (10, 5), 2),
+            CityForecast(
+                'Москва', ['18-05', '20-05'], [13, 23], [11, 9], (18, 10), 1
+            ),
+            CityForecast('Каир'),
+            CityForecast('Рим', average=(None, None)),
+        ]
+        self.assertEqual(expected, forecasts)
+
+    def test_analyzing_task_writes_rating_after_streamed_rows(self):
+        path = self.path('result.jsonl')
+        writer = JsonLinesResultWriter(path, [])
+        writer.open()
+        for forecast in self.data:
+            writer.write(forecast)
+        DataAnalyzingTask(self.data, writer=writer).analyze_data()
+        with open(path, encoding='utf-8') as jsonl_file:
+            lines = [json.loads(line) for line in jsonl_file]
+        self.assertEqual(5, len(lines))
+        self.assertEqual({'type': 'rating', 'ranks': self.ranks}, lines[-1])
+
+
+class CityForecastTest(unittest.TestCase):
+    def test_dict_round_trip_and_pickle(self):
+        forecast = {
+            'city': 'Москва',
+            'data': {'18-05': (13, 11), 'Среднее': (13, 11), 'Рейтинг': 1},
+        }
+        city_forecast = CityForecast.from_dict(forecast)
+        self.assertEqual(forecast, city_forecast.to_dict())
+        self.assertEqual(
+            city_forecast, pickle.loads(pickle.dumps(city_forecast))
+        )
+        self.assertTrue(city_forecast.is_rated)
+        self.assertFalse(CityForecast('Рим', average=(None, None)).is_rated)
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.history = HistoryStore(
+            os.path.join(self.directory.name, 'history.sqlite3')
+        )
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def test_iso_date(self):
+        self.assertEqual(
+            '2023-01-02', iso_date('02-01', datetime.date(2022, 12, 30))
+        )
+        self.assertEqual(
+            '2022-05-18', iso_date('18-05', datetime.date(2022, 5, 18))
+        )
+        self.assertEqual(
+            '2024-02-29', iso_date('29-02', datetime.date(2023, 12, 31))
+        )
+
+    def test_runs_and_queries(self):
+        first_run = datetime.datetime(2022, 5, 17).timestamp()
+        second_run = datetime.datetime(2022, 5, 18).timestamp()
+        moscow = CityForecast(
+            'Москва', ['17-05', '18-05'], [10, 12], [5, 6], (11, 6), 1,
+            {'humidity@day': [70.5, 60.0]},
+        )
+        self.history.save_run([
+            moscow,
+            CityForecast('Лондон', ['17-05'], [9], [3], (9, 3), 2),
+            CityForecast('Каир'),
+        ], first_run)
+        run = self.history.save_run([
+            CityForecast('Москва', ['18-05'], [15], [8], (15, 8), 2),
+            CityForecast('Лондон', ['18-05'], [16], [9], (16, 9), 1),
+        ], second_run)
+        self.assertEqual(
+            [(run, second_run, 2), (run - 1, first_run, 2)],
+            self.history.runs()
+        )
+        self.assertEqual(
+            [
+                ('2022-05-17', 10, 5, run - 1, first_run),
+                ('2022-05-18', 15, 8, run, second_run),
+            ],
+            self.history.city_trend('Москва')
+        )
+        self.assertEqual(
+            [('2022-05-18', 15, 8, run, second_run)],
+            self.history.city_trend('Москва', date_from='2022-05-18')
+        )
+        self.assertEqual(
+            [12, 15],
+            [day.temp for day in self.history.city_forecasts(
+                'Москва', '2022-05-18'
+            )]
+        )
+        self.assertEqual(
+            [('2022-05-17', 70.5), ('2022-05-18', 60.0)],
+            self.history.metric_trend('Москва', 'humidity@day')
+        )
+        self.assertEqual(
+            [(run, second_run, 'Лондон', 1),
+             (run - 1, first_run, 'Москва', 1)],
+            self.history.best_cities()
+        )
+        self.assertEqual(
+            [1, 2],
+            [rating.rating for rating in self.history.rating_history('Москва')]
+        )
+
+    def test_indexes(self):
+        plan = ' '.join(
+            str(row) for row in self.history._query(
+                'EXPLAIN QUERY PLAN SELECT * FROM ratings '
+                'WHERE run = 1 AND rating = 1'
+            )
+        )
+        self.assertIn('ratings_run_rating', plan)
+        plan = ' '.join(
+            str(row) for row in self.history._query(
+                'EXPLAIN QUERY PLAN SELECT * FROM days '
+                "WHERE city = 'Москва' AND date = '2022-05-18'"
+            )
+        )
+        self.assertIn('days_city_date', plan)
+
+
+class BatchedExecutionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.stub = StubForecastServer(days=7).start()
+        city_memo.clear()
+        day_memo.clear()
+
+    def tearDown(self):
+        self.stub.stop()
+        self.directory.cleanup()
+
+    def read(self, path):
+        with open(path, encoding='utf-8') as csv_file:
+            return list(csv.reader(csv_file))
+
+    def test_same_result_as_full_run(self):
+        cities_urls = self.stub.cities_urls(
+            [f'CITY{index}' for index in range(12)]
+        )
+        data = DataAggregationTask(cities_urls).aggregate_data()
+        full_path = os.path.join(self.directory.name, 'full.csv')
+        full_best = DataAnalyzingTask(
+            data,
+            writer=CsvResultWriter(
+                full_path, DataAnalyzingTask(data).get_dates()
+            ),
+        ).analyze_data()
+
+        batched_path = os.path.join(self.directory.name, 'batched.csv')
+        rating = RatingEngine()
+        batches = DataAggregationTask(
+            cities_urls, rating=rating, batch_size=5
+        ).iter_batches()
+        batched_best = DataAnalyzingTask([], rating).analyze_batches(
+            batches, lambda dates: CsvResultWriter(batched_path, dates)
+        )
+        self.assertEqual(full_best, batched_best)
+        self.assertEqual(self.read(full_path), self.read(batched_path))
+
+    def peak_memory(self, cities_urls, batch_size):
+        city_memo.clear()
+        day_memo.clear()
+        tracemalloc.start()
+        try:
+            for forecasts in DataAggregationTask(
+                    cities_urls, batch_size=batch_size
+            ).iter_batches():
+                del forecasts
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_set_by_batch_size(self):
+        cities_urls = self.stub.cities_urls(
+            [f'CITY{index}' for index in range(32)]
+        )
+        self.stub.warm_up(list(cities_urls))
+        self.assertLess(
+            self.peak_memory(cities_urls, 4) * 2,
+            self.peak_memory(cities_urls, 32)
+        )
+
+
+class CheckpointJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'checkpoint.journal')
+        self.stub = StubForecastServer(days=2).start()
+        self.cities_urls = self.stub.cities_urls(
+            [f'CITY{index}' for index in range(6)]
+        )
+        city_memo.clear()
+        day_memo.clear()
+
+    def tearDown(self):
+        self.stub.stop()
+        self.directory.cleanup()
+
+    def run_interrupted(self, cities_urls, **kwargs):
+        """Запуск, прерванный после обработки cities_urls"""
+        journal = CheckpointJournal(self.path, kwargs.get('analytics', ()))
+        DataAggregationTask(
+            cities_urls, journal=journal, **kwargs
+        ).aggregate_data()
+        journal.close()
+
+    def resume(self, **kwargs):
+        requests_before = self.stub.requests_count
+        with CheckpointJournal(
+                self.path, kwargs.get('analytics', ()), resume=True
+        ) as journal:
+            data = DataAggregationTask(
+                self.cities_urls, journal=journal, **kwargs
+            ).aggregate_data()
+        return data, self.stub.requests_count - requests_before
+
+    def expected(self, **kwargs):
+        city_memo.clear()
+        day_memo.clear()
+        return [
+            forecast.to_dict() for forecast in
+            DataAggregationTask(self.cities_urls, **kwargs).aggregate_data()
+        ]
+
+    def test_resume_fetches_only_missing_cities(self):
+        for pipeline in (False, True):
+            with self.subTest(pipeline=pipeline):
+                first = dict(list(self.cities_urls.items())[:4])
+                self.run_interrupted(first, pipeline=pipeline)
+                data, requests = self.resume(pipeline=pipeline)
+                self.assertEqual(2, requests)
+                self.assertEqual(
+                    self.expected(), [forecast.to_dict() for forecast in data]
+                )
+                self.assertFalse(os.path.exists(self.path))
+
+    def test_recorded_responses_recalculated_for_new_analytics(self):
+        self.run_interrupted(self.cities_urls)
+        analytics = normalize_specs(['humidity@evening'])
+        data, requests = self.resume(analytics=analytics)
+        self.assertEqual(0, requests)
+        self.assertEqual(
+            self.expected(analytics=analytics),
+            [forecast.to_dict() for forecast in data],
+        )
+
+    def test_torn_record_truncated(self):
+        self.run_interrupted(self.cities_urls)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(size - 10)
+        journal = CheckpointJournal(self.path, resume=True)
+        self.assertEqual(5, len(journal.forecasts))
+        self.assertLess(os.path.getsize(self.path), size - 10)
+        journal.close()
+        data, requests = self.resume()
+        self.assertEqual(0, requests)
+        self.assertEqual(
+            self.expected(), [forecast.to_dict() for forecast in data]
+        )
+
+    def test_staged_results_recorded_as_calculated(self):
+        calculate = DataCalculationTask.get_packed_forecast_data
+        calls = []
+
+        def interrupted(packed_city_data, analytics=()):
+            calls.append(packed_city_data[0])
+            if len(calls) == 4:
+                raise KeyboardInterrupt
+            return calculate(packed_city_data, analytics)
+
+        with mock.patch.object(
+                DataCalculationTask, 'get_packed_forecast_data',
+                side_effect=interrupted,
+        ), self.assertRaises(KeyboardInterrupt):
+            with CheckpointJournal(self.path) as journal:
+                DataAggregationTask(
+                    self.cities_urls, journal=journal,
+                    executor=EXECUTOR_INLINE,
+                ).aggregate_data()
+        journal = CheckpointJournal(self.path, resume=True)
+        self.assertEqual(calls[:3], list(journal.forecasts))
+        journal.close()
+        data, requests = self.resume()
+        self.assertEqual(0, requests)
+        self.assertEqual(
+            self.expected(), [forecast.to_dict() for forecast in data]
+        )
+
+    def test_journal_kept_after_failed_run(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with CheckpointJournal(self.path):
+                raise KeyboardInterrupt
+        self.assertTrue(os.path.exists(self.path))
+
+
+class ReplaySourceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.responses = os.path.join(self.directory.name, 'responses')
+        os.mkdir(self.responses)
+        self.raw_data = []
+        for index in range(8):
+            city = f'CITY{index}'
+            data = generate_response(city, days=3)
+            with open(os.path.join(self.responses, f'{city}.json'), 'w') as file:
+                json.dump(data, file)
+            self.raw_data.append((city, data))
+        self.archive = os.path.join(self.directory.name, 'responses.bin')
+        city_memo.clear()
+        day_memo.clear()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def expected(self, analytics=()):
+        return [
+            forecast.to_dict() for forecast in DataCalculationTask(
+                self.raw_data, analytics=analytics
+            ).calculate_data()
+        ]
+
+    def replay(self, source, **kwargs):
+        return [
+            forecast.to_dict() for forecast in DataAggregationTask(
+                source.locations(), source=source, **kwargs
+            ).aggregate_data()
+        ]
+
+    def test_archive_index(self):
+        directory = DirectorySource(self.responses)
+        archive = ArchiveSource.write(directory, self.archive)
+        self.assertEqual(list(directory.locations()), list(archive.locations()))
+        self.assertIsInstance(get_source(self.archive), ArchiveSource)
+        self.assertIsInstance(get_source(self.responses), DirectorySource)
+        with mock.patch.object(
+                archive, 'locations', wraps=archive.locations
+        ) as locations:
+            for city, data in self.raw_data:
+                self.assertEqual(data, archive.read(city))
+        # Индекс архива читается один раз
+        self.assertEqual(1, locations.call_count)
+
+    def test_same_result_as_fetched_responses(self):
+        archive = ArchiveSource.write(
+            DirectorySource(self.responses), self.archive
+        )
+        analytics = normalize_specs(['humidity@evening'])
+        engines = ['pool'] + (['numpy'] if np is not None else [])
+        for source in (DirectorySource(self.responses), archive):
+            for engine in engines:
+                for executor in ('inline', 'process'):
+                    with self.subTest(
+                            source=source.name, engine=engine,
+                            executor=executor,
+                    ):
+                        self.assertEqual(
+                            self.expected(analytics),
+                            self.replay(
+                                source, engine=engine, executor=executor,
+                                analytics=analytics,
+                            ),
+                        )
+
+    def test_batches_over_archive(self):
+        archive = ArchiveSource.write(
+            DirectorySource(self.responses), self.archive
+        )
+        self.assertEqual(
+            self.expected(), self.replay(archive, batch_size=3)
+        )
+
+    def test_pipeline_feeds_rating(self):
+        source = DirectorySource(self.responses)
+        rating = RatingEngine()
+        data = DataAggregationTask(
+            source.locations(), pipeline=True, rating=rating, source=source
+        ).aggregate_data()
+        self.assertEqual(8, len(rating))
+        expected = DataAnalyzingTask(
+            DataAggregationTask(
+                source.locations(), source=source
+            ).aggregate_data()
+        )
+        expected.set_rating_for_city()
+        self.assertEqual(expected.rating.best(), rating.best())
+        self.assertEqual(expected.cities_rating, rating.ranks())
+        self.assertEqual(8, len(data))
+
+    def test_unreadable_response_without_data(self):
+        with open(os.path.join(self.responses, 'CITY3.json'), 'w') as file:
+            file.write('{"forecasts": [')
+        data = DataAggregationTask(
+            DirectorySource(self.responses).locations(),
+            source=DirectorySource(self.responses),
+        ).aggregate_data()
+        self.assertEqual(8, len(data))
+        self.assertEqual(
+            ['CITY3'], [forecast.city for forecast in data if not forecast.has_data]
+        )
+
+
+class CrashingWorker(ClusterWorker):
+    """Узел, который завершается, получив шард"""
+
+    def process_shard(self, cities_urls, analytics):
+        os._exit(1)
+
+
+class SlowWorker(ClusterWorker):
+    def process_shard(self, cities_urls, analytics):
+        time.sleep(60)
+        return super().process_shard(cities_urls, analytics)
+
+
+def run_cluster_worker(worker_class, address, authkey):
+    worker_class(address, authkey, heartbeat_interval=0.1).run()
+
+
+class ClusterTest(unittest.TestCase):
+    authkey = b'test-cluster'
+
+    def setUp(self):
+        self.stub = StubForecastServer(days=2).start()
+        self.cities_urls = self.stub.cities_urls(
+            [f'CITY{index}' for index in range(12)]
+        )
+        self.workers = []
+        city_memo.clear()
+        day_memo.clear()
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.stub.stop()
+
+    def start_worker(self, coordinator, worker_class=ClusterWorker):
+        worker = multiprocessing.Process(
+            target=run_cluster_worker,
+            args=(worker_class, coordinator.address, self.authkey),
+        )
+        worker.start()
+        self.workers.append(worker)
+        return worker
+
+    def coordinator(self, **kwargs):
+        return Coordinator(
+            self.cities_urls, ('127.0.0.1', 0), self.authkey, shard_size=3,
+            **kwargs
+        )
+
+    @mock.patch.dict(os.environ, {CLUSTER_AUTHKEY_ENV: ''})
+    def test_cluster_key_required(self):
+        first = Coordinator(self.cities_urls, ('127.0.0.1', 0))
+        second = Coordinator(self.cities_urls, ('localhost', 0))
+        self.assertTrue(first.generated_key)
+        self.assertNotEqual(first.generated_key, second.generated_key)
+        with self.assertRaises(ValueError):
+            Coordinator(self.cities_urls, ('0.0.0.0', 0))
+        Coordinator(self.cities_urls, ('0.0.0.0', 0), self.authkey)
+        with self.assertRaises(ValueError):
+            ClusterWorker(('127.0.0.1', 0))
+        with mock.patch.dict(os.environ, {CLUSTER_AUTHKEY_ENV: 'key'}):
+            self.assertEqual(b'key', ClusterWorker(('127.0.0.1', 0)).authkey)
+
+    def test_same_result_as_local_run(self):
+        analytics = normalize_specs(['humidity@evening', 'prec_mm'])
+        expected = DataAggregationTask(
+            self.cities_urls, analytics=analytics
+        ).aggregate_data()
+        with self.coordinator(analytics=analytics) as coordinator:
+            for _ in range(3):
+                self.start_worker(coordinator)
+            data = coordinator.wait(timeout=60)
+        self.assertEqual(
+            [forecast.to_dict() for forecast in expected],
+            [forecast.to_dict() for forecast in data],
+        )
+        self.assertEqual(4, coordinator.stats['completed'])
+        for worker in self.workers:
+            worker.join(timeout=10)
+            self.assertEqual(0, worker.exitcode)
+
+    def test_shard_of_lost_worker_reassigned(self):
+        with self.coordinator(lease_timeout=0.5) as coordinator:
+            self.start_worker(coordinator, CrashingWorker).join(timeout=10)
+            # Аренда шарда истекает раньше, чем его заберёт другой узел
+            time.sleep(1)
+            self.start_worker(coordinator)
+            data = coordinator.wait(timeout=60)
+        self.assertEqual(1, coordinator.stats['reassigned'])
+        self.assertEqual(12, len(data))
+        self.assertTrue(all(forecast.has_data for forecast in data))
+
+    def test_slow_shard_stolen(self):
+        with self.coordinator() as coordinator:
+            self.start_worker(coordinator, SlowWorker)
+            time.sleep(1)
+            self.start_worker(coordinator)
+            started = time.monotonic()
+            data = coordinator.wait(timeout=30)
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertGreaterEqual(coordinator.stats['stolen'], 1)
+        self.assertTrue(all(forecast.has_data for forecast in data))
+
+
+class StubForecastServerTest(unittest.TestCase):
+    def test_generate_response(self):
+        response = generate_response('CITY1', days=3)
+        self.assertEqual(response, generate_response('CITY1', days=3))
+        self.assertEqual(
+            ['2022-05-18', '2022-05-19', '2022-05-20'],
+            [day['date'] for day in response['forecasts']],
+        )
+        forecast = DataCalculationTask.get_forecast_data(('CITY1', response))
+        self.assertEqual(('18-05', '19-05', '20-05'), forecast.dates)
+        self.assertTrue(forecast.is_rated)
+
+    def test_fetch_from_stub(self):
+        with StubForecastServer(days=2) as server:
+            cities_urls = server.cities_urls(['CITY1', 'CITY2'])
+            result = dict(DataFetchingTask(cities_urls).start_threads())
+        self.assertEqual(generate_response('CITY2', days=2), result['CITY2'])
+
+    def test_errors(self):
+        with StubForecastServer(error_rate=1) as server:
+            cities_urls = server.cities_urls(['CITY1'])
+            result = DataFetchingTask(cities_urls).start_async()
+            # Ошибка 503 повторяется RETRY_ATTEMPTS раз
+            self.assertEqual((RETRY_ATTEMPTS, RETRY_ATTEMPTS), (
+                server.requests_count, server.errors_count
+            ))
+        self.assertEqual([('CITY1', None)], result)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run(self):
+        with StubForecastServer(days=2) as server:
+            results = BenchmarkRunner(server).run(3)
+        self.assertEqual(
+            {'fetching', 'calculation', 'aggregation', 'analyzing'},
+            {result.stage for result in results},
+        )
+        fetching = [result for result in results if result.stage == 'fetching']
+        self.assertTrue(all(result.requests == 3 for result in fetching))
+
+    def test_compare(self):
+        baseline = {'results': [
+            {'stage': 'fetching', 'setting': 'async', 'cities': 10, 'wall': 1},
+            {'stage': 'analyzing', 'setting': 'csv', 'cities': 10, 'wall': 1},
+        ]}
+        current = {'results': [
+            {'stage': 'fetching', 'setting': 'async', 'cities': 10, 'wall': 2},
+            {'stage': 'analyzing', 'setting': 'csv', 'cities': 10, 'wall': 1},
+        ]}
+        regressions = compare(baseline, current, threshold=0.1)
+        self.assertEqual(['fetching'], [item['stage'] for item in regressions])
+        self.assertEqual(2, regressions[0]['ratio'])
+
+
+class ExecutorsTest(unittest.TestCase):
+    def test_executors_results(self):
+        expected = DataCalculationTask(
+            test_data * 5, executor=EXECUTOR_INLINE
+        ).calculate_data()
+        for executor in EXECUTORS:
+            with self.subTest(executor=executor):
+                self.assertEqual(expected, DataCalculationTask(
+                    test_data * 5, executor=executor
+                ).calculate_data())
+
+    def test_pools_are_reused(self):
+        executor = get_executor(EXECUTOR_PROCESS)
+        first_pool = executor.pool
+        DataCalculationTask(test_data, executor=EXECUTOR_PROCESS).calculate_data()
+        self.assertIs(executor, get_executor(EXECUTOR_PROCESS))
+        self.assertIs(first_pool, executor.pool)
+        self.assertEqual(
+            [2, 4, 6], get_executor(EXECUTOR_THREAD).map(abs, [-2, 4, -6])
+        )
+
+    def test_auto(self):
+        self.assertEqual(
+            EXECUTOR_INLINE, choose_executor(EXECUTOR_AUTO, 1).name
+        )
+        self.assertEqual(
+            EXECUTOR_THREAD, choose_executor(EXECUTOR_THREAD, 1).name
+        )
+
+    def test_stream_with_more_threads_than_in_flight(self):
+        executor = ThreadExecutor(workers=40)
+        self.addCleanup(executor.close)
+        with mock.patch('tasks.choose_executor', return_value=executor):
+            results = []
+            thread = threading.Thread(target=lambda: results.extend(
+                DataCalculationTask.calculate_stream(
+                    iter(test_data * 100), max_in_flight=32,
+                    executor=EXECUTOR_THREAD,
+                )
+            ))
+            thread.start()
+            thread.join(timeout=20)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(100, len(results))
+
+    def test_thread_results_in_completion_order(self):
+        executor = ThreadExecutor(workers=4)
+        self.addCleanup(executor.close)
+        received = threading.Event()
+
+        def task(item):
+            # Первый элемент завершается только после получения второго
+            if item == 0:
+                received.wait(10)
+            return item
+
+        results = []
+        for result in executor.imap_unordered(task, [0, 1]):
+            results.append(result)
+            received.set()
+        self.assertEqual([1, 0], results)
+
+    def test_stream_early_close(self):
+        results = DataCalculationTask.calculate_stream(
+            iter(test_data * 100), max_in_flight=2, executor=EXECUTOR_PROCESS
+        )
+        self.assertEqual('MOSCOW', next(results).city)
+        results.close()
+        self.assertEqual(1, len(DataCalculationTask(
+            test_data, executor=EXECUTOR_PROCESS
+        ).calculate_data()))
+
+
+class MemoTest(unittest.TestCase):
+    def setUp(self):
+        city_memo.clear()
+        day_memo.clear()
+
+    def test_unchanged_cities_reused(self):
+        raw_data = [('A', test_data[0][1]), ('B', test_data[0][1])]
+        first = DataCalculationTask(raw_data).calculate_data()
+        first[0].rating = 1
+        self.assertEqual((0, 2), (city_memo.hits, city_memo.misses))
+        changed = json.loads(json.dumps(test_data[0][1]))
+        changed['forecasts'][0]['hours'][12]['temp'] += 30
+        second = DataCalculationTask(
+            [('A', test_data[0][1]), ('B', changed)]
+        ).calculate_data()
+        self.assertEqual((1, 3), (city_memo.hits, city_memo.misses))
+        self.assertIsNone(second[0].rating)
+        self.assertNotEqual(first[1].temps, second[1].temps)
+        # Изменился один день, остальные дни взяты из сохранённых
+        days_count = len(changed['forecasts'])
+        self.assertEqual(days_count - 1, day_memo.hits)
+
+    def test_content_hash_of_equal_values(self):
+        condition = 'clear'
+        same = (condition, condition)
+        equal = (condition, ''.join(['cl', 'ear']))
+        self.assertIsNot(same[0], equal[1])
+        self.assertEqual(content_hash(same), content_hash(equal))
+
+
+class MetricsTest(unittest.TestCase):
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_disabled(self):
+        registry = Metrics()
+        registry.inc('requests_total')
+        registry.observe('fetch_seconds', 0.1)
+        with registry.span('fetching'):
+            pass
+        self.assertEqual(
+            {'counters': [], 'histograms': [], 'spans': []},
+            registry.snapshot(),
+        )
+
+    def test_prometheus(self):
+        registry = Metrics(enabled=True)
+        registry.inc('requests_total', status=200)
+        registry.inc('requests_total', 2, status=200)
+        registry.observe('fetch_seconds', 0.003)
+        registry.observe('fetch_seconds', 20)
+        with registry.span('analyzing'):
+            with registry.span('rating'):
+                pass
+        text = registry.to_prometheus()
+        self.assertIn('weather_requests_total{status="200"} 3', text)
+        self.assertIn('weather_fetch_seconds_bucket{le="0.001"} 0', text)
+        self.assertIn('weather_fetch_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn('weather_fetch_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('weather_fetch_seconds_count 2', text)
+        self.assertEqual(
+            [('rating', 'analyzing'), ('analyzing', None)],
+            [(span['name'], span['parent']) for span in registry.spans],
+        )
+
+    def test_worker_metrics(self):
+        city_memo.clear()
+        day_memo.clear()
+        metrics.enable()
+        DataCalculationTask(
+            [(city, test_data[0][1]) for city in ('A', 'B', 'C')],
+            executor=EXECUTOR_PROCESS,
+        ).calculate_data()
+        counters = {
+            (item['name'], tuple(item['labels'].items())): item['value']
+            for item in metrics.to_dict()['counters']
+        }
+        self.assertEqual(3, counters[
+            ('cities_total', (('result', 'ok'), ('stage', 'calculation')))
+        ])
+        # Процессы пула присылают своё процессорное время
+        self.assertGreater(counters[('worker_cpu_seconds_total', ())], 0)
+        histograms = {
+            item['name']: item['count']
+            for item in metrics.to_dict()['histograms']
+        }
+        self.assertEqual(
+            {'calculation_seconds': 3, 'worker_queue_seconds': 3},
+            histograms,
+        )
+
+    def test_export_json(self):
+        metrics.enable()
+        metrics.inc('requests_total')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            metrics.export(path)
+            with open(path) as metrics_file:
+                exported = json.load(metrics_file)
+        self.assertEqual(
+            [{'name': 'requests_total', 'labels': {}, 'value': 1}],
+            exported['counters'],
+        )
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        city_memo.clear()
+        day_memo.clear()
+
+    def tearDown(self):
+        profiler.disable()
+        self.directory.cleanup()
+
+    def functions(self, path):
+        return {
+            function for _, _, function in pstats.Stats(path).stats
+        }
+
+    def test_stages_with_workers_and_threads(self):
+        profiler.enable(self.directory.name, trace_memory=True)
+        with StubForecastServer(days=2) as stub:
+            forecasts = DataAggregationTask(
+                stub.cities_urls(['A', 'B', 'C']),
+                executor=EXECUTOR_PROCESS,
+            ).aggregate_data()
+        self.assertEqual(3, len(forecasts))
+        shutdown_executors(wait=True)
+        paths = profiler.save()
+        self.assertEqual(
+            {'aggregation', 'calculation', 'fetching'}, set(paths)
+        )
+        # Работа в процессах пула и упаковка данных для них
+        self.assertIn(
+            'get_packed_forecast_data', self.functions(paths['calculation'])
+        )
+        self.assertIn(
+            '<built-in method _pickle.dumps>',
+            self.functions(paths['calculation'])
+        )
+        # Работа в потоках получения данных
+        self.assertIn('get_forecasting', self.functions(paths['fetching']))
+        with open(os.path.join(self.directory.name, 'memory.json')) as file:
+            memory = json.load(file)
+        self.assertGreater(memory['fetching']['peak_bytes'], 0)
+        self.assertGreater(memory['calculation']['worker_peak_bytes'], 0)
+
+    def test_disabled(self):
+        func = DataCalculationTask.get_forecast_data
+        self.assertIs(func, profiler.wrap(func))
+        items = [1]
+        self.assertEqual((func, items), profiler.worker_task(func, items))
+
+
+class ResilienceTest(unittest.TestCase):
+    def test_retry_delays(self):
+        delays = list(RetryPolicy(4, base=1, max_delay=3).delays())
+        self.assertEqual(3, len(delays))
+        for delay, limit in zip(delays, (1, 2, 3)):
+            self.assertTrue(0 <= delay <= limit)
+
+    def test_retry_transient_only(self):
+        resilience = Resilience(RetryPolicy(3, base=0.001))
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise TransientAPIException('timeout')
+            return 'ok'
+
+        self.assertEqual('ok', resilience.call('http://host/a', flaky))
+        self.assertEqual(3, len(calls))
+
+        def not_found():
+            calls.append(1)
+            raise YandexAPIException('404')
+
+        calls.clear()
+        with self.assertRaises(YandexAPIException):
+            resilience.call('http://host/a', not_found)
+        self.assertEqual(1, len(calls))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        threading.Event().wait(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+    def test_circuit_open(self):
+        resilience = Resilience(
+            RetryPolicy(1), failure_threshold=1, reset_timeout=60
+        )
+
+        def failing():
+            raise TransientAPIException('timeout')
+
+        with self.assertRaises(TransientAPIException):
+            resilience.call('http://host/a', failing)
+        with self.assertRaises(CircuitOpenException):
+            resilience.call('http://host/b', failing)
+        self.assertEqual('ok', resilience.call('http://other/', lambda: 'ok'))
+
+    def test_hedged_request(self):
+        resilience = Resilience(hedge_percentile=50)
+        for _ in range(20):
+            resilience.latencies['host'].add(0.01)
+        calls = []
+
+        def slow_first():
+            calls.append(1)
+            if len(calls) == 1:
+                threading.Event().wait(1)
+                return 'slow'
+            return 'fast'
+
+        self.assertEqual('fast', resilience.call('http://host/', slow_first))
+        self.assertEqual(2, len(calls))
+
+    def test_hedged_request_async(self):
+        resilience = Resilience(hedge_percentile=50)
+        for _ in range(20):
+            resilience.latencies['host'].add(0.01)
+        calls = []
+
+        async def slow_first():
+            calls.append(1)
+            await asyncio.sleep(1 if len(calls) == 1 else 0)
+            return len(calls)
+
+        result = asyncio.run(resilience.call_async('http://host/', slow_first))
+        self.assertEqual(2, result)
+
+    def test_read_timeout(self):
+        with StubForecastServer(latency=0.5) as server:
+            api = YandexWeatherAPI(
+                ConnectionPool(read_timeout=0.1),
+                cities=server.cities_urls(['CITY1']),
+                resilience=Resilience(RetryPolicy(1)),
+            )
+            with self.assertRaises(TransientAPIException):
+                api.get_forecasting('CITY1')
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_coalescing(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return len(calls)
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do('key', slow_call))
+        )
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(
+                target=lambda: results.append(flight.do('key', slow_call))
+            )
+            for _ in range(5)
+        ]
+        for follower in followers:
+            follower.start()
+        # Дать последователям дойти до ожидания результата
+        threading.Event().wait(0.1)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join()
+        self.assertEqual([1] * 6, results)
+        self.assertEqual(1, flight.do('other', lambda: 1))
+
+
+class ForecastServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubForecastServer(days=2, latency=0.2).start()
+        self.service = ForecastService(
+            self.stub.cities_urls(['CITY1', 'CITY2']), refresh_interval=60
+        ).start()
+        self.server = ForecastHTTPServer(self.service, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.stop()
+        self.stub.stop()
+
+    def get(self, path):
+        resp = ConnectionPool().request(self.url + path)
+        return resp.status, json.loads(resp.body)
+
+    def test_table_and_rating(self):
+        status, table = self.get('/table')
+        self.assertEqual(200, status)
+        self.assertEqual(['CITY1', 'CITY2'], [row['city'] for row in table])
+        status, rating = self.get('/rating')
+        self.assertEqual({'CITY1', 'CITY2'}, set(rating['ranks']))
+        self.assertEqual(404, self.get('/cities/ROME')[0])
+
+    def test_city_requests_coalesced(self):
+        self.service.refresh_interval = 0
+        requests_before = self.stub.requests_count
+        responses = []
+        threads = [
+            threading.Thread(
+                target=lambda: responses.append(self.get('/cities/CITY1'))
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([200] * 8, [status for status, _ in responses])
+        self.assertEqual(1, self.stub.requests_count - requests_before)
+
+    def test_previous_snapshot_not_rerated(self):
+        service = ForecastService({})
+        forecasts = {
+            'A': CityForecast('A', average=(20, 5)),
+            'B': CityForecast('B', average=(15, 5)),
+        }
+        first = service.rate(forecasts, {}, forecasts.values())
+        self.assertEqual(1, first.forecasts['A'].rating)
+        changed = CityForecast('B', average=(25, 5))
+        second = service.rate(
+            {**first.forecasts, 'B': changed}, {}, [changed]
+        )
+        self.assertEqual(2, second.forecasts['A'].rating)
+        self.assertEqual(1, first.forecasts['A'].rating)
+        self.assertEqual(2, first.forecasts['B'].rating)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,41 @@
+import sys
+from typing import Optional, Sequence
+
+# Дата, колонки часов, температуры и погоды, затем колонки доп. полей
+DayColumns = tuple[str | tuple, ...]
+PackedCityData = tuple[str, Optional[tuple[DayColumns, ...]]]
+
+
+def pack_day_hours(
+        forecast_day_hours: list[dict], fields: Sequence[str] = ()
+) -> tuple[tuple, ...]:
+    """
+    Разложить почасовые данные дня на колонки час/температура/погода
+    и колонки дополнительных полей fields. Отсутствующие значения - None
+    """
+    hours = tuple(int(hour['hour']) for hour in forecast_day_hours)
+    temps = tuple(hour['temp'] for hour in forecast_day_hours)
+    # Одинаковые строки после intern сериализуются pickle один раз
+    conditions = tuple(
+        sys.intern(hour['condition']) for hour in forecast_day_hours
+    )
+    return hours, temps, conditions, *(
+        tuple(hour.get(field) for hour in forecast_day_hours)
+        for field in fields
+    )
+
+
+def pack_city_data(
+        raw_city_data: tuple[str, dict | None], fields: Sequence[str] = ()
+) -> PackedCityData:
+    """
+    Оставить из ответа API только то, что нужно для вычислений:
+    forecasts[].date, hours[].{hour,temp,condition} и поля fields
+    """
+    city, city_data = raw_city_data
+    if not city_data:
+        return city, None
+    return city, tuple(
+        (forecast['date'], *pack_day_hours(forecast['hours'], fields))
+        for forecast in city_data['forecasts']
+    )
@@ -1,3 +1,5 @@
+import os
+
 from exceptions import RequirementsException
 
 
@@ -45,8 +47,124 @@ MIN_MINOR_PYTHON_VER = 9
 HOURS_RANGE = (9, 19)
 GOOD_CONDITIONS = ('clear', 'partly-cloudy', 'cloudy', 'overcast')
 
+# Окна часов для показателей, границы включительно
+ANALYTICS_WINDOWS = {
+    'day': HOURS_RANGE,
+    'night': (0, 5),
+    'morning': (6, 11),
+    'afternoon': (12, 17),
+    'evening': (18, 23),
+    'all': (0, 23),
+}
+ANALYTICS_DEFAULT_WINDOW = 'day'
+ANALYTICS_WINDOW_SEPARATOR = '@'
+ANALYTICS_PRECISION = 1
+
 CSV_FILE_RELATIVE_PATH = 'result.csv'
 
+OUTPUT_FORMAT_CSV = 'csv'
+OUTPUT_FORMAT_JSONL = 'jsonl'
+OUTPUT_FORMAT_COLUMNAR = 'columnar'
+OUTPUT_FILE_RELATIVE_PATHS = {
+    OUTPUT_FORMAT_CSV: CSV_FILE_RELATIVE_PATH,
+    OUTPUT_FORMAT_JSONL: 'result.jsonl',
+    OUTPUT_FORMAT_COLUMNAR: 'result.wfc',
+}
+COLUMNAR_ROW_GROUP_SIZE = 1024
+FORECAST_DAYS = 7
+
+METRICS_PREFIX = 'weather'
+METRICS_FORMAT_JSON = 'json'
+METRICS_FORMAT_PROMETHEUS = 'prometheus'
+METRICS_FORMATS = (METRICS_FORMAT_JSON, METRICS_FORMAT_PROMETHEUS)
+METRICS_LATENCY_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+PROFILE_DIR = 'profile'
+PROFILE_TOP_FUNCTIONS = 15
+
+BENCHMARK_SCALES = (10, 1000)
+BENCHMARK_RESULTS_PATH = 'benchmark_results.json'
+BENCHMARK_REGRESSION_THRESHOLD = 0.1
+
+RATING_TOP_K = 10
+
+FETCH_MODE_THREADS = 'threads'
+FETCH_MODE_ASYNC = 'async'
+FETCH_MODES = (FETCH_MODE_THREADS, FETCH_MODE_ASYNC)
+
+ASYNC_FETCH_CONCURRENCY = 100
+ASYNC_FETCH_PER_HOST_LIMIT = 20
+ASYNC_FETCH_TIMEOUT = 30
+
+CALCULATION_PROCESSES = os.cpu_count() or 1
+CALCULATION_ENGINE_POOL = 'pool'
+CALCULATION_ENGINE_NUMPY = 'numpy'
+CALCULATION_ENGINES = (CALCULATION_ENGINE_POOL, CALCULATION_ENGINE_NUMPY)
+PIPELINE_QUEUE_SIZE = 32
+DAY_MEMO_SIZE = 100_000
+CITY_MEMO_SIZE = 10_000
+
+EXECUTOR_AUTO = 'auto'
+EXECUTOR_INLINE = 'inline'
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_PROCESS = 'process'
+EXECUTORS = (EXECUTOR_AUTO, EXECUTOR_INLINE, EXECUTOR_THREAD, EXECUTOR_PROCESS)
+# Запросы ждут сеть, поэтому потоков больше, чем ядер
+FETCH_THREADS = min(64, (os.cpu_count() or 1) * 8)
+# До такого числа городов расчёт быстрее запуска задач в пуле процессов
+EXECUTOR_INLINE_MAX_ITEMS = 64
+
+# Соединение на каждый поток получения данных
+HTTP_POOL_SIZE = FETCH_THREADS
+HTTP_POOL_IDLE_TIMEOUT = 60
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 15
+
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_BASE = 0.2
+RETRY_BACKOFF_MAX = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Дублирующий запрос отправляется, если ответа нет дольше этого
+# перцентиля времени ответа хоста; None - не отправлять
+HEDGE_PERCENTILE = None
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+RESPONSE_CACHE_DIR = '.weather_cache'
+RESPONSE_CACHE_TTL = 30 * 60
+RESPONSE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Сохранённые ответы API вместо запросов: каталог <CITY>.json
+# или архив с индексом <архив>.index.json
+REPLAY_RESPONSE_SUFFIX = '.json'
+REPLAY_ARCHIVE_INDEX_SUFFIX = '.index.json'
+REPLAY_OPEN_ARCHIVES = 8
+
+HISTORY_DB_PATH = 'history.sqlite3'
+CHECKPOINT_PATH = 'checkpoint.journal'
+
+# Координатор раздаёт города узлам пакетами (шардами)
+CLUSTER_HOST = '127.0.0.1'
+CLUSTER_PORT = 50000
+# Общий ключ координатора и узлов. Без ключа координатор создаёт
+# случайный и принимает подключения только с этого компьютера
+CLUSTER_AUTHKEY_ENV = 'WEATHER_CLUSTER_KEY'
+CLUSTER_AUTHKEY_BYTES = 16
+CLUSTER_SHARD_SIZE = 100
+# Шард узла, не приславшего сигнал за это время, отдаётся другим узлам
+CLUSTER_LEASE_TIMEOUT = 30
+CLUSTER_HEARTBEAT_INTERVAL = 5
+CLUSTER_POLL_INTERVAL = 0.2
+CLUSTER_MAX_ATTEMPTS = 3
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8080
+SERVICE_REFRESH_INTERVAL = 10 * 60
+
 
 def check_python_version():
     import sys
@@ -0,0 +1,208 @@
+import datetime
+import logging
+from itertools import chain
+
+from analytics import (
+    BASE_FIELDS,
+    COUNT,
+    MAX,
+    MIN,
+    DayAnalyzer,
+    compile_analytics,
+    metric_value,
+)
+from exceptions import RequirementsException
+from models import CityForecast
+from transport import PackedCityData
+from utils import GOOD_CONDITIONS, HOURS_RANGE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def calculate_vectorized(
+        packed_data: list[PackedCityData],
+        analytics: tuple[str, ...] = (),
+) -> list[CityForecast]:
+    """
+    Вычислить средние значения по дням и за весь период для всех городов
+    сразу. Результат совпадает с DataCalculationTask.get_forecast_data
+    """
+    if np is None:
+        raise RequirementsException(
+            'Please install numpy to use the vectorized calculation engine'
+        )
+    days = [
+        (city_index, day)
+        for city_index, (_, city_days) in enumerate(packed_data)
+        for day in city_days or ()
+    ]
+    analyzer = compile_analytics(analytics) if analytics else None
+    columns = [
+        ([], [], [], [[] for _ in analytics]) for _ in packed_data
+    ]
+    averages: list[tuple[int | None, int | None] | None] = [
+        None if city_days is None else (None, None)
+        for _, city_days in packed_data
+    ]
+    fill_columns(columns, averages, days, analyzer)
+    results = []
+    for (city, city_days), city_columns, average in zip(
+            packed_data, columns, averages
+    ):
+        if city_days is None:
+            logging.warning(f'No data for the city {city}!')
+        elif average == (None, None):
+            logging.warning('Unable to calculate averages. No data')
+        *city_columns, city_analytics = city_columns
+        results.append(CityForecast(
+            city, *city_columns, average,
+            analytics=dict(zip(analytics, city_analytics)),
+        ))
+    return results
+
+
+def fill_columns(
+        columns: list[tuple[list, list, list, list[list]]],
+        averages: list[tuple[int | None, int | None] | None],
+        days: list,
+        analyzer: DayAnalyzer | None = None,
+) -> None:
+    """Посчитать все дни и города несколькими операциями над массивами"""
+    days_count = len(days)
+    if not days_count:
+        return
+    lengths = np.fromiter(
+        (len(day[1]) for _, day in days), dtype=np.int64, count=days_count
+    )
+    total = int(lengths.sum())
+    hours = np.fromiter(
+        chain.from_iterable(day[1] for _, day in days),
+        dtype=np.int64, count=total,
+    )
+    temps = np.fromiter(
+        chain.from_iterable(day[2] for _, day in days),
+        dtype=np.float64, count=total,
+    )
+    conditions = np.array(
+        list(chain.from_iterable(day[3] for _, day in days)), dtype=object
+    )
+    day_ids = np.repeat(np.arange(days_count), lengths)
+    in_range = (hours >= HOURS_RANGE[0]) & (hours <= HOURS_RANGE[1])
+    good = in_range & np.isin(conditions, GOOD_CONDITIONS)
+
+    temp_sum = np.bincount(
+        day_ids[in_range], weights=temps[in_range], minlength=days_count
+    )
+    temp_count = np.bincount(day_ids[in_range], minlength=days_count)
+    good_hours = np.bincount(day_ids[good], minlength=days_count)
+    valid = temp_count > 0
+    days_analytics = [] if analyzer is None else list(zip(*analytics_values(
+        analyzer, days, hours, day_ids, (temps, conditions)
+    )))
+    # np.round, как и round, округляет половины к чётному
+    day_temp = np.round(
+        temp_sum[valid] / temp_count[valid]
+    ).astype(np.int64)
+    day_good = good_hours[valid]
+
+    city_ids = np.fromiter(
+        (city_index for city_index, _ in days),
+        dtype=np.int64, count=days_count,
+    )[valid]
+    cities_count = len(columns)
+    city_days = np.bincount(city_ids, minlength=cities_count)
+    city_temp_sum = np.bincount(
+        city_ids, weights=day_temp, minlength=cities_count
+    )
+    city_good_sum = np.bincount(
+        city_ids, weights=day_good, minlength=cities_count
+    )
+    with np.errstate(invalid='ignore', divide='ignore'):
+        city_temp = np.round(city_temp_sum / city_days)
+        city_good = np.round(city_good_sum / city_days)
+
+    valid_days = [
+        (day, days_analytics[index] if days_analytics else ())
+        for index, (day, is_valid) in enumerate(zip(days, valid))
+        if is_valid
+    ]
+    for ((city_index, day), day_analytics), temp, good_count in zip(
+            valid_days, day_temp.tolist(), day_good.tolist()
+    ):
+        date = datetime.datetime.strptime(day[0], '%Y-%m-%d')
+        dates, temps, good_hours, city_analytics = columns[city_index]
+        dates.append(date.strftime('%d-%m'))
+        temps.append(temp)
+        good_hours.append(good_count)
+        for values, value in zip(city_analytics, day_analytics):
+            values.append(value)
+    for city_index in np.flatnonzero(city_days).tolist():
+        averages[city_index] = (
+            int(city_temp[city_index]), int(city_good[city_index])
+        )
+
+
+def analytics_values(
+        analyzer: DayAnalyzer,
+        days: list,
+        hours,
+        day_ids,
+        base_columns: tuple,
+) -> list[list]:
+    """
+    Значения дополнительных показателей для всех дней: на каждый
+    показатель несколько операций над уже собранными колонками
+    """
+    days_count = len(days)
+    columns = dict(zip(BASE_FIELDS, base_columns))
+    counted_fields = {
+        metric.field for metric, _ in analyzer.slots
+        if metric.values is not None
+    }
+    for index, field in enumerate(analyzer.fields, start=4):
+        values = list(chain.from_iterable(day[index] for _, day in days))
+        # None в колонке float становится nan
+        columns[field] = np.array(
+            values,
+            dtype=object if field in counted_fields else np.float64,
+        )
+    results = []
+    for metric, (first, last) in analyzer.slots[2:]:
+        value = columns[metric.field]
+        present = (hours >= first) & (hours <= last)
+        if value.dtype == object:
+            present &= np.not_equal(value, None)
+        else:
+            present &= ~np.isnan(value)
+        counts = np.bincount(day_ids[present], minlength=days_count)
+        totals = aggregate(metric, value, present, day_ids, days_count)
+        results.append([
+            metric_value(metric.aggregate, total, count)
+            for total, count in zip(totals.tolist(), counts.tolist())
+        ])
+    return results
+
+
+def aggregate(metric, value, present, day_ids, days_count):
+    """Итог показателя по дням, как у DayAnalyzer до деления на число часов"""
+    ids = day_ids[present]
+    if metric.values is not None:
+        return np.bincount(
+            day_ids[present & np.isin(value, list(metric.values))],
+            minlength=days_count,
+        )
+    if metric.aggregate == COUNT:
+        return np.bincount(ids, minlength=days_count)
+    if metric.aggregate in (MIN, MAX):
+        ufunc = np.minimum if metric.aggregate == MIN else np.maximum
+        totals = np.full(
+            days_count, np.inf if metric.aggregate == MIN else -np.inf
+        )
+        ufunc.at(totals, ids, value[present].astype(np.float64))
+        return totals
+    return np.bincount(
+        ids, weights=value[present].astype(np.float64), minlength=days_count
+    )
@@ -0,0 +1,410 @@
+import csv
+import datetime
+import json
+import logging
+import os
+import struct
+from array import array
+from math import isnan, nan
+from typing import IO, Mapping, Sequence
+
+from analytics import spec_title
+from models import AVERAGE_COLUMN, RATING_COLUMN, CityForecast
+from utils import (
+    COLUMNAR_ROW_GROUP_SIZE,
+    OUTPUT_FORMAT_COLUMNAR,
+    OUTPUT_FORMAT_CSV,
+    OUTPUT_FORMAT_JSONL,
+)
+
+MISSING = -2 ** 31
+COLUMNAR_MAGIC = b'WFC1'
+# Файл с дополнительными показателями: после дат идут их названия
+COLUMNAR_ANALYTICS_MAGIC = b'WFC2'
+
+
+def date_range(start: str, days: int) -> list[str]:
+    """Даты в формате таблицы (dd-mm) начиная со start (YYYY-MM-DD)"""
+    first_day = datetime.date.fromisoformat(start)
+    return [
+        (first_day + datetime.timedelta(days=offset)).strftime('%d-%m')
+        for offset in range(days)
+    ]
+
+
+class ResultWriter:
+    """
+    Записывает результаты городов в файл по одному, по мере готовности.
+    Набор дат и дополнительных показателей задаётся заранее, поэтому
+    данные не нужно просматривать перед записью
+    """
+    mode = 'w'
+    open_kwargs = {'newline': '', 'encoding': 'utf-8'}
+    # Можно ли записать рейтинг после всех городов
+    supports_late_rating = True
+
+    def __init__(
+            self,
+            path: str,
+            dates: Sequence[str],
+            analytics: Sequence[str] = (),
+    ) -> None:
+        self.path = path
+        self.dates = list(dates)
+        self.analytics = list(analytics)
+        self.positions = {date: index for index, date in enumerate(dates)}
+        self.written = 0
+        self.file: IO | None = None
+
+    def __enter__(self) -> 'ResultWriter':
+        self.open()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def open(self) -> None:
+        self.file = open(self.path, self.mode, **self.open_kwargs)
+        self.write_head()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write_head(self) -> None:
+        """Записать заголовок файла"""
+
+    def write(self, forecast: CityForecast) -> None:
+        """Записать результат города"""
+        raise NotImplementedError
+
+    def write_rating(self, ranks: Mapping[str, int]) -> None:
+        """
+        Записать рейтинг, если города были записаны до его расчёта
+        """
+
+    def day_columns(self, forecast: CityForecast) -> tuple[list, list]:
+        """Температура и часы без осадков по заявленным датам"""
+        temps = [None] * len(self.dates)
+        good_hours = [None] * len(self.dates)
+        for date, temp, hours in forecast.days():
+            position = self.positions.get(date)
+            if position is None:
+                logging.warning(
+                    f'Date {date} of {forecast.city} is out of the range'
+                )
+                continue
+            temps[position] = temp
+            good_hours[position] = hours
+        return temps, good_hours
+
+    def analytics_columns(self, forecast: CityForecast) -> list[list]:
+        """Значения показателей self.analytics по заявленным датам"""
+        columns = []
+        for spec in self.analytics:
+            column = [None] * len(self.dates)
+            for date, value in zip(
+                    forecast.dates, forecast.analytics.get(spec, ())
+            ):
+                position = self.positions.get(date)
+                if position is not None:
+                    column[position] = value
+            columns.append(column)
+        return columns
+
+
+class CsvResultWriter(ResultWriter):
+    """
+    Таблица из README: по две строки на город. Рейтинг пишется
+    в строке города; если города были записаны до расчёта рейтинга,
+    write_rating дописывает его, переписывая файл построчно
+    """
+    supports_late_rating = False
+    TEMPERATURE_ROW = 'Температура, среднее'
+
+    def __init__(
+            self,
+            path: str,
+            dates: Sequence[str],
+            analytics: Sequence[str] = (),
+    ) -> None:
+        super().__init__(path, dates, analytics)
+        self.unrated = 0
+
+    def write_head(self) -> None:
+        self.writer = csv.writer(self.file, delimiter=',')
+        self.writer.writerow(
+            ['Город/день', '', *self.dates, AVERAGE_COLUMN, RATING_COLUMN]
+        )
+
+    def write(self, forecast: CityForecast) -> None:
+        if not forecast.has_data:
+            logging.warning('No data to write to file')
+            return
+        temps, good_hours = self.day_columns(forecast)
+        self.writer.writerow([
+            forecast.city, self.TEMPERATURE_ROW, *temps,
+            forecast.average[0], forecast.rating,
+        ])
+        if forecast.rating is None and forecast.is_rated:
+            self.unrated += 1
+        self.writer.writerow([
+            '', 'Без осадков, часов', *good_hours, forecast.average[1], '',
+        ])
+        averages = forecast.analytics_average()
+        for spec, values in zip(
+                self.analytics, self.analytics_columns(forecast)
+        ):
+            self.writer.writerow([
+                '', spec_title(spec), *values, averages.get(spec), '',
+            ])
+        self.written += 1
+
+    def write_rating(self, ranks: Mapping[str, int]) -> None:
+        if not self.unrated:
+            return
+        self.file.close()
+        temporary_path = f'{self.path}.tmp'
+        with open(self.path, **self.open_kwargs) as source, open(
+                temporary_path, 'w', **self.open_kwargs
+        ) as target:
+            writer = csv.writer(target, delimiter=',')
+            for row in csv.reader(source):
+                if row[1] == self.TEMPERATURE_ROW and not row[-1]:
+                    row[-1] = ranks.get(row[0], '')
+                writer.writerow(row)
+        os.replace(temporary_path, self.path)
+        self.file = open(self.path, 'a', **self.open_kwargs)
+        self.writer = csv.writer(self.file, delimiter=',')
+        self.unrated = 0
+
+
+class JsonLinesResultWriter(ResultWriter):
+    """Одна JSON-строка на город и строка с рейтингом в конце"""
+
+    def write(self, forecast: CityForecast) -> None:
+        row = {
+            'type': 'city',
+            'city': forecast.city,
+            'days': {
+                date: [temp, hours] for date, temp, hours in forecast.days()
+            },
+            'average': forecast.average,
+            'rating': forecast.rating,
+        }
+        if forecast.analytics:
+            row['analytics'] = {
+                spec: dict(zip(forecast.dates, values))
+                for spec, values in forecast.analytics.items()
+            }
+            row['analytics_average'] = forecast.analytics_average()
+        self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self.written += 1
+
+    def write_rating(self, ranks: Mapping[str, int]) -> None:
+        self.file.write(json.dumps(
+            {'type': 'rating', 'ranks': dict(ranks)}, ensure_ascii=False
+        ) + '\n')
+
+
+class ColumnarResultWriter(ResultWriter):
+    """
+    Двоичный формат: заголовок с датами, группы строк по колонкам
+    int32 и рейтинг в конце. Пропуски записываются как MISSING.
+    Дополнительные показатели записываются колонками float64,
+    пропуски в них - nan
+    """
+    mode = 'wb'
+    open_kwargs = {}
+
+    def __init__(
+            self,
+            path: str,
+            dates: Sequence[str],
+            analytics: Sequence[str] = (),
+            row_group_size: int = COLUMNAR_ROW_GROUP_SIZE,
+    ) -> None:
+        super().__init__(path, dates, analytics)
+        self.row_group_size = row_group_size
+        self.group: list[CityForecast] = []
+
+    def write_head(self) -> None:
+        self.file.write(
+            COLUMNAR_ANALYTICS_MAGIC if self.analytics else COLUMNAR_MAGIC
+        )
+        _write_names(self.file, self.dates)
+        if self.analytics:
+            _write_names(self.file, self.analytics)
+
+    def write(self, forecast: CityForecast) -> None:
+        self.group.append(forecast)
+        self.written += 1
+        if len(self.group) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Записать накопленную группу строк"""
+        if not self.group:
+            return
+        has_data, temps, good_hours = array('i'), array('i'), array('i')
+        averages, ratings = array('i'), array('i')
+        self.file.write(b'G' + struct.pack('<I', len(self.group)))
+        for forecast in self.group:
+            _write_str(self.file, forecast.city)
+            has_data.append(forecast.has_data)
+            day_temps, day_hours = self.day_columns(forecast)
+            temps.extend(_int_or_missing(value) for value in day_temps)
+            good_hours.extend(_int_or_missing(value) for value in day_hours)
+            averages.extend(
+                _int_or_missing(value)
+                for value in (forecast.average or (None, None))
+            )
+            ratings.append(_int_or_missing(forecast.rating))
+        for column in (has_data, temps, good_hours, averages, ratings):
+            self.file.write(_little_endian(column).tobytes())
+        if self.analytics:
+            self.file.write(
+                _little_endian(self.analytics_group()).tobytes()
+            )
+        self.group = []
+
+    def analytics_group(self) -> array:
+        """Значения показателей группы: показатель, город, дата"""
+        columns = [self.analytics_columns(forecast) for forecast in self.group]
+        values = array('d')
+        for index in range(len(self.analytics)):
+            for city_columns in columns:
+                values.extend(
+                    nan if value is None else value
+                    for value in city_columns[index]
+                )
+        return values
+
+    def write_rating(self, ranks: Mapping[str, int]) -> None:
+        self.flush()
+        self.file.write(b'R' + struct.pack('<I', len(ranks)))
+        for city, rank in ranks.items():
+            _write_str(self.file, city)
+            self.file.write(struct.pack('<i', rank))
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.flush()
+        super().close()
+
+
+WRITERS: dict[str, type[ResultWriter]] = {
+    OUTPUT_FORMAT_CSV: CsvResultWriter,
+    OUTPUT_FORMAT_JSONL: JsonLinesResultWriter,
+    OUTPUT_FORMAT_COLUMNAR: ColumnarResultWriter,
+}
+
+
+def read_columnar(path: str) -> tuple[list[str], list[CityForecast]]:
+    """Прочитать файл ColumnarResultWriter: даты и результаты городов"""
+    with open(path, 'rb') as file:
+        magic = file.read(4)
+        if magic not in (COLUMNAR_MAGIC, COLUMNAR_ANALYTICS_MAGIC):
+            raise ValueError(f'{path} is not a columnar result file')
+        dates = _read_names(file)
+        analytics = (
+            _read_names(file) if magic == COLUMNAR_ANALYTICS_MAGIC else []
+        )
+        forecasts: list[CityForecast] = []
+        ranks: dict[str, int] = {}
+        while block := file.read(1):
+            count = struct.unpack('<I', file.read(4))[0]
+            if block == b'G':
+                forecasts.extend(_read_group(file, dates, analytics, count))
+            else:
+                for _ in range(count):
+                    city = _read_str(file)
+                    ranks[city] = struct.unpack('<i', file.read(4))[0]
+    for forecast in forecasts:
+        forecast.rating = ranks.get(forecast.city, forecast.rating)
+    return dates, forecasts
+
+
+def _read_group(
+        file: IO, dates: list[str], analytics: list[str], count: int
+) -> list:
+    names = [_read_str(file) for _ in range(count)]
+    days = len(dates)
+    has_data = _read_column(file, count)
+    temps = _read_column(file, count * days)
+    good_hours = _read_column(file, count * days)
+    averages = _read_column(file, count * 2)
+    ratings = _read_column(file, count)
+    values = _read_column(file, len(analytics) * count * days, 'd')
+    forecasts = []
+    for index, city in enumerate(names):
+        row = slice(index * days, (index + 1) * days)
+        positions = [
+            position for position, temp in enumerate(temps[row])
+            if temp != MISSING
+        ]
+        present = [
+            (dates[position], temps[row][position], good_hours[row][position])
+            for position in positions
+        ]
+        city_analytics = {}
+        for spec_index, spec in enumerate(analytics):
+            start = (spec_index * count + index) * days
+            city_analytics[spec] = [
+                None if isnan(values[start + position])
+                else values[start + position]
+                for position in positions
+            ]
+        average = tuple(
+            None if value == MISSING else value
+            for value in averages[index * 2:index * 2 + 2]
+        )
+        forecasts.append(CityForecast(
+            city,
+            [day[0] for day in present],
+            [day[1] for day in present],
+            [day[2] for day in present],
+            average if has_data[index] else None,
+            None if ratings[index] == MISSING else ratings[index],
+            city_analytics,
+        ))
+    return forecasts
+
+
+def _int_or_missing(value: int | None) -> int:
+    return MISSING if value is None else value
+
+
+def _little_endian(column: array) -> array:
+    if struct.pack('=i', 1) != struct.pack('<i', 1):
+        column.byteswap()
+    return column
+
+
+def _read_column(file: IO, count: int, typecode: str = 'i') -> array:
+    column = array(typecode)
+    column.frombytes(file.read(count * column.itemsize))
+    return _little_endian(column)
+
+
+def _write_names(file: IO, names: Sequence[str]) -> None:
+    file.write(struct.pack('<H', len(names)))
+    for name in names:
+        _write_str(file, name)
+
+
+def _read_names(file: IO) -> list[str]:
+    return [
+        _read_str(file) for _ in range(struct.unpack('<H', file.read(2))[0])
+    ]
+
+
+def _write_str(file: IO, value: str) -> None:
+    data = value.encode('utf-8')
+    file.write(struct.pack('<H', len(data)) + data)
+
+
+def _read_str(file: IO) -> str:
+    size = struct.unpack('<H', file.read(2))[0]
+    return file.read(size).decode('utf-8')